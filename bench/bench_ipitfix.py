@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for ipub.ipitfix on a large synthetic manuscript.
+
+Compares the previous `re.findall` based asterisk counting with the
+`str.count` based one, and fixing a set of chapter files sequentially vs.
+in a process pool. Run from the repository root:
+
+    python bench/bench_ipitfix.py [--chapters 200] [--pars 400]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ipub import ipitfix
+
+
+WORDS = 'the of and to a in that he was it his with as had for buck'.split()
+
+
+def mk_chapter(rnd, pars):
+    out = []
+    for _ in range(pars):
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(20, 120))]
+        # sprinkle closed, escaped and hanging italics:
+        for _ in range(rnd.randint(0, 3)):
+            i = rnd.randrange(len(words))
+            words[i] = rnd.choice(['*{}*', '\\*{}', '*{}'])\
+                    .format(words[i])
+        out.append(' '.join(words) + '\n\n')
+    return ''.join(out)
+
+
+def re_it_ast_count(line):
+    # previous implementation
+    return (len(re.findall(r'\*', line)) -
+            len(re.findall(r'\\\*', line)))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chapters', type=int, default=200)
+    parser.add_argument('--pars', type=int, default=400)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    chapters = [mk_chapter(rnd, args.pars) for _ in range(args.chapters)]
+    lines = [l for ch in chapters for l in ch.splitlines(True)]
+    size = sum(len(ch) for ch in chapters)
+    print('manuscript: {} chapters, {} lines, {:.1f} MB'.format(
+        len(chapters), len(lines), size / 2**20))
+
+    t_re, _ = timed(lambda: [re_it_ast_count(l) for l in lines])
+    t_count, _ = timed(lambda: [ipitfix.it_ast_count(l) for l in lines])
+    print('asterisk counting: re.findall {:.3f}s, str.count {:.3f}s'.format(
+        t_re, t_count))
+    t_filter, _ = timed(lambda: sum(1 for _ in ipitfix.fix_italics(lines)))
+    print('fix_italics over all lines: {:.3f}s'.format(t_filter))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def write_files():
+            paths = []
+            for i, ch in enumerate(chapters):
+                path = os.path.join(tmp, 'ch{:04d}.md'.format(i))
+                with open(path, 'w') as foo:
+                    foo.write(ch)
+                paths.append(path)
+            return paths
+        paths = write_files()
+        t_seq, changed = timed(ipitfix.fix_files, paths, 1)
+        write_files()
+        t_par, _ = timed(ipitfix.fix_files, paths, args.workers)
+        print('fix_files ({} changed): sequential {:.3f}s, pool {:.3f}s'
+              .format(len(changed), t_seq, t_par))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+Memory benchmark for the page record pipeline (scrivx2yaml through the page
+metadata stage of genep) on a large synthetic Scrivener binder.
+
+Compares the previous dict based pipeline (page dicts copied and merged per
+item, children lists rebuilt recursively) with
+`schema.Page` records (slots, children tuples, augmented in place).
+Reports peak traced memory and run time of each. Run from the repository
+root:
+
+    python bench/bench_pages.py [--entries 5000] [--fanout 10]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ipub import scriv
+from ipub import utils
+
+
+# metadata as found in the header of a chapter source:
+SOURCE_META = {'subheading': 'A subheading', 'hdgalign': 'center',
+               'beg_raw': '<p>Some raw HTML</p>'}
+
+
+def mk_binder(rnd, entries, fanout):
+    """
+    Returns the 'Manuscript' BinderItem of a synthetic binder with
+    `entries` items, nested up to three levels.
+    """
+    top = ET.Element('BinderItem', ID='0', Type='DraftFolder')
+    ET.SubElement(top, 'Title').text = 'Manuscript'
+    ET.SubElement(top, 'MetaData')
+    parents = [ET.SubElement(top, 'Children')]
+    for i in range(entries):
+        parent = parents[min(len(parents) - 1, rnd.randrange(3))]
+        item = ET.SubElement(parent, 'BinderItem', ID=str(i + 1),
+                             Type='Text')
+        ET.SubElement(item, 'Title').text = 'Chapter {}'.format(i + 1)
+        md = ET.SubElement(item, 'MetaData')
+        ET.SubElement(md, 'IncludeInCompile').text = 'Yes'
+        if len(parents) < 3 and rnd.randrange(fanout) == 0:
+            parents.append(ET.SubElement(item, 'Children'))
+        elif len(parents) > 1 and rnd.randrange(fanout) == 0:
+            parents.pop()
+    return top
+
+
+def old_get_chapters(top):
+    # previous implementation: plain dicts, children as lists
+    def get_children(top, chapters):
+        for e in top.iterfind('BinderItem'):
+            rec = {'scrivID': e.get('ID'), 'scrivType': e.get('Type'),
+                   'scrivTitle': e.findtext('Title'), 'children': []}
+            children = e.find('Children')
+            if children is not None:
+                get_children(children, rec['children'])
+            if not rec['children']:
+                rec.pop('children')
+            chapters.append(rec)
+
+    chapters = []
+    get_children(top.find('Children'), chapters)
+    return chapters
+
+
+def old_pipeline(top):
+    chapters = old_get_chapters(top)
+    ids = set()
+
+    def augment_ch(chapters):
+        for ch in chapters:
+            id_str = re.sub(r'[ \-&/]', '_', ch['scrivTitle'].lower())
+            ids.add(id_str)
+            ch['id'] = id_str
+            ch['type'] = 'chapter'
+            ch['rtf_src'] = os.path.join('Files/Docs',
+                                         '{}.rtf'.format(ch.pop('scrivID')))
+            ch['heading'] = ''
+            ch['subheading'] = ''
+            if 'children' in ch:
+                augment_ch(ch['children'])
+
+    augment_ch(chapters)
+
+    def augment_meta(meta_item):
+        item = meta_item.copy()
+        item['mdfile'] = item['id'] + '.md'
+        item['parstyle'] = 'par-indent'
+        return utils.merge_dicts(SOURCE_META, item)
+
+    def genmeta(mm_list):
+        out = []
+        for item in mm_list:
+            if 'children' in item:
+                item['children'] = genmeta(item['children'])
+            out.append(augment_meta(item))
+        return out
+
+    return genmeta(chapters)
+
+
+def new_pipeline(top):
+    chapters, _ = scriv.get_chapters(top)
+    chapters = scriv.chapters_to_dict(chapters, in_place=True)
+    for pg in chapters:
+        for item in pg.walk():
+            item['mdfile'] = item['id'] + '.md'
+            item['parstyle'] = 'par-indent'
+            for key, value in SOURCE_META.items():
+                if key not in item:
+                    item[key] = value
+    return chapters
+
+
+def measure(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, current, peak, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--fanout', type=int, default=10)
+    args = parser.parse_args()
+
+    top = mk_binder(random.Random(42), args.entries, args.fanout)
+    print('binder: {} entries'.format(args.entries))
+    for name, func in (('dicts', old_pipeline), ('pages', new_pipeline)):
+        elapsed, current, peak, _ = measure(func, top)
+        print('{:6s} {:.3f}s, retained {:.1f} MB, peak {:.1f} MB'.format(
+            name, elapsed, current / 2**20, peak / 2**20))
+
+    # sanity check: both pipelines yield the same records
+    old = old_pipeline(top)
+    new = [pg.to_dict() for pg in new_pipeline(top)]
+    assert old == new, 'pipelines differ'
+
+
+if __name__ == '__main__':
+    main()
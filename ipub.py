@@ -7,14 +7,40 @@ projects into good looking EPUBs and print books(written for Python 3)
 Run `python ipub.py -h` for more info
 """
 
+import os
+import sys
 import argparse
 import logging
 import json
 
-from ipub import epub, scriv, latex, utils
+from ipub import epub, scriv, latex, utils, params, writers, ncx, check, \
+        schema, events, retag, search
 
 
-logging.basicConfig(level=logging.INFO)
+def target_list(value):
+    """
+    Converts the comma separated list of output targets `value` to a list
+    (argparse type).
+    """
+    targets = [t.strip() for t in value.split(',') if t.strip()]
+    unknown = [t for t in targets if t not in params._TARGETS]
+    if unknown or not targets:
+        raise argparse.ArgumentTypeError('unknown target(s): {}'.format(
+                ', '.join(unknown) or value))
+    return targets
+
+
+def query_item(value):
+    """
+    Converts query parameter `value` given as 'key=value' to a tuple
+    (argparse type).
+    """
+    key, sep, val = value.partition('=')
+    if not sep or not key:
+        raise argparse.ArgumentTypeError(
+                "expected 'key=value', got '{}'".format(value))
+    return key, val
+
 
 def setup_parser_create(p):
     p.add_argument('--template', required=True, help="""cookiecutter template
@@ -32,6 +58,13 @@ def setup_parser_init(p):
     p.add_argument('--target', default='.',
             help="""directory in which to set up EPUB structure; defaults to
             current directory""")
+    p.add_argument('--link', choices=['copy', 'hard', 'reflink'],
+            default='copy',
+            help="""how to place immutable assets (images, CSS,
+            container.xml) in the new project: 'hard' shares them via
+            hardlinks (do not edit them in place), 'reflink' uses
+            copy-on-write clones where the file system supports it; falls
+            back to 'copy' if linking is not possible; defaults to 'copy'""")
 
 
 def setup_parser_scriv2md(p):
@@ -43,7 +76,34 @@ def setup_parser_scriv2md(p):
             help="path to Scrivener project directory")
     p.add_argument('--use_synopsis', action='store_true',
             help="""will look for Scrivener synopsis files and prepend
-            content as metadata to respective  Markdown content files""")
+            content as metadata to respective  Markdown content files (all
+            synopses are validated as YAML first)""")
+    p.add_argument('--fixit', action='store_true',
+            help="""fix hanging italics in the generated Markdown files (see
+            ipub/ipitfix.py)""")
+    p.add_argument('--workers', type=int, default=None,
+            help="""number of worker processes for fixing italics; defaults
+            to the number of CPUs""")
+    p.add_argument('--stats', default=None,
+            help="""save a JSON stats index (words, characters, paragraphs,
+            section breaks and italics per chapter plus totals) to this
+            file""")
+    p.add_argument('--fingerprints', default=None,
+            help="""JSON file with the content fingerprints of the RTF
+            sources converted last time (only chapters whose text changed
+            are converted again); defaults to '{}' in the Markdown
+            directory""".format(params._SCRIV_FINGERPRINTS))
+    p.add_argument('--force', action='store_true',
+            help="""convert all chapters, whether they changed or not""")
+    p.add_argument('--report', action='store_true',
+            help="""list the chapters that are new, changed or removed since
+            the last run instead of converting them""")
+    p.add_argument('--search_index', default=None,
+            help="""SQLite file with a full-text search index (see the
+            'search' command) in which to update the book's chapters""")
+    p.add_argument('--search_book', default=None,
+            help="""name of the book in the search index (the same as for
+            genep); required with --search_index""")
 
 
 def setup_parser_mmcat(p):
@@ -60,6 +120,15 @@ def setup_parser_mmcat(p):
             help="""will replace '***' and '###' (also if escaped and/or
                  space spearated) with LaTeX code for a paragraph separator
                  (fleuron)""")
+    p.add_argument('--chapterdir', default=None,
+            help="""write each top level chapter (with its children) to a
+                 Markdown file <id>.md of its own in this directory instead
+                 of concatenating (only changed files are rewritten); see
+                 genlatex --chapterdir""")
+    p.add_argument('--stats', default=None,
+            help="""save a JSON stats index (words, characters, paragraphs,
+                 section breaks and italics per chapter plus totals) to this
+                 file""")
 
 
 def setup_parser_body2md(p):
@@ -86,12 +155,14 @@ def setup_parser_body2md(p):
 def setup_parser_scrivx2yaml(p):
     p.add_argument('--projdir', required=True,
             help="path to Scrivener project directory")
-    p.add_argument('--scrivxml', default='project.scrivx',
+    p.add_argument('--scrivxml', default=None,
             help="Scrivener project XML file, relative to Scrivener project"
-            " directory; defaults to 'project.scrivx'")
-    p.add_argument('--rtfdir', default='Files/Docs',
+            " directory; defaults to the project's only .scrivx file")
+    p.add_argument('--rtfdir', default=None,
             help="path to Scrivener rtf directory, relative to Scrivener"
-            " project directory; defaults to 'Files/Docs'")
+            " project directory; defaults to 'Files/Docs' for Scrivener 2"
+            " and 'Files/Data' for Scrivener 3 projects (detected"
+            " automatically)")
     p.add_argument('--output', type=argparse.FileType('w'), default=None,
             help="file to save YAML output to, defaults to STDOUT if"
             " not specified")
@@ -109,6 +180,34 @@ def setup_parser_scrivx2yaml(p):
     p.add_argument('--hoffset', type=int, default=0,
             help="""offset for start of chapter headings (first <hoffset>
             chapters will be skipped""")
+    p.add_argument('--synopsis', action='store_true',
+            help="""merge the `key: value` metadata in the items' Scrivener
+            synopsis files into the YAML output (validated), so that genep
+            needs no metadata in the Markdown files""")
+
+
+def setup_parser_ncx2yaml(p):
+    p.add_argument('--source', required=True,
+            help="""toc.ncx file, EPUB archive (read without unpacking), or
+            directory with EPUB archives to import""")
+    p.add_argument('--mddir', required=True,
+            help="""directory to which to write markdown output; for a
+            directory of EPUBs one subdirectory per EPUB (with its own
+            mainmatter.yaml) will be created""")
+    p.add_argument('--output', type=argparse.FileType('w'), default=None,
+            help="file to save YAML output to, defaults to STDOUT if"
+            " not specified (ignored for a directory of EPUBs)")
+    p.add_argument('--type', default='chapter',
+            help="string to used as 'Type' attribute for chapters; "
+            "defaults to 'chapter'")
+    p.add_argument('--headings', action='store_true',
+            help="will add headings to for each chapter as 'Chapter Num'")
+    p.add_argument('--hoffset', type=int, default=0,
+            help="""offset for start of chapter headings (first <hoffset>
+            chapters will be skipped""")
+    p.add_argument('--workers', type=int, default=None,
+            help="""number of worker processes when importing a directory
+            of EPUBs; defaults to the number of CPUs""")
 
 
 def setup_parser_genlatex(p):
@@ -126,6 +225,17 @@ def setup_parser_genlatex(p):
             help="template to use for the book")
     p.add_argument('--book', required=True,
             help="file name to be used for LaTeX output (without extension")
+    p.add_argument('--workers', type=int, default=None,
+            help="""number of worker processes for rendering pages; defaults
+            to the number of CPUs""")
+    p.add_argument('--mmyaml', default=None,
+            help="""YAML file with book mainmatter page inventory; required
+                 with --chapterdir""")
+    p.add_argument('--chapterdir', default=None,
+            help="""directory with per chapter LaTeX files (converted from
+                 the output of mmcat --chapterdir); if given together with
+                 --mmyaml, the main file \\include's each chapter instead
+                 of the single mainmatter file""")
 
 
 def setup_parser_genep(p):
@@ -161,6 +271,134 @@ def setup_parser_genep(p):
             ***, ###, <<<>>> (or variants of these including whitespace) with
             an <hr class="asterism" /> element; this can be styled in CSS e.g.
             to use a predefined image""")
+    p.add_argument('--img_srcdir', default=None,
+            help="""path to image source directory relative to EPUB root
+            directory; if specified, images are read from there and written
+            to `imgdir`, optimized to fit `img_budget` where required""")
+    p.add_argument('--img_budget', default=None,
+            choices=sorted(params._IMG_BUDGETS),
+            help="""retailer image budget (maximum pixels and file size) to
+            which images from `img_srcdir` are downscaled / recompressed;
+            requires Pillow""")
+    p.add_argument('--workers', type=int, default=None,
+            help="""number of worker processes for image optimization;
+            defaults to the number of CPUs""")
+    p.add_argument('--fixit', action='store_true',
+            help="""fix hanging italics in Markdown sources on the fly (see
+            ipub/ipitfix.py)""")
+    p.add_argument('--split_size', type=int, default=None,
+            help="""split chapters whose XHTML body exceeds this size (in KB)
+            into several files (at paragraph boundaries); the parts are
+            added to manifest and spine, links to them are rewritten""")
+    p.add_argument('--split_breaks', action='store_true',
+            help="""split chapters into separate files after each in-page
+            section break""")
+    p.add_argument('--stats', default=None,
+            help="""save a JSON stats index (words, characters, paragraphs,
+            section breaks, italics, output size and render time per page
+            plus totals) to this file""")
+    p.add_argument('--css', default='full',
+            choices=['full', 'minify', 'prune'],
+            help="""'minify' links a minified copy of the stylesheet
+            (`css_file` in meta YAML, with extension '.min.css') instead of
+            the stylesheet itself; 'prune' additionally drops all rules for
+            classes, ids and elements not used in any rendered page; defaults
+            to 'full' (stylesheet as is)""")
+    p.add_argument('--targets', default=None,
+            type=target_list,
+            help="""comma separated list of output targets ({}); pages are
+            rendered once, OPF/NCX/nav, guide and `utm` link parameters (see
+            `targets` in meta YAML) per target; each target is packaged as
+            `epubfile` with the target name appended (e.g.
+            'book-kindle.epub')""".format(', '.join(sorted(params._TARGETS))))
+    p.add_argument('--fragment_cache', default=None,
+            help="""directory for a persistent cache of pages rendered from
+            templates (front and backmatter), keyed on the templates and the
+            data they read; can be shared by several books""")
+    p.add_argument('--fragment_cache_size', type=int, default=None,
+            help="""size cap of the fragment cache in MB (least recently
+            used entries are evicted); defaults to {}""".format(
+            params._FRAGMENT_CACHE_SIZE // 2**20))
+    p.add_argument('--static_link', choices=['copy', 'hard', 'reflink'],
+            default='copy',
+            help="""how the 'dir' writer places static pages that need no
+            URL rewriting: kernel-side copy, hardlink to the source or
+            copy-on-write clone; defaults to 'copy'""")
+    p.add_argument('--search_index', default=None,
+            help="""SQLite file with a full-text search index (see the
+            'search' command) in which to update the book's chapters""")
+    p.add_argument('--search_book', default=None,
+            help="""name of the book in the search index (the same as for
+            scriv2md); required with --search_index""")
+    p.add_argument('--writer', default='dir',
+            choices=['dir', 'zip', 'none'],
+            help="""how to output the generated files: 'dir' writes them
+            to the EPUB root directory (only files whose content changed),
+            'zip' packages the complete book as `epubfile`, 'none' is a dry
+            run; defaults to 'dir'""")
+    p.add_argument('--epubfile', default='book.epub',
+            help="""EPUB archive to write with `--writer zip`, relative to
+            EPUB root directory; defaults to 'book.epub'""")
+
+
+def setup_parser_pack(p):
+    p.add_argument('--epubdir', default='.',
+            help="""path to EPUB root directory; defaults to '.'""")
+    p.add_argument('--epubfile', default='book.epub',
+            help="""EPUB archive to create, relative to EPUB root directory;
+            defaults to 'book.epub'""")
+
+
+def setup_parser_check(p):
+    p.add_argument('--source', default='.',
+            help="""EPUB root directory or EPUB archive to check; defaults
+            to '.'""")
+    p.add_argument('--metayaml',
+            help="""YAML file with book metadata (relative to EPUB root
+            directory); if given together with --mmyaml, manifest and spine
+            are checked against the pages defined there""")
+    p.add_argument('--mmyaml',
+            help="""YAML file with mainmatter structure (relative to EPUB
+            root directory)""")
+    p.add_argument('--workers', type=int,
+            help="""number of processes for parsing XHTML files; defaults to
+            number of CPUs""")
+
+
+def setup_parser_retag(p):
+    p.add_argument('--source', required=True, nargs='+',
+            help="""EPUB archives or directories to search for them
+            (recursively)""")
+    p.add_argument('--url_re', required=True,
+            help="""regular expression for the URLs to rewrite (as for
+            `query_url` in mainmatter YAML)""")
+    p.add_argument('--utm', required=True, nargs='+', type=query_item,
+            metavar='KEY=VALUE',
+            help="""query parameters to set in matching URLs, e.g.
+            'utm_campaign=spring'""")
+    p.add_argument('--outdir', default=None,
+            help="""directory to write the retagged archives to; by default
+            archives are replaced in place (only if links changed)""")
+    p.add_argument('--workers', type=int, default=None,
+            help="""number of processes for retagging archives; defaults to
+            number of CPUs""")
+
+
+def setup_parser_search(p):
+    p.add_argument('--index', required=True,
+            help="""SQLite search index file written by genep or scriv2md
+            with --search_index""")
+    p.add_argument('query', nargs='?', default=None,
+            help="""full-text query (SQLite FTS5 syntax, e.g. 'Buck',
+            '"lost mine"', 'Buck NOT Spitz' or 'heading:Thornton'); lists
+            all chapters if omitted""")
+    p.add_argument('--book', default=None,
+            help="""only search the chapters of this book""")
+    p.add_argument('--breaks', action='store_true',
+            help="""only list chapters with in-page section breaks (number
+            shown)""")
+    p.add_argument('--limit', type=int, default=20,
+            help="""maximum number of results; defaults to 20""")
 
 
 def handle_mmcat(args):
@@ -169,7 +407,7 @@ def handle_mmcat(args):
     level inserted.
     """
     latex.mmcat(args.mmyaml, args.outfile, args.mddir, args.hoffset,
-            args.lbreak)
+            args.lbreak, args.chapterdir, args.stats)
 
 
 def handle_genlatex(args):
@@ -177,7 +415,17 @@ def handle_genlatex(args):
     Generates LaTeX for a print book, given meta YAML, mainmatter md and a
     template.
     """
-    latex.mkbook(args.metayaml, args.book, args.tmpl, args.yincl)
+    latex.mkbook(args.metayaml, args.book, args.tmpl, args.yincl,
+            args.workers, args.mmyaml, args.chapterdir)
+
+
+def check_search_book(args):
+    """
+    Exits with an error if --search_index is given without --search_book.
+    """
+    if args.search_index and not args.search_book:
+        logging.error('--search_index needs --search_book')
+        sys.exit(1)
 
 
 def handle_scriv2md(args):
@@ -186,18 +434,30 @@ def handle_scriv2md(args):
 
     Returns number of items written.
     """
-    scriv.to_md(args.mmyaml, args.projdir, args.mddir, args.use_synopsis)
+    check_search_book(args)
+    scriv.to_md(args.mmyaml, args.projdir, args.mddir, args.use_synopsis,
+            args.fixit, args.workers, args.stats, args.fingerprints,
+            args.force, args.report, args.search_index, args.search_book)
 
 
 def handle_scrivx2yaml(args):
     """
     Converts the 'Manuscript' section a Scrivener project XML file into a
     YAML file, augmenting with additional info such as rtf source file
-    location and unique label.
+    location, unique label and Scrivener label/status/keywords.
     """
     scriv.to_yaml(args.projdir, args.scrivxml, args.rtfdir,
             args.toptitle, args.typefilter, args.type, args.hoffset,
-            args.headings, args.output)
+            args.headings, args.output, args.synopsis)
+
+
+def handle_ncx2yaml(args):
+    """
+    Imports existing EPUBs: converts the NCX navigation map into mainmatter
+    YAML and extracts the chapter content as Markdown files.
+    """
+    ncx.to_yaml(args.source, args.mddir, args.output, args.type,
+            args.headings, -args.hoffset, args.workers)
 
 
 def handle_body2md(args):
@@ -218,7 +478,7 @@ def handle_init(args):
     """
     Intializes basic EPUB directory structure.
     """
-    epub.init(args.target)
+    epub.init(args.target, args.link)
 
 
 def handle_create(args):
@@ -239,9 +499,74 @@ def handle_genep(args):
     """
     Generates the files required for an EPUB ebook
     """
+    if args.targets and len(args.targets) > 1 and args.writer == 'dir':
+        logging.error('several --targets need --writer zip or none')
+        sys.exit(1)
+    check_search_book(args)
     epub.mkbook(args.epubdir, args.srcdir, args.htmldir, args.imgdir,
             args.metayaml, args.mmyaml, args.yincl, args.dropcaps,
-            args.asterism)
+            args.asterism, args.img_srcdir, args.img_budget, args.workers,
+            args.writer, args.epubfile, args.fixit,
+            args.split_size * 1024 if args.split_size else None,
+            args.split_breaks, args.stats, args.css, args.targets,
+            args.fragment_cache,
+            args.fragment_cache_size * 2**20 if args.fragment_cache_size
+            else None, args.static_link, args.search_index,
+            args.search_book)
+
+
+def handle_pack(args):
+    """
+    Packages an EPUB root directory as reproducible EPUB archive (mimetype
+    first, fixed timestamps, files in exclude.list skipped).
+    """
+    writers.write_zip([], args.epubdir, args.epubfile)
+
+
+def handle_check(args):
+    """
+    Validates a generated EPUB (directory or archive): manifest and spine,
+    well-formed XHTML, duplicate ids, missing images/CSS, broken internal
+    links and mimetype placement. Exits with status 1 on errors.
+    """
+    page_ids = None
+    if args.metayaml and args.mmyaml:
+        epubdir = (args.source if os.path.isdir(args.source) else
+                   os.path.dirname(args.source))
+        page_ids = check.read_pages(epubdir, args.metayaml, args.mmyaml)
+    if check.check(args.source, page_ids, args.workers):
+        sys.exit(1)
+
+
+def handle_retag(args):
+    """
+    Rewrites the link query parameters (e.g. utm_* campaign tags) in existing
+    EPUB archives without rebuilding them.
+    """
+    try:
+        retag.retag(args.source, args.url_re, dict(args.utm), args.outdir,
+                args.workers)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+
+
+def handle_search(args):
+    """
+    Searches the full-text index of chapters built by genep or scriv2md
+    (--search_index) and prints book, page id, number of section breaks and
+    the matching text for each result.
+    """
+    try:
+        results = search.search(args.index, args.query, args.book,
+                args.breaks, args.limit)
+    except search.SearchError as e:
+        logging.error(e)
+        sys.exit(1)
+    for r in results:
+        text = ' '.join((r['snippet'] or r['heading'] or '').split())
+        print('\t'.join(str(v) for v in (r['book'], r['page'], r['breaks'],
+                text)))
 
 
 # The _task_handler dictionary maps each 'command' to a (task_handler,
@@ -256,22 +581,43 @@ _task_handler = {'init':        (handle_init, setup_parser_init),
                  'genep':       (handle_genep, setup_parser_genep),
                  'genlatex':    (handle_genlatex, setup_parser_genlatex),
                  'body2md':     (handle_body2md, setup_parser_body2md),
+                 'ncx2yaml':    (handle_ncx2yaml, setup_parser_ncx2yaml),
                  'mmcat':       (handle_mmcat, setup_parser_mmcat),
+                 'pack':        (handle_pack, setup_parser_pack),
+                 'check':       (handle_check, setup_parser_check),
+                 'retag':       (handle_retag, setup_parser_retag),
+                 'search':      (handle_search, setup_parser_search),
 }
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--log-format', choices=['text', 'json'],
+            default='text', help="""format of log messages on stderr:
+            plain text or one JSON object per line""")
+    parser.add_argument('-q', '--quiet', action='store_true',
+            help="""only log warnings and errors""")
+    parser.add_argument('--events', default=os.environ.get('IPUB_EVENTS'),
+            help="""file to which build events (stage start/end, files
+            written/skipped, external processes, warnings) are appended as
+            JSON lines; use 'unix:PATH' to send them to a Unix domain socket;
+            defaults to the IPUB_EVENTS environment variable""")
 
     # add subparser for each task
     subparsers = parser.add_subparsers()
     for k in _task_handler:
         func, p_setup = _task_handler[k]
         p = subparsers.add_parser(k, help=func.__doc__)
-        p.set_defaults(func=func)
+        p.set_defaults(func=func, command=k)
         p_setup(p)
 
     # parse the arguments and run the handler associated with each task
     args = parser.parse_args()
-    args.func(args)
+    events.setup(args.log_format, args.quiet, args.events)
+    try:
+        with events.stage(args.command):
+            args.func(args)
+    except schema.SchemaError as e:
+        logging.error(e)
+        sys.exit(1)
@@ -0,0 +1,331 @@
+"""
+Validation of generated EPUBs (a directory or a packaged archive): container
+and OPF, manifest/spine consistency (optionally against the `pages` defined
+in meta and mainmatter YAML), well-formed XHTML, duplicate ids, missing
+images or CSS and broken internal links, NCX targets and `mimetype`
+placement.
+
+Problems are returned as `(severity, path, message)` tuples with severity
+'error' or 'warning'.
+"""
+
+import os
+import re
+import posixpath
+import logging
+import zipfile
+import html.entities
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit, unquote
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from . import params
+from . import writers
+
+
+_CONTAINER = 'META-INF/container.xml'
+_MIMETYPE = b'application/epub+zip'
+_XHTML_TYPES = ('application/xhtml+xml', 'text/html')
+# XHTML files are only parsed in a process pool for books with at least this
+# many files (pool startup would otherwise dominate):
+_PARALLEL_MIN = 16
+
+
+def _local(tag):
+    """
+    Returns `tag` without namespace URI.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def _parse(data):
+    """
+    Parses XML `data`, resolving named HTML entities (such as ``&nbsp;``)
+    declared by the XHTML DTD.
+    """
+    parser = ET.XMLParser()
+    parser.entity.update((k, chr(v))
+                         for k, v in html.entities.name2codepoint.items())
+    parser.feed(data)
+    return parser.close()
+
+
+def scan_xhtml(job):
+    """
+    Parses one XHTML file; `job` is a tuple `(path, data)`.
+
+    Returns a tuple `(path, error, ids, dup_ids, links)` with `error` the
+    parse error message (or `None`), `ids` the set of element ids, `dup_ids`
+    the ids that occur more than once and `links` a list of `(tag, ref)`
+    tuples for all href and src attributes.
+    """
+    path, data = job
+    try:
+        root = _parse(data)
+    except ET.ParseError as e:
+        return path, str(e), set(), [], []
+    ids = set()
+    dups = []
+    links = []
+    for elem in root.iter():
+        elem_id = elem.get('id')
+        if elem_id is not None:
+            if elem_id in ids:
+                dups.append(elem_id)
+            ids.add(elem_id)
+        for attr in ('href', 'src', '{http://www.w3.org/1999/xlink}href'):
+            ref = elem.get(attr)
+            if ref is not None:
+                links.append((_local(elem.tag), ref))
+    return path, None, ids, dups, links
+
+
+def _resolve(base, ref):
+    """
+    Resolves `ref` relative to the file `base` (both relative to the EPUB
+    root). Returns `(path, fragment)` or `None` for external references.
+    """
+    parts = urlsplit(ref)
+    if parts.scheme or parts.netloc:
+        return None
+    path = unquote(parts.path)
+    if path:
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(base),
+                                                 path))
+    else:
+        path = base
+    return path, unquote(parts.fragment)
+
+
+def read_pages(epubdir, metayaml, mmyaml):
+    """
+    Returns the ids of the pages defined in `metayaml` (front- and
+    backmatter) and `mmyaml` (mainmatter), both relative to `epubdir`, in
+    reading order.
+    """
+    with open(os.path.join(epubdir, metayaml), 'r') as foi:
+        meta = yaml.safe_load(foi)
+    with open(os.path.join(epubdir, mmyaml), 'r') as foi:
+        mainmatter = yaml.safe_load(foi) or []
+    ids = []
+
+    def walk(pages):
+        for pg in pages:
+            ids.append(pg['id'])
+            walk(pg.get('children', []))
+
+    walk((meta.get('frontmatter') or []) + mainmatter +
+         (meta.get('backmatter') or []))
+    return ids
+
+
+def check_files(files, page_ids=None, workers=None):
+    """
+    Validates the EPUB in `files`, a dict that maps paths (relative to the
+    EPUB root, '/' separated) to content. If `page_ids` (see `read_pages`)
+    is given, manifest and spine are checked against it as well.
+
+    XHTML files are parsed in a pool of `workers` processes (1 parses
+    sequentially).
+
+    Returns a list of `(severity, path, message)` tuples.
+    """
+    problems = []
+
+    def error(path, msg, *args):
+        problems.append(('error', path, msg % args))
+
+    def warning(path, msg, *args):
+        problems.append(('warning', path, msg % args))
+
+    if files.get('mimetype', b'').strip() != _MIMETYPE:
+        error('mimetype', 'missing or not %r', _MIMETYPE.decode())
+
+    # container and OPF:
+    try:
+        container = _parse(files[_CONTAINER])
+        opf_path = next(e for e in container.iter()
+                        if _local(e.tag) == 'rootfile').get('full-path')
+        opf = _parse(files[opf_path])
+    except KeyError as e:
+        error(_CONTAINER, 'missing file %s', e)
+        return problems
+    except StopIteration:
+        error(_CONTAINER, 'no rootfile element')
+        return problems
+    except ET.ParseError as e:
+        error(_CONTAINER, 'cannot parse container or OPF: %s', e)
+        return problems
+
+    manifest = {}
+    media_types = {}
+    toc_id = None
+    spine = []
+    guide = []
+    for elem in opf.iter():
+        tag = _local(elem.tag)
+        if tag == 'item':
+            item_id, href = elem.get('id'), elem.get('href')
+            if item_id in manifest:
+                error(opf_path, 'duplicate manifest id %r', item_id)
+            target = _resolve(opf_path, href or '')
+            if target is None:
+                continue
+            manifest[item_id] = target[0]
+            media_types[target[0]] = elem.get('media-type')
+            if target[0] not in files:
+                error(opf_path, 'manifest item %r: %s not found', item_id,
+                      href)
+        elif tag == 'spine':
+            toc_id = elem.get('toc')
+        elif tag == 'itemref':
+            spine.append(elem.get('idref'))
+        elif tag == 'reference':
+            guide.append(elem.get('href', ''))
+
+    listed = set(manifest.values())
+    for path in sorted(files):
+        if (path in listed or path == 'mimetype' or path == opf_path or
+                path.startswith('META-INF/')):
+            continue
+        warning(path, 'not listed in manifest')
+
+    for idref in spine:
+        if idref not in manifest:
+            error(opf_path, 'spine itemref %r not in manifest', idref)
+    if len(set(spine)) != len(spine):
+        error(opf_path, 'spine lists items more than once')
+    if page_ids is not None:
+        expected = ['html_' + pg_id for pg_id in page_ids]
+        # parts of split chapters (of pages in `page_ids`) follow their
+        # chapter in the spine:
+        part_re = re.compile('html_' + params._SPLIT_PART_ID.format(
+                '(.+)', r'\d+') + '$')
+        known = set(page_ids)
+        parts = {i for i in spine if i not in expected and
+                 part_re.match(i) and part_re.match(i).group(1) in known}
+        spine = [i for i in spine if i not in parts]
+        for pg_id, item_id in zip(page_ids, expected):
+            if item_id not in manifest:
+                error(opf_path, 'page %r not in manifest', pg_id)
+        if spine != expected:
+            missing = [i for i in expected if i not in spine]
+            extra = [i for i in spine if i not in expected]
+            if missing or extra:
+                error(opf_path, 'spine does not match pages (missing: %s, '
+                      'extra: %s)', missing, extra)
+            else:
+                error(opf_path, 'spine order does not match pages')
+
+    # XHTML content:
+    xhtml = [(p, files[p]) for p, mt in sorted(media_types.items())
+             if mt in _XHTML_TYPES and p in files]
+    if workers == 1 or len(xhtml) < _PARALLEL_MIN:
+        results = list(map(scan_xhtml, xhtml))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(scan_xhtml, xhtml, chunksize=4))
+    ids = {}
+    for path, err, file_ids, dups, _ in results:
+        ids[path] = file_ids
+        if err:
+            error(path, 'not well-formed: %s', err)
+        for dup in sorted(set(dups)):
+            error(path, 'duplicate id %r', dup)
+
+    def check_ref(base, ref, what):
+        target = _resolve(base, ref)
+        if target is None:
+            return
+        path, frag = target
+        if path not in files:
+            error(base, 'broken %s %s', what, ref)
+        elif frag and path in ids and frag not in ids[path]:
+            error(base, 'broken %s %s (no element with id %r)', what, ref,
+                  frag)
+
+    for path, _, _, _, links in results:
+        for tag, ref in links:
+            if tag == 'img' or tag == 'image':
+                what = 'image'
+            elif tag == 'link':
+                what = 'stylesheet'
+            else:
+                what = 'link'
+            check_ref(path, ref, what)
+    for ref in guide:
+        check_ref(opf_path, ref, 'guide reference')
+
+    # NCX:
+    ncx_path = manifest.get(toc_id)
+    if toc_id and ncx_path is None:
+        error(opf_path, 'spine toc %r not in manifest', toc_id)
+    elif ncx_path in files:
+        try:
+            ncx = _parse(files[ncx_path])
+        except ET.ParseError as e:
+            error(ncx_path, 'not well-formed: %s', e)
+        else:
+            np_ids = set()
+            for elem in ncx.iter():
+                tag = _local(elem.tag)
+                if tag == 'navPoint':
+                    if elem.get('id') in np_ids:
+                        error(ncx_path, 'duplicate navPoint id %r',
+                              elem.get('id'))
+                    np_ids.add(elem.get('id'))
+                elif tag == 'content':
+                    check_ref(ncx_path, elem.get('src', ''), 'navPoint')
+
+    return problems
+
+
+def read_epub(source):
+    """
+    Reads the EPUB `source` (a directory or archive) into a dict that maps
+    '/' separated paths to content.
+
+    Returns a tuple `(files, problems)` with `problems` a list of archive
+    layout problems (mimetype not being the first, uncompressed entry).
+    """
+    problems = []
+    if os.path.isdir(source):
+        files = writers.collect_files(source)
+        files = {p.replace(os.sep, '/'): d for p, d in files.items()
+                 if not p.endswith('.epub')}
+        return files, problems
+    with zipfile.ZipFile(source) as zf:
+        infos = zf.infolist()
+        if not infos or infos[0].filename != 'mimetype':
+            problems.append(('error', 'mimetype',
+                             'not the first entry in the archive'))
+        for info in infos:
+            if (info.filename == 'mimetype' and
+                    (info.compress_type != zipfile.ZIP_STORED or
+                     info.extra)):
+                problems.append(('error', 'mimetype',
+                                 'compressed or with extra field'))
+        files = {i.filename: zf.read(i) for i in infos if not i.is_dir()}
+    return files, problems
+
+
+def check(source, page_ids=None, workers=None):
+    """
+    Validates the EPUB directory or archive `source` (see `check_files`),
+    logs all problems found and returns the number of errors.
+    """
+    logging.info('checking %s...', source)
+    files, problems = read_epub(source)
+    problems += check_files(files, page_ids, workers)
+    errors = 0
+    for severity, path, msg in problems:
+        if severity == 'error':
+            errors += 1
+            logging.error('%s: %s', path, msg)
+        else:
+            logging.warning('%s: %s', path, msg)
+    logging.info('%s: %d errors, %d warnings', source, errors,
+                 len(problems) - errors)
+    return errors
@@ -0,0 +1,221 @@
+"""
+Pruning and minification of the book stylesheet, based on the element names,
+classes and ids used in the rendered XHTML pages (collected with
+`collect_selectors` while `genep` renders the pages).
+
+Pruning is conservative: a selector is dropped only if one of its element
+names, classes or ids occurs nowhere in the book. Pseudo-classes, pseudo
+elements and attribute selectors are ignored for matching, at-rules other
+than ``@media`` and ``@supports`` are kept as they are.
+"""
+
+import re
+
+
+_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+_TAG_RE = re.compile(rb'<([A-Za-z][\w:.-]*)')
+_CLASS_RE = re.compile(rb'\sclass\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_ID_RE = re.compile(rb'\sid\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+# simple selector parts: element name, class, id (with CSS escapes)
+_PART_RE = re.compile(r'([.#]?)((?:[\w-]|\\.)+|\*)')
+# pseudo-classes/-elements (with arguments) and attribute selectors
+_IGNORE_RE = re.compile(r'::?[\w-]+(?:\([^)]*\))?|\[[^\]]*\]')
+_COMBINATOR_RE = re.compile(r'\s*([>+~])\s*')
+# at-rules whose blocks hold rules that can be pruned
+_NESTED_AT_RULES = ('@media', '@supports')
+
+
+def new_selectors():
+    """
+    Returns an empty collection of used selectors, see `collect_selectors`.
+    """
+    return {'tags': set(), 'classes': set(), 'ids': set()}
+
+
+def collect_selectors(data, used):
+    """
+    Adds the element names, classes and ids used in the XHTML page `data`
+    (bytes) to `used` (see `new_selectors`) and returns `used`.
+    """
+    used['tags'].update(t.lower().decode('ascii')
+                        for t in _TAG_RE.findall(data) if b':' not in t)
+    for m in _CLASS_RE.finditer(data):
+        used['classes'].update((m.group(1) or m.group(2)).decode('utf-8')
+                               .split())
+    for m in _ID_RE.finditer(data):
+        used['ids'].add((m.group(1) or m.group(2)).decode('utf-8').strip())
+    return used
+
+
+def _split_top(text, sep):
+    """
+    Splits `text` at `sep` characters outside of strings, parentheses and
+    brackets.
+    """
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if quote:
+            if c == '\\':
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == sep and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def parse_rules(css_text):
+    """
+    Parses `css_text` into a list of `(prelude, body)` tuples: `prelude` is
+    the selector list or at-rule, `body` the text between the braces (`None`
+    for statements such as ``@import``). Comments are removed.
+    """
+    text = _COMMENT_RE.sub('', css_text)
+    rules = []
+    pos = 0
+    while pos < len(text):
+        brace = text.find('{', pos)
+        semi = text.find(';', pos)
+        if brace < 0 or (0 <= semi < brace and
+                         text[pos:semi].lstrip().startswith('@')):
+            stmt = text[pos:semi if semi >= 0 else len(text)].strip()
+            if stmt:
+                rules.append((stmt, None))
+            if semi < 0:
+                break
+            pos = semi + 1
+            continue
+        # find the matching closing brace (skipping strings)
+        depth = 0
+        quote = None
+        i = brace
+        while i < len(text):
+            c = text[i]
+            if quote:
+                if c == '\\':
+                    i += 1
+                elif c == quote:
+                    quote = None
+            elif c in '"\'':
+                quote = c
+            elif c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            i += 1
+        rules.append((text[pos:brace].strip(), text[brace + 1:i]))
+        pos = i + 1
+    return rules
+
+
+def selector_used(selector, used):
+    """
+    Returns `True` if all element names, classes and ids in `selector` (a
+    single complex selector) are in `used` (see `collect_selectors`).
+    """
+    sel = _IGNORE_RE.sub(' ', selector)
+    for prefix, name in _PART_RE.findall(sel):
+        name = name.replace('\\', '')
+        if prefix == '.':
+            if name not in used['classes']:
+                return False
+        elif prefix == '#':
+            if name not in used['ids']:
+                return False
+        elif name != '*' and name.lower() not in used['tags']:
+            return False
+    return True
+
+
+def minify_selector(selector):
+    """
+    Returns `selector` with whitespace collapsed.
+    """
+    sel = re.sub(r'\s+', ' ', selector.strip())
+    return _COMBINATOR_RE.sub(r'\1', sel)
+
+
+def minify_body(body):
+    """
+    Returns the declaration block `body` (without braces) minified.
+    """
+    decls = []
+    for decl in _split_top(body, ';'):
+        prop, colon, value = decl.partition(':')
+        if not colon:
+            continue
+        value = re.sub(r'\s+', ' ', value.strip())
+        value = re.sub(r'\s*,\s*', ',', value)
+        value = re.sub(r'\s*!\s*important$', '!important', value)
+        decls.append('{}:{}'.format(prop.strip(), value))
+    return ';'.join(decls)
+
+
+def prune(css_text, used=None, minify=True):
+    """
+    Returns `css_text` without the rules none of whose selectors are in
+    `used` (see `selector_used`; nothing is pruned if `used` is `None`),
+    minified if `minify` is `True`.
+
+    Returns a tuple `(css_text, kept, total)` with the number of rules kept
+    and the number of rules in `css_text`.
+    """
+    kept = total = 0
+    out = []
+    for prelude, body in parse_rules(css_text):
+        if body is None:
+            out.append(prelude + ';')
+            continue
+        if prelude.startswith('@'):
+            if prelude.split(None, 1)[0].lower() in _NESTED_AT_RULES:
+                inner, k, t = prune(body, used, minify)
+                kept += k
+                total += t
+                if not k:
+                    continue
+                body = inner
+            elif minify:
+                body = minify_body(body) if ':' in body and \
+                        '{' not in body else body.strip()
+            out.append(_fmt_rule(re.sub(r'\s+', ' ', prelude) if minify
+                                 else prelude, body, minify))
+            continue
+        total += 1
+        selectors = [s.strip() for s in _split_top(prelude, ',')]
+        if used is not None:
+            selectors = [s for s in selectors if selector_used(s, used)]
+        if not selectors:
+            continue
+        kept += 1
+        if minify:
+            out.append(_fmt_rule(','.join(minify_selector(s)
+                                          for s in selectors),
+                                 minify_body(body), True))
+        else:
+            out.append(_fmt_rule(',\n'.join(selectors), body, False))
+    return ('' if minify else '\n').join(out), kept, total
+
+
+def _fmt_rule(prelude, body, minify):
+    """
+    Returns a rule with `prelude` and declaration block `body`.
+    """
+    if minify:
+        return '{}{{{}}}'.format(prelude, body)
+    return '{} {{{}}}'.format(prelude, body)
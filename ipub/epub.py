@@ -3,17 +3,30 @@ EPUB generation from Markdown source files plus YAML metadata
 """
 
 import os
-from datetime import datetime as dt
+import time
 import shutil
+import mmap
 from hashlib import md5
 import logging
 import re
+import json
+from concurrent.futures import ProcessPoolExecutor
 import yaml
 import jinja2 as j2
 import markdown
 
 from . import params
 from . import utils
+from . import img
+from . import ipitfix
+from . import ncx
+from . import writers
+from . import stats
+from . import schema
+from . import events
+from . import css
+from . import fragments
+from . import search
 
 
 def gen_uuid(message):
@@ -23,14 +36,54 @@ def gen_uuid(message):
             uuid[16:20], uuid[20:])
 
 
-def init(target):
+def book_uuid(meta):
+    """
+    Returns the book's unique identifier: the value of 'uuid' in `meta` if
+    pinned there, otherwise a UUID derived from the identifying metadata
+    items listed in ``params._UUID_KEYS``, so that it is stable across runs.
+    """
+    if meta.get('uuid'):
+        return str(meta['uuid'])
+    ident = {k: meta[k] for k in params._UUID_KEYS if k in meta}
+    return gen_uuid(json.dumps(ident, sort_keys=True, default=str))
+
+
+def init(target, link='copy'):
     """
     Intializes basic EPUB directory structure.
+
+    Follows the semantics of ``cp -a``: if `target` is an existing directory
+    the skeleton will be created as subdirectory ``epub`` in `target`,
+    otherwise `target` itself will be created. Immutable assets (see
+    ``params._EPUB_SKELETON_SHARED``) are placed via `utils.link_file` with
+    `link` as mode ('copy', 'hard', or 'reflink'); the YAML files, sources
+    and all other mutable files are always copied. Hardlinked assets share
+    their inode with the skeleton and must not be edited in place.
+
+    Returns the path to the new EPUB root directory.
     """
-    std, err = utils.run_script('cp', '-ar', params._EPUB_SKELETON_PATH,
-                                target)
-    if err: logging.error(err.decode('utf-8'))
-    if std: logging.info(std.decode('utf-8'))
+    skel = params._EPUB_SKELETON_PATH
+    if os.path.isdir(target):
+        target = os.path.join(target, os.path.basename(skel))
+    shared = [os.path.normpath(p) for p in params._EPUB_SKELETON_SHARED]
+
+    def is_shared(rel_path):
+        return any(rel_path == p or rel_path.startswith(p + os.sep)
+                   for p in shared)
+
+    logging.info('initializing EPUB directory %s...', target)
+    for dirpath, dirnames, filenames in os.walk(skel):
+        rel_dir = os.path.relpath(dirpath, skel)
+        out_dir = os.path.normpath(os.path.join(target, rel_dir))
+        os.makedirs(out_dir, exist_ok=True)
+        for fname in filenames:
+            rel_path = os.path.normpath(os.path.join(rel_dir, fname))
+            mode = link if is_shared(rel_path) else 'copy'
+            utils.link_file(os.path.join(dirpath, fname),
+                            os.path.join(out_dir, fname), mode)
+        shutil.copystat(dirpath, out_dir)
+
+    return target
 
 
 def navMap2dict(nav_map, chtype='chapter', headings=False, hoffset=0):
@@ -52,59 +105,119 @@ def navMap2dict(nav_map, chtype='chapter', headings=False, hoffset=0):
 
     ns = {'xmlns': ns_uri}
 
-    def get_navPoint_children(parent, records, count):
+    def get_navPoints(parent, depth):
         for np in parent.iterfind('xmlns:navPoint', ns):
-            count += 1
-            rec = {}
-            if headings and count > 0:
-                rec['heading'] = ('Chapter ' +
-                        num2eng(count).title().replace(' ', '-'))
-            else:
-                rec['heading'] = np.find(
-                        'xmlns:navLabel', ns).find('xmlns:text', ns).text
-            rec['id'] = np.get('id')
-            rec['type'] = chtype
-            rec['src'] = np.find('xmlns:content', ns).get('src')
-            # check for children:
-            if np.find('xmlns:navPoint', ns):
-                children = []
-                count = get_navPoint_children(np, children, count)
-                rec['children'] = children
-            records.append(rec)
-        return count
-
-    records = []
-    get_navPoint_children(nav_map, records, hoffset)
-
-    return records
-
-
-def build_img_inventory(epubdir, imgdir, opfdir):
+            yield (depth, np.get('id'),
+                   np.find('xmlns:navLabel', ns).find('xmlns:text', ns).text,
+                   np.find('xmlns:content', ns).get('src'))
+            yield from get_navPoints(np, depth + 1)
+
+    return ncx.nest_navpoints(get_navPoints(nav_map, 1), chtype, headings,
+                              hoffset)
+
+
+def build_img_inventory(epubdir, imgdir, opfdir, img_srcdir=None,
+                        img_budget=None, workers=None, persist=True):
     """
     Build list of image dicts for opf manifest.
-    """
-    img_ext2fmt = {'jpg': 'jpeg',
-                   'jpeg': 'jpeg',
-                   'png': 'png',
-                   'gif': 'gif',
-                   'svg': 'svg+xml'}
 
+    All files in `imgdir` and its subdirectories are included; the image
+    format is detected from the file header and files of unknown format are
+    skipped. Image metadata is cached in ``params._CACHE_DIR`` (keyed by
+    content hash; only read if `persist` is `False`) and each dict carries
+    'width', 'height' and 'bytes' in addition to the manifest entries.
+
+    If `img_srcdir` is specified, images are read from there and placed in
+    `imgdir` by the output writer, downscaled and/or recompressed where they
+    exceed `img_budget` (name of an entry in ``params._IMG_BUDGETS``), using
+    `workers` processes.
+
+    Returns a tuple `(images, files)`, where `files` maps the output paths
+    (relative to `epubdir`) of the images from `img_srcdir` to their content
+    (see `img.process`).
+    """
     logging.info('building image inventory...')
     img_dir = os.path.join(epubdir, imgdir)
     opf_dir = os.path.join(epubdir, os.path.dirname(opfdir))
     opf2img_path = os.path.relpath(img_dir, opf_dir)
+    cache_dir = os.path.join(epubdir, params._CACHE_DIR)
+    files = {}
+    if img_srcdir:
+        found = img.process(os.path.join(epubdir, img_srcdir), cache_dir,
+                            budget=img_budget, workers=workers,
+                            persist=persist)
+        files = {os.path.join(imgdir, rel_path): data
+                 for rel_path, _, data in found}
+    else:
+        if img_budget:
+            logging.warning('image budget "%s" ignored: optimization '
+                            'requires a separate image source directory',
+                            img_budget)
+        found = img.process(img_dir, cache_dir, persist=persist)
     images = []
-    for item in os.listdir(img_dir):
-        # ignore subdirectories in image directory (can add walk later)
-        if os.path.isdir(os.path.join(img_dir, item)):
-            continue
-        img = {}
-        img['href'] = os.path.join(opf2img_path, item)
-        img['id'] = '-'.join(item.split('.')[:-1]) + '-img'
-        img['format'] = img_ext2fmt[item.split('.')[-1].lower()]
-        images.append(img)
+    for rel_path, rec, _ in found:
+        image = {}
+        image['href'] = os.path.join(opf2img_path, rel_path)
+        image['id'] = '-'.join(os.path.splitext(rel_path)[0].split(os.sep))
+        image['id'] = re.sub(r'[^\w.-]', '_', image['id']) + '-img'
+        image['format'] = rec['format']
+        image.update({k: rec[k] for k in ('width', 'height', 'bytes')})
+        images.append(image)
+
+    return images, files
 
-    return images
+
+def index_pages(pages):
+    """
+    Flattens the (nested) `pages` list into a list of dicts in reading order,
+    computed once and passed to the templates as `page_index`. Each dict
+    holds:
+
+        pg: the page dict
+        id, href: page id and XHTML file name
+        order, play_order: 0-based position and 1-based NCX play order
+        depth: nesting level, starting with 1 for top level pages
+        parent: id of the parent page or `None` for top level pages
+        toc: `False` if the page or one of its parents has `no_toc` set
+        parts: list of dicts with 'id' and 'href' of the additional files
+            the page was split into (see `split_html`), filled in during
+            rendering
+    """
+    index = []
+
+    def walk(pages, depth, parent, toc):
+        for pg in pages:
+            visible = toc and not pg.get('no_toc')
+            index.append({'pg': pg, 'id': pg['id'],
+                          'href': pg['id'] + '.xhtml', 'order': len(index),
+                          'play_order': len(index) + 1, 'depth': depth,
+                          'parent': parent, 'toc': visible, 'parts': []})
+            if pg.get('children'):
+                walk(pg['children'], depth + 1, pg['id'], visible)
+
+    walk(pages, 1, None, True)
+
+    return index
+
+
+def nav_entries(page_index, max_depth=None, toc_only=False):
+    """
+    Jinja filter that selects the entries of `page_index` (see `index_pages`)
+    with a depth of at most `max_depth` (all if `max_depth` is not set) and,
+    if `toc_only` is `True`, only those visible in the TOC. Each selected
+    entry is returned with 'play_order' renumbered and an additional 'close'
+    item: the number of nesting levels to close after the entry (0 if the
+    next entry is its child), so that templates can emit nested structures
+    with a single flat loop.
+    """
+    sel = [e for e in page_index if (not max_depth or e['depth'] <= max_depth)
+           and (e['toc'] or not toc_only)]
+    out = []
+    for i, e in enumerate(sel):
+        next_depth = sel[i + 1]['depth'] if i + 1 < len(sel) else 1
+        out.append(dict(e, play_order=i + 1,
+                        close=max(e['depth'] - next_depth + 1, 0)))
+    return out
 
 
 def render_output(tmpl_env, tmpl_name, out_file=None, **kwargs):
@@ -136,26 +249,104 @@ def render_output(tmpl_env, tmpl_name, out_file=None, **kwargs):
 
 def cp_static(pg, epubdir, srcdir, htmldir, **kwargs):
     """
-    Copies static source file to htmldir, inserting url query params if
-    specified in `pg`.
+    Reads static source file for htmldir, inserting url query params if
+    specified in `pg`. The source is read once: memory-mapped and rewritten
+    in a single pass if there are query params, otherwise as is (as
+    `utils.FileData`, so that the 'dir' writer can copy or link the file).
+
+    Returns tuple `(path, data)` with the output path (relative to `epubdir`)
+    and the file content as bytes.
     """
     src_base = pg.get('src', pg['id'])
     source = os.path.join(epubdir, srcdir, src_base + '.xhtml')
-    target = os.path.join(epubdir, htmldir, pg['id'] + '.xhtml')
+    target = os.path.join(htmldir, pg['id'] + '.xhtml')
     logging.info('copying %s to %s...', source, target)
-    shutil.copy(source, target)
-    if 'query_url' in pg:
-        with open(target, 'r') as foi:
-            ht_text = utils.mk_query_urls(foi.read(),
-                    pg['query_url']['url_re'], pg['query_url']['utm'])
-        with open(target, 'w') as foo:
-            foo.write(ht_text)
+    if 'query_url' not in pg:
+        return target, utils.read_file(source)
+    with open(source, 'rb') as foi:
+        if os.fstat(foi.fileno()).st_size == 0:
+            return target, b''
+        with mmap.mmap(foi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = utils.mk_query_urls(mm, pg['query_url']['url_re'],
+                                       pg['query_url']['utm'])
+    return target, data
+
+
+# top level block elements in Markdown HTML output (see `html_blocks`)
+_BLOCK_TAG_RE = re.compile(
+        r'<(/?)(p|div|blockquote|ul|ol|dl|table|pre|h[1-6])\b[^>]*?(/?)>')
+# in-page section breaks as styled by `gen_chapter`
+_SEC_BREAK_RE = re.compile(r'<(?:p|hr) class="(?:{0}|asterism)"'.format(
+        params._IN_PG_SEC_BREAK_STYLE))
+
+
+def html_blocks(ht_text):
+    """
+    Splits HTML `ht_text` (as generated by Markdown) into a list of top level
+    blocks; blank lines are kept with the preceding block.
+    """
+    blocks = []
+    current = []
+    depth = 0
+    for line in ht_text.splitlines(keepends=True):
+        if depth == 0 and current and line.strip():
+            blocks.append(''.join(current))
+            current = []
+        current.append(line)
+        for m in _BLOCK_TAG_RE.finditer(line):
+            if not m.group(3):
+                depth += -1 if m.group(1) else 1
+        depth = max(depth, 0)
+    if current:
+        blocks.append(''.join(current))
+    return blocks
+
+
+def split_html(ht_text, max_bytes=None, at_breaks=False):
+    """
+    Splits chapter HTML `ht_text` into parts of at most `max_bytes` (UTF-8
+    encoded; a single block larger than that becomes a part of its own)
+    and, if `at_breaks` is `True`, after each in-page section break. Splits
+    only occur between top level blocks (see `html_blocks`).
+
+    Returns the list of parts (a single part if no split is required).
+    """
+    if not max_bytes and not at_breaks:
+        return [ht_text]
+    parts = []
+    current = []
+    size = 0
+    for block in html_blocks(ht_text):
+        block_size = len(block.encode('utf-8'))
+        if current and max_bytes and size + block_size > max_bytes:
+            parts.append(''.join(current))
+            current = []
+            size = 0
+        current.append(block)
+        size += block_size
+        if at_breaks and _SEC_BREAK_RE.search(block):
+            parts.append(''.join(current))
+            current = []
+            size = 0
+    if current and (''.join(current).strip() or not parts):
+        parts.append(''.join(current))
+    return parts
 
 
 def gen_chapter(pg, meta, tmpl_env, epubdir, srcdir, htmldir, dropcaps=False,
-                asterism=False, **kwargs):
+                asterism=False, fixit=False, split_size=None,
+                split_breaks=False, **kwargs):
     """
-    Generates HTML chapter file from md source.
+    Generates HTML chapter file from md source. If `fixit` is `True` hanging
+    italics in the source are fixed on the fly (see `ipitfix.fix_italics`).
+    Oversized chapters can be split into several files, see `split_html` for
+    `split_size` (in bytes) and `split_breaks`; the first part carries the
+    page's own file name, additional parts are named as per
+    ``params._SPLIT_PART_ID`` and rendered with the ``chapter_part``
+    template.
+
+    Returns list of tuples `(path, data)` with the output path (relative to
+    `epubdir`) and the rendered chapter (part) as bytes.
     """
     # lines with `break_re` in the raw HTML output will be styled as in-page
     # section breaks
@@ -164,12 +355,12 @@ def gen_chapter(pg, meta, tmpl_env, epubdir, srcdir, htmldir, dropcaps=False,
                 r'#\s*#\s*#', ]
 
     # TODO: run beg_raw and end_raw through markdown
-    outfile = os.path.join(epubdir, htmldir, pg['id'] +
-                           '.xhtml')
+    outfile = os.path.join(htmldir, pg['id'] + '.xhtml')
     logging.info('generating %s from %s with par style "%s"...', outfile,
             pg['mdfile'], pg['parstyle'])
     with open(pg['mdfile'], 'r') as foi:
-        ht_text = markdown.markdown(foi.read(), extensions=['meta', 'smarty'])
+        md_text = ''.join(ipitfix.fix_italics(foi)) if fixit else foi.read()
+    ht_text = markdown.markdown(md_text, extensions=['meta', 'smarty'])
     # styling for in-page section breaks:
     for br_pat in break_re:
         if asterism:
@@ -197,62 +388,120 @@ def gen_chapter(pg, meta, tmpl_env, epubdir, srcdir, htmldir, dropcaps=False,
     header_title = meta['title']
     if pg.get('heading'):
         header_title += ' | ' + pg['heading']
-    tmpl_name = pg.get('template', 'chapter')
-    ht_text = render_output(tmpl_env, tmpl_name, chapter_content=ht_text,
-                            header_title=header_title, pg_meta=pg)
-    if 'query_url' in pg:
-        ht_text = utils.mk_query_urls(ht_text, pg['query_url']['url_re'],
-                                      pg['query_url']['utm'])
-    with open(outfile, 'w') as foo:
-        foo.write(ht_text)
+    parts = split_html(ht_text, split_size, split_breaks)
+    out = []
+    for i, part in enumerate(parts, 1):
+        pg_meta = pg
+        if i < len(parts) and pg.get('end_raw'):
+            # closing raw content goes into the last part only
+            pg_meta = {k: v for k, v in pg.items() if k != 'end_raw'}
+        if i == 1:
+            path = outfile
+            tmpl_name = pg.get('template', 'chapter')
+        else:
+            path = os.path.join(htmldir, params._SPLIT_PART_ID.format(
+                    pg['id'], i) + '.xhtml')
+            tmpl_name = 'chapter_part'
+            logging.info('splitting off %s...', path)
+        part = render_output(tmpl_env, tmpl_name, chapter_content=part,
+                             header_title=header_title, pg_meta=pg_meta)
+        if 'query_url' in pg:
+            part = utils.mk_query_urls(part, pg['query_url']['url_re'],
+                                       pg['query_url']['utm'])
+        out.append((path, part.encode('utf-8')))
+    return out
+
+
+_FRAG_LINK_RE = re.compile(r'href="([^"#:]*)#([^"]+)"')
+_ID_RE = re.compile(r'\bid="([^"]+)"')
+
+
+def rewrite_split_links(files, htmldir, splits):
+    """
+    Rewrites fragment links in the XHTML files in `files` (dict that maps
+    paths to content) that point to elements which ended up in a split off
+    part of a chapter. `splits` maps the file name of each split chapter to
+    the list of paths of its parts (first part first).
+
+    Returns the number of files changed.
+    """
+    # maps (chapter file name, fragment) to name of the part holding it:
+    moved = {}
+    owner = {}
+    for href, paths in splits.items():
+        for path in paths[1:]:
+            part_href = os.path.basename(path)
+            owner[part_href] = href
+            for frag in _ID_RE.findall(files[path].decode('utf-8')):
+                moved[(href, frag)] = part_href
+    if not moved:
+        return 0
+    changed = 0
+    for path, data in files.items():
+        if (not path.endswith('.xhtml') or
+                os.path.dirname(path) != os.path.normpath(htmldir)):
+            continue
+        current = os.path.basename(path)
+
+        def repl(m):
+            target = m.group(1) or owner.get(current, current)
+            new = moved.get((target, m.group(2)))
+            if not new or (not m.group(1) and new == current):
+                return m.group(0)
+            return 'href="{0}#{1}"'.format(new, m.group(2))
+
+        text = data.decode('utf-8')
+        new_text = _FRAG_LINK_RE.sub(repl, text)
+        if new_text != text:
+            files[path] = new_text.encode('utf-8')
+            changed += 1
+    return changed
 
 
 def gen_from_tmpl(pg, pages, meta, tmpl_env, epubdir, srcdir, htmldir,
-                  yaml_incl_dir, **kwargs):
+                  yaml_incl_dir, page_index=None, frag_cache=None, **kwargs):
     """
     Generates HTML output from (page-) metadata
+
+    If `frag_cache` (a `fragments.FragmentCache`) is given, the page is taken
+    from the cache if it was rendered from the same templates and context
+    before (e.g. for another book).
+
+    Returns tuple `(path, data)` with the output path (relative to `epubdir`)
+    and the rendered page as bytes.
     """
     tmpl_name = pg.get('template')
     if not tmpl_name:
         tmpl_name = pg['id']
-    pg_data = meta.get(pg['id'])
-    if not pg_data:
-        # look for supplementary YAML file with page data,
-        # first in current dir, then in epubdir, then in yincl:
-        fname = '{0}.yaml'.format(pg['yaml'] if 'yaml' in pg else pg['id'])
-        try:
-            with open(fname, 'r') as foi:
-                pg_data = yaml.load(foi)
-        except FileNotFoundError as e:
-            logging.warning(e)
-        try:
-            with open(os.path.join(epubdir, fname), 'r') as foi:
-                pg_data = yaml.load(foi)
-        except FileNotFoundError as e:
-            logging.warning(e)
-        try:
-            with open(os.path.join(yaml_incl_dir, fname), 'r') as foi:
-                pg_data = yaml.load(foi)
-        except FileNotFoundError as e:
-            logging.warning(e)
-    ht_text = render_output(tmpl_env, tmpl_name, pg_meta=pg,
-            pg_data=pg_data, pages=pages, header_title=pg.get('heading'),
-            **meta)
+    # supplementary YAML file with page data is looked up in current dir,
+    # then in epubdir, then in yincl:
+    pg_data = utils.find_page_data(pg, meta, ['.', epubdir, yaml_incl_dir])
+    context = dict(meta, pg_meta=pg, pg_data=pg_data, pages=pages,
+                   page_index=page_index, header_title=pg.get('heading'))
+    if frag_cache is None:
+        ht_text = render_output(tmpl_env, tmpl_name, **context)
+    else:
+        ht_text = frag_cache.render(tmpl_env,
+                                    tmpl_name + params._TEMPLATE_EXT,
+                                    **context)
     if 'query_url' in pg:
         ht_text = utils.mk_query_urls(ht_text, pg['query_url']['url_re'],
                                       pg['query_url']['utm'])
-    outfile = os.path.join(epubdir, htmldir, pg['id'] + '.xhtml')
+    outfile = os.path.join(htmldir, pg['id'] + '.xhtml')
     logging.info('generating %s...', outfile)
-    with open(outfile, 'w') as foo:
-        foo.write(ht_text)
+    return outfile, ht_text.encode('utf-8')
 
 
-def augment_meta(meta_item, epubdir, srcdir):
+def augment_meta(meta_item, epubdir, srcdir, indexer=None, fixit=False):
     """
     Augment with metadata defined in individual source files for entries of
-    type 'chapter'.
+    type 'chapter'. Text statistics of the source (see `stats.text_stats`)
+    are added as 'stats'. The page record is augmented in place and
+    returned. If `indexer` (a `search.SearchIndex`) is given, the source is
+    added to it, with hanging italics fixed if `fixit` is `True` (as in the
+    rendered chapter, see `gen_chapter`).
     """
-    item = meta_item.copy()
+    item = meta_item
     if item['type'] != 'chapter':
         return item
     # Page level metadata items for which the chapter template expects single
@@ -267,38 +516,42 @@ def augment_meta(meta_item, epubdir, srcdir):
     src_path = os.path.abspath(src_path)
     md_base = item.get('src', item['id'])
     mdfile = os.path.join(src_path, md_base + '.md')
-    # Note: the following will change the item in `mainmatter` list
     item['mdfile'] = mdfile
     item['parstyle'] = item.get('parstyle', params._BASIC_CH_PAR_STYLE)
     with open(mdfile, 'r') as foi:
-        # we're only interested in metadata, throw away html:
-        md.convert(foi.read())
-    mdm = { key: value[0] if key in delist else value
-                     for key, value in md.Meta.items()}
-    item = utils.merge_dicts(mdm, item)
+        md_text = foi.read()
+    # we're only interested in metadata (which ends at the first blank line),
+    # throw away html:
+    md.convert(md_text.split('\n\n', 1)[0])
+    item['stats'] = stats.text_stats(md_text)
+    for key, value in md.Meta.items():
+        # values in the YAML take precedence over those in the source
+        if key not in item:
+            item[key] = value[0] if key in delist else value
+    if indexer is not None:
+        if fixit:
+            md_text = ''.join(ipitfix.fix_italics(md_text.splitlines(True)))
+        indexer.add(item['id'], item.get('heading'), md_text, item['stats'])
 
     return item
 
 
-def get_meta(epubdir, yaml_meta, srcdir):
+def get_meta(epubdir, yaml_meta, srcdir, indexer=None, fixit=False):
     """
-    Generates metayaml list augmenting ``yaml_meta`` with page metadata
-    contained in individual source files (*.md) for pages of type 'chapter'.
+    Augments the pages in ``yaml_meta`` (list of `schema.Page` trees) in
+    place with page metadata contained in individual source files (*.md) for
+    pages of type 'chapter' (see `augment_meta`, also for `indexer` and
+    `fixit`) and returns ``yaml_meta``.
 
     Will also add an 'mdfile' key for each mainmatter item that has the full
     absolute path to the corresponding Markdown source file. Similarly, the
     'parstyle' value will be defined for each item.
     """
+    for pg in yaml_meta:
+        for item in pg.walk():
+            augment_meta(item, epubdir, srcdir, indexer, fixit)
 
-    def genmeta(mm_list):
-        out = []
-        for item in mm_list:
-            if 'children' in item:
-                item['children'] = genmeta(item['children'])
-            out.append(augment_meta(item, epubdir, srcdir))
-        return out
-
-    return genmeta(yaml_meta)
+    return yaml_meta
 
 
 def md2ht(text, par_style=None, trim_tags=False):
@@ -322,57 +575,327 @@ def md2ht(text, par_style=None, trim_tags=False):
     return html
 
 
-def mkbook(epubdir, srcdir, htmldir, imgdir, metayaml, mmyaml, yaml_incl_dir,
-           dropcaps=False, asterism=False):
+def css_paths(meta, htmldir):
     """
-    Generates the files required for an EPUB ebook
+    Returns a tuple `(source, pruned)` with the paths (relative to the EPUB
+    root) of the book stylesheet (meta item `css_file`) and of the pruned
+    and/or minified stylesheet generated from it (see `gen_css`).
     """
-    epub_meta = {
-            # maps meta type to (template, output_path)
-            'opf': ('opf', os.path.join(htmldir, 'content.opf')),
-            'ncx': ('ncx', os.path.join(htmldir, 'toc.ncx')),
-    }
+    css_file = meta.get('css_file') or params._CSS_FILE
+    pruned = os.path.splitext(css_file)[0] + params._CSS_PRUNED_EXT
+    return os.path.join(htmldir, css_file), os.path.join(htmldir, pruned)
+
+
+def gen_css(files, meta, epubdir, htmldir, used=None):
+    """
+    Generates the minified book stylesheet, pruned to the selectors in
+    `used` (see `css.collect_selectors`; not pruned if `None`). Stylesheet
+    links in the XHTML files in `files` (dict that maps paths to content)
+    and the `css_file` item in `meta` are changed to point to the new
+    stylesheet.
+
+    Returns tuple `(path, data)` with the output path (relative to `epubdir`)
+    and the file content as bytes.
+    """
+    source, target = css_paths(meta, htmldir)
+    logging.info('generating %s from %s...', target, source)
+    with open(os.path.join(epubdir, source), 'r') as foi:
+        text, kept, total = css.prune(foi.read(), used)
+    data = (text + '\n').encode('utf-8')
+    logging.info('%d of %d CSS rules kept (%d bytes)', kept, total,
+                 len(data))
+    old_href = 'href="{}"'.format(os.path.relpath(source, htmldir)).encode()
+    new_href = 'href="{}"'.format(os.path.relpath(target, htmldir)).encode()
+    for path in files:
+        if path.endswith('.xhtml'):
+            files[path] = files[path].replace(old_href, new_href)
+    meta['css_file'] = os.path.relpath(target, htmldir)
+    return target, data
+
+
+# XHTML 1.1 doctype of the page templates, replaced by the HTML5 doctype in
+# EPUB 3 content documents
+_XHTML11_DOCTYPE_RE = re.compile(rb'<!DOCTYPE html PUBLIC[^>]*>')
+
+
+def render_target(target, content, tmpl_env, htmldir, tracked=None,
+                  **context):
+    """
+    Renders the metadata files for output target `target` (a key in
+    ``params._TARGETS``): OPF, NCX and, for EPUB 3, the navigation document
+    (from template ``nav_toc``). `content` is the dict that maps paths to
+    the rendered pages (shared by all targets), `context` holds the template
+    variables for the metadata templates (book metadata, `pages`,
+    `page_index`, `images`, `uuid`).
+
+    Retailer specific query parameters can be set as `utm` in the entry for
+    the target under `targets` in the book metadata; they are added to the
+    links in the pages in `tracked` (dict that maps paths to the `query_url`
+    item of their page), overriding the page's own parameters.
+
+    Returns a dict that maps output paths to file contents (metadata files
+    first, followed by `content`).
+    """
+    spec = params._TARGETS[target]
+    opts = (context.get('targets') or {}).get(target) or {}
+    context = dict(context, target=target, guide_cover=spec['guide_cover'],
+            epub_version=spec['version'], nav_href=spec['nav'],
+            modified='{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}Z'.format(
+                    *writers.zip_date_time()))
+    files = {}
+    for tmpl_file, out_file in ((spec['opf'], 'content.opf'),
+                                ('ncx', 'toc.ncx')):
+        out_file = os.path.join(htmldir, out_file)
+        logging.info('generating %s (%s)...', out_file, target)
+        files[out_file] = render_output(tmpl_env, tmpl_file,
+                                        **context).encode('utf-8')
+    if spec['nav']:
+        out_file = os.path.join(htmldir, spec['nav'])
+        logging.info('generating %s (%s)...', out_file, target)
+        nav = render_output(tmpl_env, 'nav_toc',
+                pg_meta={'id': os.path.splitext(spec['nav'])[0]},
+                **context).encode('utf-8')
+        files[out_file] = _XHTML11_DOCTYPE_RE.sub(b'<!DOCTYPE html>', nav,
+                                                  count=1)
+    utm = opts.get('utm')
+    for path, data in content.items():
+        if spec['version'] != '2.0' and path.endswith('.xhtml'):
+            data = _XHTML11_DOCTYPE_RE.sub(b'<!DOCTYPE html>', data, count=1)
+        if utm and tracked and path in tracked:
+            data = utils.mk_query_urls(data.decode('utf-8'),
+                    tracked[path]['url_re'], utm).encode('utf-8')
+        files[path] = data
+    return files
+
+
+def render_book(epubdir, srcdir, htmldir, imgdir, metayaml, mmyaml,
+                yaml_incl_dir, dropcaps=False, asterism=False, img_srcdir=None,
+                img_budget=None, workers=None, fixit=False, split_size=None,
+                split_breaks=False, stats_file=None, css_mode='full',
+                targets=None, fragment_cache=None, fragment_cache_size=None,
+                search_index=None, search_book=None, persist=True):
+    """
+    Renders the files required for an EPUB ebook into memory. Content is
+    rendered first, so that the metadata files can list chapters split by
+    `split_size` (in bytes) or `split_breaks` (see `gen_chapter`).
+
+    The pages are rendered once and shared by all output `targets` (list of
+    keys in ``params._TARGETS``, defaults to ``params._DEFAULT_TARGET``);
+    only the metadata files are rendered per target (see `render_target`).
+
+    If `fragment_cache` (a directory) is given, pages rendered from templates
+    are cached there (see `fragments.FragmentCache`, size capped at
+    `fragment_cache_size` bytes) and reused by later builds of this or other
+    books.
+
+    With `css_mode` 'minify' a minified copy of the book stylesheet is used
+    instead of the stylesheet itself, with 'prune' it is also stripped of
+    all rules for classes, ids and elements that do not occur in the
+    rendered pages (see `gen_css`); 'full' uses the stylesheet as is.
+
+    If `search_index` (an SQLite file) is given, the chapter sources are
+    added to this full-text search index as book `search_book` (required),
+    replacing the book's chapters indexed before (see `search.SearchIndex`).
+
+    Images from `img_srcdir` are part of the returned files (see
+    `build_img_inventory`); the image cache is only updated if `persist` is
+    `True`.
+
+    Book totals of the chapter statistics collected by `augment_meta` are
+    available to all templates as `book_stats` (see `stats.totals`). If
+    `stats_file` is given, the per page statistics (plus output size and
+    render time) are saved there as JSON (see `stats.save_index`).
+
+    Returns a dict that maps each target to a dict that maps output paths
+    (relative to `epubdir`) to the file contents as bytes.
+    """
+    if search_index and not search_book:
+        raise ValueError('search_index needs search_book')
+    targets = targets or [params._DEFAULT_TARGET]
 
     with open(os.path.join(epubdir, metayaml), 'r') as foi:
-        meta = yaml.load(foi)
-    fm = get_meta(epubdir, meta.get('frontmatter', []), srcdir)
-    bm = get_meta(epubdir, meta.get('backmatter', []), srcdir)
+        meta = yaml.safe_load(foi)
     with open(os.path.join(epubdir, mmyaml), 'r') as foi:
-        mainmatter = yaml.load(foi)
-    mm = get_meta(epubdir, mainmatter, srcdir)
+        mainmatter = yaml.safe_load(foi)
+    # report all metadata problems before rendering anything:
+    meta, mainmatter = schema.validate(meta, mainmatter, epubdir, srcdir)
+    indexer = None
+    if search_index:
+        indexer = search.SearchIndex(search_index, search_book)
+    fm = get_meta(epubdir, meta.get('frontmatter', []), srcdir, indexer,
+                  fixit)
+    bm = get_meta(epubdir, meta.get('backmatter', []), srcdir, indexer,
+                  fixit)
+    mm = get_meta(epubdir, mainmatter, srcdir, indexer, fixit)
+    if indexer is not None:
+        indexer.prune()
+        indexer.close()
     pages = (fm if fm else []) + mm + (bm if bm else [])
 
     tmplLoader = j2.FileSystemLoader(searchpath=params._TEMPLATE_PATH)
     tmplEnv = j2.Environment(loader=tmplLoader, trim_blocks=True,
             lstrip_blocks=True)
     tmplEnv.filters['markdown'] = md2ht
-
-    images = build_img_inventory(epubdir, imgdir, epub_meta['opf'][1])
-
-    # generate metadata files:
-    uuid = gen_uuid(meta.__str__() + dt.utcnow().__str__())
-    for tmpl_file, out_file in epub_meta.values():
-        render_output(tmplEnv, tmpl_file, pages=pages,
-                images=images, uuid=uuid,
-                out_file=os.path.join(epubdir, out_file), **meta)
-
-    # now content:
+    tmplEnv.filters['nav_entries'] = nav_entries
+    page_index = index_pages(pages)
+    tmplEnv.globals['book_stats'] = stats.totals(
+            e['pg']['stats'] for e in page_index if 'stats' in e['pg'])
+    logging.info('%(chapters)d chapters, %(words)d words, reading time '
+                 '%(reading_minutes)d minutes', tmplEnv.globals['book_stats'])
+
+    images, img_files = build_img_inventory(
+            epubdir, imgdir, os.path.join(htmldir, 'content.opf'),
+            img_srcdir, img_budget, workers, persist)
+
+    # content first:
     kwargs = {'meta': meta, 'epubdir': epubdir, 'srcdir': srcdir,
              'htmldir': htmldir, 'tmpl_env': tmplEnv,
              'yaml_incl_dir': yaml_incl_dir, 'dropcaps': dropcaps,
-             'asterism': asterism}
+             'asterism': asterism, 'fixit': fixit,
+             'page_index': page_index, 'split_size': split_size,
+             'split_breaks': split_breaks, 'frag_cache': None}
+    if fragment_cache:
+        kwargs['frag_cache'] = fragments.FragmentCache(fragment_cache,
+                                                       fragment_cache_size)
+    entries = {e['id']: e for e in page_index}
+    splits = {}
+
+    page_stats = {}
+    # maps paths of pages with tracked links to the pages' 'query_url' item:
+    tracked = {}
+    # selectors used in the rendered pages (for pruning the stylesheet):
+    used = css.new_selectors() if css_mode == 'prune' else None
 
     def gen_content(pages, **kwargs):
         for pg in pages:
+            start = time.perf_counter()
+            out = []
             if pg['type'] == 'chapter':
-                gen_chapter(pg, **kwargs)
+                out = gen_chapter(pg, **kwargs)
+                if len(out) > 1:
+                    splits[pg['id'] + '.xhtml'] = [p for p, _ in out]
+                    entries[pg['id']]['parts'] = [
+                            {'id': os.path.splitext(os.path.basename(p))[0],
+                             'href': os.path.basename(p)}
+                            for p, _ in out[1:]]
             elif pg['type'] == 'static':
-                cp_static(pg, **kwargs)
+                out = [cp_static(pg, **kwargs)]
             elif pg['type'] == 'template':
-                gen_from_tmpl(pg, pages, **kwargs)
+                out = [gen_from_tmpl(pg, pages, **kwargs)]
+            if out:
+                page_stats[pg['id']] = dict(pg.get('stats', {}),
+                        bytes=sum(len(data) for _, data in out),
+                        render_time=round(time.perf_counter() - start, 4))
+                if used is not None:
+                    for _, data in out:
+                        css.collect_selectors(data, used)
+                if 'query_url' in pg:
+                    tracked.update((p, pg['query_url']) for p, _ in out)
+            yield from out
             if 'children' in pg:
-                gen_content(pg['children'], **kwargs)
+                yield from gen_content(pg['children'], **kwargs)
+
+    content = dict(gen_content(pages, **kwargs))
+    if kwargs['frag_cache']:
+        logging.info('fragment cache: %d hits, %d misses, %d entries '
+                     'evicted', kwargs['frag_cache'].hits,
+                     kwargs['frag_cache'].misses,
+                     kwargs['frag_cache'].evict())
+    if stats_file:
+        logging.info('saving stats index %s...', stats_file)
+        stats.save_index(stats_file, page_stats)
+    if splits:
+        logging.info('%d chapters split, %d files with links rewritten',
+                     len(splits),
+                     rewrite_split_links(content, htmldir, splits))
+    if css_mode != 'full':
+        path, data = gen_css(content, meta, epubdir, htmldir, used)
+        content[path] = data
+    content.update(img_files)
+
+    # then metadata files:
+    uuid = book_uuid(meta)
+    return {t: render_target(t, content, tmplEnv, htmldir, tracked,
+                             pages=pages, page_index=page_index,
+                             images=images, uuid=uuid, **meta)
+            for t in targets}
+
+
+def target_file(epubfile, target):
+    """
+    Returns the name of the EPUB archive for output target `target`, derived
+    from `epubfile` (e.g. 'book-kindle.epub').
+    """
+    stem, ext = os.path.splitext(epubfile)
+    return '{}-{}{}'.format(stem, target, ext)
+
 
-    gen_content(pages, **kwargs)
+def write_target(job):
+    """
+    Hands the files of one output target to a writer (see `mkbook`); `job`
+    is a tuple `(target, writer, files, epubdir, epubfile, skip, link)`.
+
+    Returns the number of files written.
+    """
+    target, writer, files, epubdir, epubfile, skip, link = job
+    with events.stage('write', writer=writer, target=target):
+        count = writers._WRITERS[writer](files.items(), epubdir,
+                                         epubfile=epubfile, skip=skip,
+                                         link=link)
+    logging.info('%s writer (%s): %d files written (%d generated)', writer,
+                 target, count, len(files))
+    return count
 
-    return None
+
+def mkbook(epubdir, srcdir, htmldir, imgdir, metayaml, mmyaml, yaml_incl_dir,
+           dropcaps=False, asterism=False, img_srcdir=None, img_budget=None,
+           workers=None, writer='dir', epubfile='book.epub', fixit=False,
+           split_size=None, split_breaks=False, stats_file=None,
+           css_mode='full', targets=None, fragment_cache=None,
+           fragment_cache_size=None, static_link='copy', search_index=None,
+           search_book=None):
+    """
+    Generates the files required for an EPUB ebook
+
+    The files are rendered into memory (see `render_book`) and then handed to
+    the output writer `writer` (a key in ``writers._WRITERS``): 'dir' writes
+    changed files below `epubdir`, 'zip' packages the book as `epubfile`
+    (without the source stylesheet if `css_mode` is not 'full'), and 'none'
+    is a dry run (caches are not updated either). Static pages without query
+    params and images are placed by the 'dir' writer according to
+    `static_link` (see `utils.place_file`).
+
+    If output `targets` are given (see `render_book`), each target is
+    packaged as archive of its own (see `target_file`), using `workers`
+    processes; the 'dir' writer can only be used with a single target.
+
+    See `render_book` for `search_index` and `search_book`.
+
+    Returns a dict that maps the targets to the dicts with their rendered
+    files.
+    """
+    if targets and len(targets) > 1 and writer == 'dir':
+        raise ValueError('several targets need the zip or none writer')
+    with events.stage('render'):
+        books = render_book(epubdir, srcdir, htmldir, imgdir, metayaml,
+                            mmyaml, yaml_incl_dir, dropcaps, asterism,
+                            img_srcdir, img_budget, workers, fixit,
+                            split_size, split_breaks, stats_file, css_mode,
+                            targets, fragment_cache, fragment_cache_size,
+                            search_index, search_book,
+                            persist=writer != 'none')
+    skip = []
+    if css_mode != 'full':
+        meta = utils.load_yaml_cached(os.path.join(epubdir, metayaml))
+        skip.append(css_paths(meta, htmldir)[0])
+    jobs = [(t, writer, files, epubdir,
+             target_file(epubfile, t) if targets else epubfile, skip,
+             static_link)
+            for t, files in books.items()]
+    if workers == 1 or len(jobs) < 2:
+        list(map(write_target, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(write_target, jobs))
+
+    return books
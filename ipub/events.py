@@ -0,0 +1,178 @@
+"""
+Log output configuration (plain text or JSON lines, quiet mode) and the
+build event stream: stage start/end, files written or skipped, external
+process runs and warnings, written as JSON lines to a file or a Unix domain
+socket for consumption by CI dashboards.
+
+Events are dicts with at least 'time' (seconds since the epoch), 'event'
+and 'pid'. Emitting is a no-op unless a stream has been opened with
+`open_stream` (or `setup`).
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import logging
+import contextlib
+
+
+# prefix of event stream targets that name a Unix domain socket
+_UNIX_PREFIX = 'unix:'
+
+_stream = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as one JSON object per line.
+    """
+
+    def format(self, record):
+        out = {'time': round(record.created, 3),
+               'level': record.levelname.lower(),
+               'logger': record.name,
+               'message': record.getMessage()}
+        if record.exc_info:
+            out['exc'] = self.formatException(record.exc_info)
+        return json.dumps(out)
+
+
+class EventHandler(logging.Handler):
+    """
+    Forwards log records (by default warnings and errors) to the event stream
+    as 'warning' or 'error' events.
+    """
+
+    def __init__(self, level=logging.WARNING):
+        super().__init__(level)
+
+    def emit(self, record):
+        try:
+            emit(record.levelname.lower(), logger=record.name,
+                 message=record.getMessage())
+        except Exception:
+            self.handleError(record)
+
+
+class _SocketStream:
+    """
+    Minimal file-like wrapper for a connected Unix domain socket.
+    """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def write(self, text):
+        self.sock.sendall(text.encode('utf-8'))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.sock.close()
+
+
+def open_stream(target):
+    """
+    Opens the event stream: `target` is a file name (events are appended)
+    or 'unix:PATH' for a Unix domain socket. If the target cannot be opened
+    a warning is logged and events are discarded.
+    """
+    global _stream
+    close_stream()
+    try:
+        if target.startswith(_UNIX_PREFIX):
+            _stream = _SocketStream(target[len(_UNIX_PREFIX):])
+        else:
+            # line buffered, so that no events are pending (and duplicated)
+            # when worker processes are forked
+            _stream = open(target, 'a', buffering=1, encoding='utf-8')
+    except OSError as e:
+        logging.warning('cannot open event stream %s: %s', target, e)
+        _stream = None
+
+
+def close_stream():
+    """
+    Closes the event stream (if open).
+    """
+    global _stream
+    if _stream is not None:
+        try:
+            _stream.close()
+        except OSError:
+            pass
+        _stream = None
+
+
+atexit.register(close_stream)
+
+
+def enabled():
+    """
+    Returns `True` if an event stream is open.
+    """
+    return _stream is not None
+
+
+def emit(event, **fields):
+    """
+    Writes `event` (a name such as 'stage_end' or 'file_written') with
+    `fields` to the event stream. Events that cannot be written (e.g.
+    because the socket was closed by the reader) are dropped and the stream
+    is closed.
+    """
+    global _stream
+    if _stream is None:
+        return
+    rec = {'time': round(time.time(), 3), 'event': event, 'pid': os.getpid()}
+    rec.update(fields)
+    try:
+        _stream.write(json.dumps(rec, default=str) + '\n')
+    except OSError:
+        _stream = None
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Context manager that emits 'stage_start' and 'stage_end' events for
+    build stage `name`; 'stage_end' has the 'duration' in seconds and 'ok'
+    (`False` if the stage was left with an exception).
+    """
+    emit('stage_start', stage=name, **fields)
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    except SystemExit as e:
+        ok = not e.code
+        raise
+    finally:
+        emit('stage_end', stage=name, ok=ok,
+             duration=round(time.perf_counter() - start, 4), **fields)
+
+
+def setup(log_format='text', quiet=False, events=None):
+    """
+    Configures the root logger: messages go to stderr as plain text or, with
+    `log_format` 'json', as JSON lines (see `JsonFormatter`). With `quiet`
+    only warnings and errors are logged. If `events` is given, the event
+    stream is opened (see `open_stream`) and warnings are forwarded to it.
+    """
+    root = logging.getLogger()
+    handler = logging.StreamHandler(sys.stderr)
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root.addHandler(handler)
+    root.setLevel(logging.WARNING if quiet else logging.INFO)
+    if events:
+        open_stream(events)
+        root.addHandler(EventHandler())
@@ -0,0 +1,193 @@
+"""
+Persistent, content-addressed cache of rendered template output (front and
+backmatter pages rendered by `epub.gen_from_tmpl`), shared across books.
+
+Entries are keyed on the SHA-256 of the source of the template and all
+templates it extends, includes or imports, plus the values of the context
+variables these templates read (see `jinja2.meta`). A variable that is only
+read as the fallback of a ``default`` filter
+(``header_title|default(title)``) is left out of the key while the filtered
+variable is in the context. Entries are files in the cache directory; their
+mtime is refreshed on every hit, and the least recently used entries are
+evicted once the cache exceeds its size cap.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from collections.abc import Mapping, Set
+
+import jinja2.meta
+from jinja2 import nodes
+
+from . import params
+from . import utils
+
+
+def _json_default(obj):
+    """
+    JSON encoder fallback for context values (page records, sets).
+    """
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, Set):
+        return sorted(obj, key=repr)
+    return repr(obj)
+
+
+def _default_fallbacks(ast):
+    """
+    Returns a tuple `(fallbacks, others)`: a dict that maps the names of the
+    variables in template `ast` that are read as the fallback of a
+    ``default`` filter on another variable to a set of tuples `(primary,
+    boolean)`, and the set of names of the variables read elsewhere.
+    """
+    fallbacks = {}
+    fallback_nodes = set()
+    for f in ast.find_all(nodes.Filter):
+        if f.name != 'default' or not isinstance(f.node, nodes.Name) or \
+                not f.args or not isinstance(f.args[0], nodes.Name):
+            continue
+        boolean = f.args[1] if len(f.args) > 1 else next(
+                (kw.value for kw in f.kwargs if kw.key == 'boolean'), None)
+        boolean = boolean is not None and not (
+                isinstance(boolean, nodes.Const) and not boolean.value)
+        fallbacks.setdefault(f.args[0].name, set()).add((f.node.name,
+                                                         boolean))
+        fallback_nodes.add(id(f.args[0]))
+    others = {n.name for n in ast.find_all(nodes.Name)
+              if n.ctx == 'load' and id(n) not in fallback_nodes}
+    return fallbacks, others
+
+
+class FragmentCache:
+    """
+    Cache of rendered templates in directory `cache_dir`, limited to
+    `max_bytes` (``params._FRAGMENT_CACHE_SIZE`` if `None`).
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = (params._FRAGMENT_CACHE_SIZE if max_bytes is None
+                          else max_bytes)
+        self.hits = self.misses = 0
+        # maps template name to (source hash, variables read, fallbacks) or
+        # `None` for templates that cannot be cached (dynamic includes):
+        self._templates = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def template_info(self, env, name):
+        """
+        Returns a tuple `(digest, names, fallbacks)` with the SHA-256 of the
+        sources of template `name` and all templates it references, the set
+        of variable names they read and a dict that maps the names only read
+        as ``default`` fallbacks to their `(primary, boolean)` tuples (see
+        `_default_fallbacks`), or `None` if the referenced templates cannot
+        be determined statically.
+        """
+        if name in self._templates:
+            return self._templates[name]
+        digest = hashlib.sha256()
+        names = set()
+        fallbacks = {}
+        others = set()
+        seen = set()
+        todo = [name]
+        info = None
+        while todo:
+            tmpl_name = todo.pop()
+            if tmpl_name in seen:
+                continue
+            seen.add(tmpl_name)
+            source = env.loader.get_source(env, tmpl_name)[0]
+            digest.update(tmpl_name.encode('utf-8') + b'\0' +
+                          source.encode('utf-8') + b'\0')
+            ast = env.parse(source)
+            names |= jinja2.meta.find_undeclared_variables(ast)
+            tmpl_fallbacks, tmpl_others = _default_fallbacks(ast)
+            for var, primaries in tmpl_fallbacks.items():
+                fallbacks.setdefault(var, set()).update(primaries)
+            others |= tmpl_others
+            refs = list(jinja2.meta.find_referenced_templates(ast))
+            if None in refs:
+                break
+            todo.extend(refs)
+        else:
+            info = (digest.hexdigest(), frozenset(names),
+                    {var: frozenset(primaries)
+                     for var, primaries in fallbacks.items()
+                     if var in names and var not in others})
+        self._templates[name] = info
+        return info
+
+    def key(self, env, name, context):
+        """
+        Returns the cache key for rendering template `name` with `context`
+        (dict), or `None` if the template cannot be cached.
+        """
+        info = self.template_info(env, name)
+        if info is None:
+            return None
+        digest, names, fallbacks = info
+        values = {}
+        for var in sorted(names):
+            if var in fallbacks and all(
+                    p in context and (context[p] or not boolean)
+                    for p, boolean in fallbacks[var]):
+                # fallback not used
+                continue
+            if var in context:
+                values[var] = context[var]
+            elif var in env.globals and not callable(env.globals[var]):
+                values[var] = env.globals[var]
+        data = json.dumps(values, sort_keys=True, default=_json_default)
+        return hashlib.sha256(digest.encode('ascii') +
+                              data.encode('utf-8')).hexdigest()
+
+    def render(self, env, name, **context):
+        """
+        Returns template `name` rendered with `context`, from the cache if
+        possible (see `key`).
+        """
+        key = self.key(env, name, context)
+        if key is None:
+            return env.get_template(name).render(**context)
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path, 'rb') as foi:
+                text = foi.read().decode('utf-8')
+            os.utime(path)
+            self.hits += 1
+            logging.debug('fragment cache hit for %s (%s)', name, key)
+            return text
+        except FileNotFoundError:
+            pass
+        text = env.get_template(name).render(**context)
+        utils.write_if_changed(path, text)
+        self.misses += 1
+        return text
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache holds at most
+        `max_bytes`. Returns the number of entries deleted.
+        """
+        entries = []
+        total = 0
+        for e in os.scandir(self.cache_dir):
+            if e.is_file() and not e.name.startswith('.'):
+                st = e.stat()
+                entries.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+        deleted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            deleted += 1
+        return deleted
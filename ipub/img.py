@@ -0,0 +1,269 @@
+"""
+Image inspection and size optimization for the EPUB image inventory
+"""
+
+import os
+import io
+import re
+import struct
+import logging
+from hashlib import sha1
+from concurrent.futures import ProcessPoolExecutor
+
+from . import params
+from . import utils
+
+
+_CACHE_FILE = 'images.json'
+_OPT_DIR = 'img'
+# JPEG start-of-frame markers (these carry the image dimensions)
+_JPEG_SOF = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+_SVG_TAG_RE = re.compile(rb'<svg\b[^>]*>', re.DOTALL)
+_SVG_ATTR_RE = r'\b{}\s*=\s*["\']\s*([0-9.]+)\s*(?:px)?\s*["\']'
+
+
+def sniff_format(head):
+    """
+    Returns the image format ('jpeg', 'png', 'gif', or 'svg+xml', as used in
+    the OPF media type) detected from the leading bytes `head` of an image
+    file, or `None` if the format is not recognized.
+    """
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    text = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    if text.startswith(b'<') and b'<svg' in text[:4096]:
+        return 'svg+xml'
+    return None
+
+
+def dimensions(data, fmt):
+    """
+    Returns `(width, height)` of the image in `data` (bytes) of format `fmt`,
+    parsed from the image header. Either value is `None` if it cannot be
+    determined.
+    """
+    try:
+        if fmt == 'png':
+            return struct.unpack('>II', data[16:24])
+        if fmt == 'gif':
+            return struct.unpack('<HH', data[6:10])
+        if fmt == 'jpeg':
+            i = 2
+            while i + 9 < len(data):
+                if data[i] != 0xff:
+                    i += 1
+                    continue
+                marker = data[i + 1]
+                if marker in _JPEG_SOF:
+                    height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                    return width, height
+                if marker == 0xff or 0xd0 <= marker <= 0xd9 or marker == 0x01:
+                    # padding and markers without payload
+                    i += 1 if marker == 0xff else 2
+                    continue
+                i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+        if fmt == 'svg+xml':
+            tag = _SVG_TAG_RE.search(data)
+            if tag:
+                tag = tag.group(0).decode('utf-8', 'replace')
+                dims = [re.search(_SVG_ATTR_RE.format(a), tag)
+                        for a in ('width', 'height')]
+                if all(dims):
+                    return tuple(int(float(d.group(1))) for d in dims)
+                vbox = re.search(r'viewBox\s*=\s*["\']([^"\']*)["\']', tag)
+                if vbox:
+                    vals = vbox.group(1).replace(',', ' ').split()
+                    return int(float(vals[2])), int(float(vals[3]))
+    except (struct.error, IndexError, ValueError):
+        pass
+    return None, None
+
+
+def inspect(data):
+    """
+    Returns a dict with 'format', 'width', 'height', and 'bytes' for the image
+    in `data`. 'format' is `None` for unrecognized formats.
+    """
+    fmt = sniff_format(data[:4096])
+    width, height = dimensions(data, fmt) if fmt else (None, None)
+    return {'format': fmt, 'width': width, 'height': height,
+            'bytes': len(data)}
+
+
+def over_budget(rec, budget):
+    """
+    Returns `True` if image record `rec` (see `inspect`) exceeds `budget` (a
+    dict as in ``params._IMG_BUDGETS``). SVGs are never over budget.
+    """
+    if rec['format'] == 'svg+xml':
+        return False
+    pixels = (rec['width'] or 0) * (rec['height'] or 0)
+    return (pixels > budget.get('max_pixels', pixels) or
+            rec['bytes'] > budget.get('max_bytes', rec['bytes']))
+
+
+def optimize(data, fmt, budget):
+    """
+    Downscales and/or recompresses the image in `data` so that it fits
+    `budget` as far as possible. Requires Pillow. Returns the optimized image
+    as bytes, or `data` unchanged if optimization did not make it smaller.
+    """
+    from PIL import Image
+
+    im = Image.open(io.BytesIO(data))
+    if getattr(im, 'is_animated', False):
+        return data
+    width, height = im.size
+    max_pixels = budget.get('max_pixels')
+    if max_pixels and width * height > max_pixels:
+        scale = (max_pixels / (width * height)) ** 0.5
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        im = im.resize(size, Image.LANCZOS)
+    quality = budget.get('quality', 85)
+    max_bytes = budget.get('max_bytes')
+    while True:
+        out = io.BytesIO()
+        if fmt == 'jpeg':
+            if im.mode not in ('RGB', 'L'):
+                im = im.convert('RGB')
+            im.save(out, 'JPEG', quality=quality, optimize=True)
+        elif fmt == 'png':
+            im.save(out, 'PNG', optimize=True)
+        else:
+            im.save(out, 'GIF', optimize=True)
+        opt = out.getvalue()
+        # only JPEG quality can be traded for size:
+        if fmt != 'jpeg' or not max_bytes or len(opt) <= max_bytes or \
+                quality <= 40:
+            break
+        quality -= 10
+    if len(opt) >= len(data) and im.size == (width, height):
+        return data
+    return opt
+
+
+def _optimize_file(args):
+    src, fmt, budget, target = args
+    with open(src, 'rb') as foi:
+        data = foi.read()
+    opt = optimize(data, fmt, budget)
+    if target is not None:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # atomic, so that an interrupted run leaves no truncated cache entry
+        utils.write_if_changed(target, opt)
+    return opt
+
+
+def scan(img_dir):
+    """
+    Yields paths (relative to `img_dir`) of all non-hidden files in `img_dir`
+    and its subdirectories, in sorted order.
+    """
+    for dirpath, dirnames, filenames in os.walk(img_dir):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for fname in sorted(filenames):
+            if fname.startswith('.'):
+                continue
+            yield os.path.relpath(os.path.join(dirpath, fname), img_dir)
+
+
+def prune_optimized(opt_dir, digests):
+    """
+    Deletes the optimized images in `opt_dir` that do not belong to an image
+    with one of the SHA-1 `digests`. Returns the number of files deleted.
+    """
+    try:
+        entries = list(os.scandir(opt_dir))
+    except FileNotFoundError:
+        return 0
+    deleted = 0
+    for e in entries:
+        if e.is_file() and not e.name.startswith('.') and \
+                e.name.split('-', 1)[0] not in digests:
+            os.remove(e.path)
+            deleted += 1
+    if deleted:
+        logging.info('removed %d stale optimized images from %s', deleted,
+                     opt_dir)
+    return deleted
+
+
+def process(img_dir, cache_dir, budget=None, workers=None, persist=True):
+    """
+    Inspects all images in `img_dir` (recursively) and returns a list of
+    `(rel_path, record, data)` tuples (see `inspect`) for images of a
+    supported format; other files are skipped with a warning. `data` is the
+    image to ship, as `utils.FileData` (or bytes): images that exceed
+    `budget` (name of a ``params._IMG_BUDGETS`` entry) are replaced by
+    optimized versions, which are computed in a pool of `workers` processes.
+
+    Image records and optimized images are cached in `cache_dir` (records
+    keyed by the SHA-1 of the image content, optimized images named after
+    it); entries for images no longer in `img_dir` are dropped when the
+    cache is saved. If `persist` is `False` the cache is only read.
+    """
+    cache_file = os.path.join(cache_dir, _CACHE_FILE)
+    cache = utils.load_json(cache_file, {})
+    budget_spec = params._IMG_BUDGETS[budget] if budget else None
+
+    images = []
+    seen = set()
+    # maps optimized image paths in the cache to the optimization job:
+    jobs = {}
+    for rel_path in scan(img_dir):
+        src = os.path.join(img_dir, rel_path)
+        data = utils.read_file(src)
+        digest = sha1(data).hexdigest()
+        seen.add(digest)
+        rec = cache.get(digest)
+        if rec is None:
+            rec = cache[digest] = inspect(data)
+        if rec['format'] is None:
+            logging.warning('skipping %s: unknown image format', src)
+            continue
+        if budget_spec and over_budget(rec, budget_spec):
+            opt_name = '{}-{}{}'.format(digest, budget,
+                                        os.path.splitext(rel_path)[1])
+            opt_src = os.path.join(cache_dir, _OPT_DIR, opt_name)
+            if os.path.exists(opt_src):
+                data = utils.read_file(opt_src)
+            elif opt_src not in jobs:
+                jobs[opt_src] = (digest, src, rec['format'])
+            images.append([rel_path, rec, data, opt_src])
+        else:
+            images.append([rel_path, rec, data, None])
+
+    if jobs:
+        try:
+            import PIL
+        except ImportError:
+            logging.error('Pillow is required for image optimization; '
+                          'images will be copied as is')
+            jobs = {}
+    if jobs:
+        logging.info('optimizing %d images for budget "%s" with %s '
+                     'workers...', len(jobs), budget, workers or 'default')
+        args = [(src, fmt, budget_spec, opt_src if persist else None)
+                for opt_src, (_, src, fmt) in jobs.items()]
+        optimized = {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for (opt_src, (digest, src, _)), opt in zip(
+                    jobs.items(), pool.map(_optimize_file, args)):
+                logging.info('optimized %s: %d -> %d bytes', src,
+                             cache[digest]['bytes'], len(opt))
+                optimized[opt_src] = (utils.FileData(opt, opt_src) if persist
+                                      else opt)
+        for entry in images:
+            if entry[3] in optimized:
+                entry[2] = optimized[entry[3]]
+
+    if persist:
+        utils.save_json(cache_file, {d: rec for d, rec in cache.items()
+                                     if d in seen})
+        prune_optimized(os.path.join(cache_dir, _OPT_DIR), seen)
+
+    return [(rel_path, rec, data) for rel_path, rec, data, _ in images]
@@ -6,32 +6,42 @@ If a paragraph contains an uneven number of '*' (not counting '\*') an '*' will
 be appended at the end and an '*' will be stripped from the start of the next
 non-empty line. Also corrects italics formatting strtching over multiple
 paragraphs.
+
+Can be used as a script (filtering files given as arguments or STDIN to
+STDOUT) or as a library via `fix_italics` (streaming filter over lines) and
+`fix_files` (in-place fixing of Markdown files).
 """
 
-import re
+import os
+import sys
+import filecmp
+import tempfile
 import fileinput
+from concurrent.futures import ProcessPoolExecutor
 
-def ast_count(line):
-    return len(re.findall(r'\*', line))
-
-def esc_ast_count(line):
-    return len(re.findall(r'\\\*', line))
 
 def it_ast_count(line):
-    return ast_count(line) - esc_ast_count(line)
+    r"""
+    Returns the number of '*' in `line` that are not escaped as '\*'.
+    """
+    return line.count('*') - line.count('\\*')
 
 def open_italics(line):
     return (it_ast_count(line) % 2) != 0
 
-with fileinput.input() as input_:
-    orphan = False
-    for line in input_:
+def fix_italics(lines):
+    """
+    Generator that takes an iterable of lines and yields the lines with
+    hanging italics fixed. Output lines are right-stripped and terminated
+    with a newline; lines merged during a fix are yielded as one string. If
+    the input ends while italics are still open they will be closed.
+    """
+    lines = iter(lines)
+    for line in lines:
         if open_italics(line):
             line = '{0}*\n'.format(line.rstrip())
-            orphan = True
-            while orphan:
-                nl = next(input_)
-                if re.match(r'^\s*$', nl):
+            for nl in lines:
+                if not nl.strip():
                     line += nl
                     continue
                 if open_italics(nl):
@@ -39,8 +49,49 @@ with fileinput.input() as input_:
                         line += nl.replace('*', '', 1)
                     else:
                         line += '*{0}'.format(nl)
-                    orphan = False
-                else:
-                    line += '*{0}*\n'.format(nl.rstrip())
-        print(line.rstrip())
+                    break
+                line += '*{0}*\n'.format(nl.rstrip())
+        yield line.rstrip() + '\n'
+
+def fix_file(path):
+    """
+    Fixes hanging italics in file `path` in place, streaming through a
+    temporary file. The file is only replaced if its content changed.
+
+    Returns `True` if the file was changed.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.', suffix='.tmp')
+    try:
+        with open(path, 'r') as foi, os.fdopen(fd, 'w') as foo:
+            foo.writelines(fix_italics(foi))
+        if filecmp.cmp(tmp_path, path, shallow=False):
+            os.unlink(tmp_path)
+            return False
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return True
+
+def fix_files(paths, workers=None):
+    """
+    Runs `fix_file` on all files in `paths` using a pool of `workers`
+    processes (defaults to number of CPUs; 1 processes files sequentially).
+
+    Returns the list of paths of files that were changed.
+    """
+    paths = list(paths)
+    if workers == 1 or len(paths) < 2:
+        changed = map(fix_file, paths)
+        return [p for p, c in zip(paths, changed) if c]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        changed = list(pool.map(fix_file, paths))
+    return [p for p, c in zip(paths, changed) if c]
+
 
+if __name__ == '__main__':
+    with fileinput.input() as input_:
+        sys.stdout.writelines(fix_italics(input_))
@@ -5,11 +5,18 @@ Functions for generating LaTeX output from mainmatter Markdown source files.
 import sys
 import re
 import os.path
+import posixpath
+import time
 import logging
+from concurrent.futures import ProcessPoolExecutor
 import yaml
 import jinja2 as j2
 
 from . import params
+from . import utils
+from . import stats
+from . import schema
+from . import events
 
 
 def fleuronize(s, symbol=r'\\infty', rpt=3, math=True):
@@ -36,11 +43,13 @@ def fleuronize(s, symbol=r'\\infty', rpt=3, math=True):
     return s
 
 
-def mm_gen(mm, src_dir, hoffs):
+def mm_gen(mm, src_dir, hoffs, page_stats=None):
     """
     Generator that yields the chapters in mm (mainmatter list of dicts) with
     headings at correct level (top level will be equal to `hoffs` + 1).
-    Source markdown files are assumed to reside in `src_dir`.
+    Source markdown files are assumed to reside in `src_dir`. If
+    `page_stats` is a dict, the text statistics of each chapter source (see
+    `stats.text_stats`) are stored in it, keyed by chapter id.
     """
     level = hoffs + 1
     for m in mm:
@@ -49,39 +58,96 @@ def mm_gen(mm, src_dir, hoffs):
         if not m['type'] == 'chapter':
             continue
         with open(os.path.join(src_dir, m['id'] + '.md'), 'r') as foi:
-            s += foi.read()
+            text = foi.read()
+        if page_stats is not None:
+            page_stats[m['id']] = stats.text_stats(text)
+        s += text
         yield s
         if 'children' in m:
-            yield from mm_gen(m['children'], src_dir, level)
+            yield from mm_gen(m['children'], src_dir, level, page_stats)
 
 
-def mmcat(mmyaml, outfile, mddir, hoffset=0, lbreak=False):
+def chapter_ids(mm):
     """
+    Returns the ids of the top level chapters in `mm` (mainmatter list of
+    dicts), i.e. the chapters written to separate files by `mmcat` with a
+    `chapterdir`.
+    """
+    return [m['id'] for m in mm if m['type'] == 'chapter']
+
+
+def mm_chapters(mm, src_dir, hoffs, lbreak=False, page_stats=None):
+    """
+    Generator that yields a tuple `(id, text)` for each top level chapter in
+    `mm` (see `chapter_ids`), with `text` the Markdown of the chapter and
+    all its children, headings at the levels computed by `mm_gen`. If
+    `lbreak` is `True` section breaks are replaced by fleurons. See `mm_gen`
+    for `page_stats`.
+    """
+    for m in mm:
+        if m['type'] != 'chapter':
+            continue
+        text = ''
+        for s in mm_gen([m], src_dir, hoffs, page_stats):
+            if lbreak:
+                s = fleuronize(s)
+            text += '{}\n\n'.format(s)
+        yield m['id'], text
+
+
+def mmcat(mmyaml, outfile, mddir, hoffset=0, lbreak=False, chapterdir=None,
+          stats_file=None):
+    r"""
     Concatenates all mainmatter markdown sources with headings at correct level
     inserted.
+
+    If `chapterdir` is given, each top level chapter (with its children) is
+    written to a file ``<id>.md`` of its own in `chapterdir` instead (see
+    `mm_chapters`), for a main LaTeX file that ``\include``s the chapters
+    (see `mkbook`). Files whose content did not change are not touched.
+
+    If `stats_file` is given, a JSON stats index of the chapters is saved
+    there (see `stats.save_index`).
     """
     with open(mmyaml, 'r') as foi:
-        mainmatter = yaml.load(foi)
+        mainmatter = yaml.safe_load(foi)
+    page_stats = {} if stats_file else None
 
-    foo = outfile if outfile else sys.stdout
-    for m in mm_gen(mainmatter, mddir, hoffset):
-        if lbreak:
-            m = fleuronize(m)
-        foo.write('{}\n\n'.format(m))
+    if chapterdir:
+        os.makedirs(chapterdir, exist_ok=True)
+        written = unchanged = 0
+        for ch_id, text in mm_chapters(mainmatter, mddir, hoffset, lbreak,
+                                       page_stats):
+            path = os.path.join(chapterdir, ch_id + '.md')
+            if utils.write_if_changed(path, text):
+                logging.info('wrote %s', path)
+                written += 1
+            else:
+                logging.info('%s unchanged', path)
+                unchanged += 1
+        logging.info('%d chapter files written, %d unchanged', written,
+                     unchanged)
+    else:
+        foo = outfile if outfile else sys.stdout
+        for m in mm_gen(mainmatter, mddir, hoffset, page_stats):
+            if lbreak:
+                m = fleuronize(m)
+            foo.write('{}\n\n'.format(m))
 
-    foo.close()
+        foo.close()
 
+    if stats_file:
+        logging.info('saving stats index %s...', stats_file)
+        stats.save_index(stats_file, page_stats)
 
-def mkbook(metayaml, book, tmpl, yincl):
+
+def tex_env():
     """
-    Generates LaTeX for a print book, given meta YAML, mainmatter md and a
-    template.
+    Returns the jinja Environment for LaTeX templates (with delimiters that
+    do not clash with LaTeX syntax).
     """
-    with open(metayaml, 'r') as foi:
-        meta = yaml.load(foi)
-
     tmplLoader = j2.FileSystemLoader(searchpath=params._TEMPLATE_PATH)
-    tmplEnv = j2.Environment(
+    return j2.Environment(
             loader=tmplLoader,
             trim_blocks=True,
             block_start_string='<%',
@@ -91,46 +157,100 @@ def mkbook(metayaml, book, tmpl, yincl):
             comment_start_string='<#',
             comment_end_string='#>')
 
-    # generate main document file:
+
+# per process template environment for `render_page`
+_TEX_ENV = None
+
+
+def render_page(job):
+    """
+    Renders one LaTeX output file; `job` is a tuple `(outfile, tmpl_name,
+    context)`.
+
+    Returns tuple `(outfile, text, seconds)`.
+    """
+    global _TEX_ENV
+    outfile, tmpl_name, context = job
+    if _TEX_ENV is None:
+        _TEX_ENV = tex_env()
+    start = time.perf_counter()
+    tmpl = _TEX_ENV.get_template(tmpl_name + params._TEMPLATE_EXT)
+    text = tmpl.render(context)
+    return outfile, text, time.perf_counter() - start
+
+
+def mkbook(metayaml, book, tmpl, yincl, workers=None, mmyaml=None,
+           chapterdir=None):
+    r"""
+    Generates LaTeX for a print book, given meta YAML, mainmatter md and a
+    template.
+
+    If `mmyaml` and `chapterdir` are given, the main document
+    ``\include``s one file per top level chapter (as written by `mmcat`
+    with a `chapterdir` and converted to LaTeX) rather than the single
+    mainmatter file, so that ``\includeonly`` and latexmk can recompile
+    changed chapters only. The template gets the list of chapter files
+    (without extension) as `chapters`.
+
+    The main document and the dynamic front and backmatter pages are
+    rendered in a pool of `workers` processes (defaults to number of CPUs; 1
+    renders sequentially). Output files are only written if their content
+    changed, so that their mtimes stay stable for latexmk. Render times per
+    file are logged and recorded in ``latex_timing.json`` in the cache
+    directory (``params._CACHE_DIR``).
+    """
+    with open(metayaml, 'r') as foi:
+        meta = yaml.safe_load(foi)
+    # report all metadata problems before rendering anything:
+    meta, _ = schema.validate(meta)
+
+    # main document file:
     logging.info('generating main file %s from template %s...',
             book + '.tex', tmpl + params._TEMPLATE_EXT)
-    tmpl = tmplEnv.get_template(tmpl + params._TEMPLATE_EXT)
-    with open(book + '.tex', 'w') as foo:
-        foo.write(tmpl.render(meta))
+    context = meta
+    if mmyaml and chapterdir:
+        with open(mmyaml, 'r') as foi:
+            mainmatter = yaml.safe_load(foi)
+        context = dict(meta, chapters=[
+                posixpath.join(chapterdir, ch_id)
+                for ch_id in chapter_ids(mainmatter)])
+    jobs = [(book + '.tex', tmpl, context)]
 
-    # generate any dynamic front or backmatter files:
+    # any dynamic front or backmatter files:
     fm = meta.get('frontmatter', [])
     bm = meta.get('backmatter', [])
     pages = (fm if fm else []) + (bm if bm else [])
     pages = [p for p in pages if p['type'] == 'template']
     for pg in pages:
-        logging.info('generating page for "%s" from template %s...',
-                pg['heading'], pg['template'] + params._TEMPLATE_EXT)
         tmpl_name = pg.get('template')
         if not tmpl_name:
             tmpl_name = pg['id']
-        pg_data = meta.get(pg['id'])
-        # TODO: encapsulate finding the right page_data yaml so it can be used
-        # for epub as well as for print
-        if not pg_data:
-            # look for supplementary YAML file with page data,
-            # first in current dir, then in yincl:
-            fname = '{0}.yaml'.format(pg['yaml'] if 'yaml' in pg else pg['id'])
-            try:
-                with open(fname, 'r') as foi:
-                    pg_data = yaml.load(foi)
-            except FileNotFoundError as e:
-                logging.warning(e)
-            try:
-                with open(os.path.join(yincl, fname), 'r') as foi:
-                    pg_data = yaml.load(foi)
-            except FileNotFoundError as e:
-                logging.warning(e)
-
-        tmpl = tmplEnv.get_template(tmpl_name + params._TEMPLATE_EXT)
-        outfile = os.path.join(pg['id'] + '.tex')
-        logging.info('generating %s...', outfile)
-        with open(outfile, 'w') as foo:
-            foo.write(tmpl.render(meta, pg_meta=pg, pg_data=pg_data))
+        logging.info('generating page for "%s" from template %s...',
+                pg.get('heading', pg['id']), tmpl_name + params._TEMPLATE_EXT)
+        # supplementary YAML file with page data is looked up in current
+        # dir, then in yincl:
+        pg_data = utils.find_page_data(pg, meta, ['.', yincl])
+        jobs.append((pg['id'] + '.tex', tmpl_name,
+                     dict(meta, pg_meta=pg, pg_data=pg_data)))
+
+    with events.stage('render', files=len(jobs)):
+        if workers == 1 or len(jobs) < 2:
+            results = list(map(render_page, jobs))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(render_page, jobs))
 
+    written = unchanged = 0
+    timing = {}
+    for outfile, text, seconds in results:
+        timing[outfile] = round(seconds, 4)
+        if utils.write_if_changed(outfile, text):
+            logging.info('wrote %s (rendered in %.3fs)', outfile, seconds)
+            written += 1
+        else:
+            logging.info('%s unchanged (rendered in %.3fs)', outfile, seconds)
+            unchanged += 1
 
+    utils.save_json(os.path.join(params._CACHE_DIR, 'latex_timing.json'),
+                    timing)
+    logging.info('%d files written, %d unchanged', written, unchanged)
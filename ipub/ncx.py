@@ -0,0 +1,365 @@
+"""
+Import of existing EPUBs: mainmatter YAML and Markdown chapter sources from
+an NCX navigation map
+"""
+
+import os
+import re
+import sys
+import posixpath
+import logging
+import zipfile
+import xml.etree.ElementTree as ET
+from html.parser import HTMLParser
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from . import utils
+
+
+_CONTAINER = 'META-INF/container.xml'
+
+
+def _local(tag):
+    """
+    Returns `tag` without namespace URI.
+    """
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_navpoints(source):
+    """
+    Generator that parses the NCX in `source` (file name or binary file
+    object) incrementally and yields a tuple `(depth, id, label, src)` for
+    each navPoint in document order (`depth` starts with 1 for top level
+    navPoints).
+    """
+    stack = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        tag = _local(elem.tag)
+        if event == 'start':
+            if tag == 'navPoint':
+                stack.append({'id': elem.get('id'), 'label': None,
+                              'src': None})
+            continue
+        if not stack:
+            if tag == 'navMap':
+                elem.clear()
+            continue
+        top = stack[-1]
+        if tag == 'text' and top['label'] is None:
+            top['label'] = (elem.text or '').strip()
+        elif tag == 'content' and top['src'] is None:
+            top['src'] = elem.get('src')
+            # label and content precede nested navPoints, so the record is
+            # complete at this point:
+            yield len(stack), top['id'], top['label'], top['src']
+        elif tag == 'navPoint':
+            stack.pop()
+            elem.clear()
+
+
+def nest_navpoints(navpoints, chtype='chapter', headings=False, hoffset=0):
+    """
+    Converts a flat sequence of `(depth, id, label, src)` tuples (see
+    `iter_navpoints`) to a list of dicts, preserving hierarchy via
+    'children'. See `epub.navMap2dict` for `chtype`, `headings` and
+    `hoffset`.
+    """
+    records = []
+    parents = [records]
+    count = hoffset
+    for depth, np_id, label, src in navpoints:
+        count += 1
+        rec = {}
+        if headings and count > 0:
+            rec['heading'] = ('Chapter ' +
+                    utils.num2eng(count).title().replace(' ', '-'))
+        else:
+            rec['heading'] = label
+        rec['id'] = np_id
+        rec['type'] = chtype
+        rec['src'] = src
+        del parents[depth:]
+        siblings = parents[-1]
+        siblings.append(rec)
+        rec['children'] = []
+        parents.append(rec['children'])
+
+    def prune(recs):
+        for rec in recs:
+            if rec['children']:
+                prune(rec['children'])
+            else:
+                del rec['children']
+
+    prune(records)
+
+    return records
+
+
+class Html2Md(HTMLParser):
+    """
+    Minimal XHTML to Markdown converter for chapter bodies: keeps paragraphs,
+    headings, italics/bold, block quotes, lists, line breaks, images and
+    external links; drops all other formatting. `<hr>` becomes '* * *' (an
+    in-page section break for `genep`). Headings whose text is in
+    `skip_headings` are dropped (the heading is kept in the YAML instead).
+    Output is split into chunks at elements whose id is in `split_ids`.
+    """
+
+    _BLOCK = {'p', 'div', 'li', 'blockquote', 'section', 'h1', 'h2', 'h3',
+              'h4', 'h5', 'h6', 'ul', 'ol', 'table', 'tr'}
+    _SKIP = {'head', 'script', 'style', 'title'}
+
+    def __init__(self, skip_headings=(), split_ids=()):
+        super().__init__(convert_charrefs=True)
+        self.skip_headings = {h.strip().lower() for h in skip_headings if h}
+        self.split_ids = set(split_ids)
+        self.chunks = {None: []}
+        self.current = None
+        self.blocks = []
+        self.text = []
+        self.skip = 0
+        self.quote = 0
+        self.heading = None
+        self.href = None
+
+    def _flush(self):
+        text = re.sub(r'[ \t\r\n]+', ' ', ''.join(self.text)).strip()
+        text = text.replace('\x00', '  \n')
+        self.text = []
+        if not text:
+            return
+        if self.heading:
+            if text.lower() in self.skip_headings:
+                return
+            text = '#' * self.heading + ' ' + text
+        elif self.blocks and self.blocks[-1] == 'li':
+            text = '- ' + text
+        if self.quote:
+            text = '\n'.join('> ' + l for l in text.split('\n'))
+        self.chunks[self.current].append(text)
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if attrs.get('id') in self.split_ids:
+            self._flush()
+            self.current = attrs['id']
+            self.chunks.setdefault(self.current, [])
+        if tag in self._SKIP:
+            self.skip += 1
+        elif tag in self._BLOCK:
+            self._flush()
+            self.blocks.append(tag)
+            if tag == 'blockquote':
+                self.quote += 1
+            elif re.match(r'h[1-6]$', tag):
+                self.heading = int(tag[1])
+        elif tag in ('em', 'i'):
+            self.text.append('*')
+        elif tag in ('strong', 'b'):
+            self.text.append('**')
+        elif tag == 'br':
+            self.text.append('\x00')
+        elif tag == 'hr':
+            self._flush()
+            self.chunks[self.current].append('* * *')
+        elif tag == 'img':
+            self.text.append('![{}]({})'.format(attrs.get('alt', ''),
+                                                attrs.get('src', '')))
+        elif tag == 'a' and re.match(r'(?:https?|mailto):',
+                                     attrs.get('href', '')):
+            self.href = attrs['href']
+            self.text.append('[')
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self._BLOCK:
+            self._flush()
+            if self.blocks:
+                self.blocks.pop()
+            if tag == 'blockquote':
+                self.quote = max(self.quote - 1, 0)
+            elif re.match(r'h[1-6]$', tag):
+                self.heading = None
+        elif tag in ('em', 'i'):
+            self.text.append('*')
+        elif tag in ('strong', 'b'):
+            self.text.append('**')
+        elif tag == 'a' and self.href:
+            self.text.append(']({})'.format(self.href))
+            self.href = None
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag in self._BLOCK or tag in self._SKIP:
+            self.handle_endtag(tag)
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.text.append(re.sub(r'([\\*_`])', r'\\\1', data))
+
+    def markdown(self):
+        """
+        Returns dict that maps split ids (`None` for the content before the
+        first split element) to Markdown text.
+        """
+        self._flush()
+        return {k: '\n\n'.join(v) + '\n' for k, v in self.chunks.items()}
+
+
+def html2md(html, skip_headings=(), split_ids=()):
+    """
+    Converts XHTML string `html` to Markdown, see `Html2Md`.
+    """
+    parser = Html2Md(skip_headings, split_ids)
+    parser.feed(html)
+    parser.close()
+    return parser.markdown()
+
+
+class _DirSource:
+    """
+    Read access to EPUB files in a directory (paths relative to `root`).
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def open(self, path):
+        return open(os.path.join(self.root, path), 'rb')
+
+    def close(self):
+        pass
+
+
+def _find_ncx(zf):
+    """
+    Returns the path of the NCX file in EPUB zip `zf`, looked up via
+    container and OPF, falling back to the first *.ncx entry.
+    """
+    try:
+        container = ET.parse(zf.open(_CONTAINER))
+        rootfile = next(e for e in container.iter()
+                        if _local(e.tag) == 'rootfile')
+        opf_path = rootfile.get('full-path')
+        opf = ET.parse(zf.open(opf_path))
+        for item in opf.iter():
+            if (_local(item.tag) == 'item' and
+                    item.get('media-type') == 'application/x-dtbncx+xml'):
+                return posixpath.normpath(posixpath.join(
+                    posixpath.dirname(opf_path), item.get('href')))
+    except (KeyError, StopIteration, ET.ParseError) as e:
+        logging.warning('cannot locate NCX via OPF: %s', e)
+    for name in zf.namelist():
+        if name.lower().endswith('.ncx'):
+            return name
+    raise FileNotFoundError('no NCX file found in {}'.format(zf.filename))
+
+
+def import_ncx(source, mddir, chtype='chapter', headings=False, hoffset=0):
+    """
+    Reads the NCX of `source` (a toc.ncx file or an EPUB archive, which is
+    read without unpacking) and writes the content of each navPoint as
+    Markdown file `<id>.md` to `mddir`. navPoints that point into the same
+    XHTML file are split at their fragment ids.
+
+    Returns the mainmatter list of dicts (as written by `scrivx2yaml`).
+    """
+    if zipfile.is_zipfile(source):
+        src = zipfile.ZipFile(source)
+        ncx_path = _find_ncx(src)
+    else:
+        src = _DirSource(os.path.dirname(source))
+        ncx_path = os.path.basename(source)
+    try:
+        with src.open(ncx_path) as foi:
+            navpoints = list(iter_navpoints(foi))
+        ids = set()
+        unique = []
+        for depth, np_id, label, np_src in navpoints:
+            np_id = re.sub(r'[^\w-]', '_', np_id or 'np')
+            while np_id in ids:
+                np_id += '_'
+            ids.add(np_id)
+            unique.append((depth, np_id, label, np_src))
+        navpoints = unique
+
+        # group navPoints by target XHTML file:
+        by_file = {}
+        for depth, np_id, label, np_src in navpoints:
+            href, _, frag = (np_src or '').partition('#')
+            path = posixpath.normpath(posixpath.join(
+                posixpath.dirname(ncx_path), href))
+            by_file.setdefault(path, []).append((np_id, label, frag))
+
+        os.makedirs(mddir, exist_ok=True)
+        for path, nps in by_file.items():
+            try:
+                with src.open(path) as foi:
+                    html = foi.read().decode('utf-8')
+            except (KeyError, FileNotFoundError):
+                logging.warning('%s: %s not found', source, path)
+                continue
+            frags = [f for _, _, f in nps if f]
+            chunks = html2md(html, [l for _, l, _ in nps], frags)
+            for i, (np_id, label, frag) in enumerate(nps):
+                text = chunks.get(frag or None, '')
+                if i == 0 and frag:
+                    # content before the first fragment belongs to the
+                    # first navPoint
+                    text = chunks.get(None, '') + text
+                outfile = os.path.join(mddir, np_id + '.md')
+                logging.info('writing %s...', outfile)
+                utils.write_if_changed(outfile, text.lstrip('\n'))
+    finally:
+        src.close()
+
+    mm = nest_navpoints(navpoints, chtype, headings, hoffset)
+
+    def drop_src(recs):
+        for rec in recs:
+            rec.pop('src', None)
+            drop_src(rec.get('children', []))
+
+    drop_src(mm)
+
+    return mm
+
+
+def _import_epub(args):
+    epub_file, mddir, chtype, headings, hoffset = args
+    mm = import_ncx(epub_file, mddir, chtype, headings, hoffset)
+    with open(os.path.join(mddir, 'mainmatter.yaml'), 'w') as foo:
+        yaml.dump(mm, stream=foo, default_flow_style=False)
+    return epub_file, len(mm)
+
+
+def to_yaml(source, mddir, output=None, chtype='chapter', headings=False,
+            hoffset=0, workers=None):
+    """
+    Converts the NCX of `source` into mainmatter YAML (written to `output` or
+    STDOUT) and Markdown chapter files in `mddir`. If `source` is a
+    directory, each EPUB in it is imported into its own subdirectory of
+    `mddir` (named after the EPUB, with a ``mainmatter.yaml`` each) using a
+    pool of `workers` processes.
+    """
+    if not os.path.isdir(source):
+        mm = import_ncx(source, mddir, chtype, headings, hoffset)
+        foo = output if output else sys.stdout
+        yaml.dump(mm, stream=foo, default_flow_style=False)
+        if output:
+            output.close()
+        return
+
+    jobs = [(os.path.join(source, f),
+             os.path.join(mddir, os.path.splitext(f)[0]), chtype, headings,
+             hoffset)
+            for f in sorted(os.listdir(source)) if f.endswith('.epub')]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for epub_file, count in pool.map(_import_epub, jobs):
+            logging.info('imported %s: %d top level entries', epub_file,
+                         count)
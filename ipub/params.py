@@ -4,8 +4,71 @@ _PATH_PREFIX =  os.path.dirname(os.path.realpath(__file__))
 _TEMPLATE_PATH =  os.path.join(_PATH_PREFIX, 'tmpl')
 _TEMPLATE_EXT =  '.jinja'
 _EPUB_SKELETON_PATH =  os.path.join(_PATH_PREFIX, 'epub')
+# paths (relative to the EPUB skeleton) of assets that are never modified
+# in a book project and can therefore be linked rather than copied by `init`
+_EPUB_SKELETON_SHARED = ('META-INF/container.xml', 'OPS/css', 'OPS/img')
 _BASIC_CH_PAR_STYLE = 'par-indent'
 _FIRST_CH_PAR_STYLE = 'texttop'
 _DROP_CAP_STYLE = 'dropcap'
 _CLEAR_STYLE = 'clearit'
 _IN_PG_SEC_BREAK_STYLE = 'center-par-tb-space'
+# directory (relative to EPUB root) for build caches
+_CACHE_DIR = '.ipub_cache'
+# per-retailer image budgets used by `genep --img_budget`: `max_pixels` is the
+# maximum width * height, `max_bytes` the maximum file size, `quality` the
+# JPEG quality used when recompressing
+_IMG_BUDGETS = {
+    'kindle':   {'max_pixels': 2560 * 1600, 'max_bytes': 5 * 2**20,
+                 'quality': 85},
+    'apple':    {'max_pixels': 4000000, 'max_bytes': 10 * 2**20,
+                 'quality': 90},
+    'kobo':     {'max_pixels': 3200 * 2000, 'max_bytes': 5 * 2**20,
+                 'quality': 85},
+    'compact':  {'max_pixels': 1600 * 1000, 'max_bytes': 300 * 2**10,
+                 'quality': 75},
+}
+# metadata items from which the book UUID is derived unless `uuid` is pinned
+# in the metadata YAML
+_UUID_KEYS = ('title', 'subtitle', 'author', 'authorlist', 'publisher',
+              'language', 'isbn')
+# timestamp for entries in generated EPUB archives (reproducible builds); the
+# SOURCE_DATE_EPOCH environment variable takes precedence if set
+_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# file/manifest id of the n-th (n >= 2) part of a chapter split by
+# `genep --split_size` or `--split_breaks`
+_SPLIT_PART_ID = '{0}-part{1}'
+# directory with the binder items' content (relative to the project
+# directory) by Scrivener version: '<ID>.rtf' files (2) or '<UUID>/' with
+# 'content.rtf' (3)
+_SCRIV_RTF_DIR = {2: 'Files/Docs', 3: 'Files/Data'}
+# file (in the Markdown directory) in which `scriv2md` keeps the content
+# fingerprints of the RTF sources it converted
+_SCRIV_FINGERPRINTS = '.scriv2md.json'
+# page keys set by `scrivx2yaml` that Scrivener synopsis metadata must not set
+_SYNOPSIS_RESERVED = ('id', 'type', 'rtf_src', 'children', 'scrivID',
+                      'scrivType', 'scrivTitle', 'scrivLabel', 'scrivStatus',
+                      'scrivKeywords', 'mdfile', 'stats')
+# default book stylesheet (relative to the EPUB content directory, see the
+# `css_file` meta item) and extension of the stylesheet written by
+# `genep --css minify` or `--css prune` in its place
+_CSS_FILE = 'css/stylesheet.css'
+_CSS_PRUNED_EXT = '.min.css'
+# output targets of `genep --targets`: EPUB version, OPF template, whether
+# the guide lists the cover page (KDP wants it removed), file name of the
+# EPUB 3 navigation document (`None` for none); `_DEFAULT_TARGET` is used
+# if no targets are given
+_TARGETS = {
+    'epub2':  {'version': '2.0', 'opf': 'opf', 'guide_cover': True,
+               'nav': None},
+    'epub3':  {'version': '3.0', 'opf': 'opf3', 'guide_cover': True,
+               'nav': 'nav.xhtml'},
+    'kindle': {'version': '2.0', 'opf': 'opf', 'guide_cover': False,
+               'nav': None},
+}
+_DEFAULT_TARGET = 'epub2'
+# default size cap (in bytes) of the rendered fragment cache (see
+# `genep --fragment_cache`)
+_FRAGMENT_CACHE_SIZE = 64 * 2**20
+# reading speed (words per minute) for the reading time estimate in the stats
+# index and the `book_stats` template variable
+_READING_WPM = 250
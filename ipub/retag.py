@@ -0,0 +1,186 @@
+"""
+Rewrites the link query parameters (see `utils.mk_query_urls`) in existing
+EPUB archives, without rebuilding the books.
+
+Only XHTML entries in which a link actually changes are decompressed,
+rewritten and recompressed; all other entries (including ``mimetype``, which
+stays first and stored) are copied as raw compressed data, in their original
+order.
+"""
+
+import os
+import copy
+import shutil
+import struct
+import logging
+import zipfile
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from . import utils
+from . import events
+
+
+_XHTML_EXT = ('.xhtml', '.html', '.htm')
+
+# local file header: signature, versions, flags, method, time, date, CRC,
+# sizes, name length, extra field length
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_DATA_DESCRIPTOR_SIG = b'PK\x07\x08'
+
+
+def find_epubs(paths):
+    """
+    Returns the sorted list of EPUB archives in `paths` (files or
+    directories, which are searched recursively) as tuples `(path, rel)`,
+    where `rel` is the path of the archive relative to the directory in
+    `paths` it was found in (the file name for files).
+    """
+    found = set()
+    for path in paths:
+        if not os.path.isdir(path):
+            found.add((path, os.path.basename(path)))
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            found.update((os.path.join(dirpath, f),
+                          os.path.relpath(os.path.join(dirpath, f), path))
+                         for f in filenames if f.lower().endswith('.epub'))
+    return sorted(found)
+
+
+def copy_raw(src, zinfo, zout):
+    """
+    Appends entry `zinfo` of the archive open as file object `src` to
+    `zout` (ZipFile opened for writing) without decompressing it: local
+    header, compressed data and data descriptor are copied as they are.
+    """
+    src.seek(zinfo.header_offset)
+    header = src.read(_LOCAL_HEADER.size)
+    fields = _LOCAL_HEADER.unpack(header)
+    if fields[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile('bad local header for {}'.format(
+                zinfo.filename))
+    size = fields[-2] + fields[-1] + zinfo.compress_size
+    if zinfo.flag_bits & 0x08:
+        src.seek(zinfo.header_offset + _LOCAL_HEADER.size + size)
+        sig = src.read(4)
+        size += 4 if sig == _DATA_DESCRIPTOR_SIG else 0
+        size += 20 if zinfo.file_size > zipfile.ZIP64_LIMIT or \
+                zinfo.compress_size > zipfile.ZIP64_LIMIT else 12
+        src.seek(zinfo.header_offset + _LOCAL_HEADER.size)
+    out = zout.fp
+    out.seek(zout.start_dir)
+    new = copy.copy(zinfo)
+    new.header_offset = out.tell()
+    out.write(header)
+    remaining = size
+    while remaining:
+        chunk = src.read(min(remaining, 2**20))
+        if not chunk:
+            raise zipfile.BadZipFile('truncated entry {}'.format(
+                    zinfo.filename))
+        out.write(chunk)
+        remaining -= len(chunk)
+    zout.filelist.append(new)
+    zout.NameToInfo[new.filename] = new
+    zout.start_dir = out.tell()
+
+
+def _rewritten_info(zinfo):
+    """
+    Returns a fresh ZipInfo for rewriting entry `zinfo` with the same name,
+    timestamp, compression and attributes.
+    """
+    new = zipfile.ZipInfo(zinfo.filename, date_time=zinfo.date_time)
+    new.compress_type = zinfo.compress_type
+    new.create_system = zinfo.create_system
+    new.external_attr = zinfo.external_attr
+    new.comment = zinfo.comment
+    return new
+
+
+def retag_epub(job):
+    """
+    Rewrites the links matching `url_re` in the XHTML entries of EPUB
+    archive `path`, where `job` is a tuple `(path, url_re, qmap, outfile)`
+    (see `utils.mk_query_urls`). The result goes to `outfile` (`None` to
+    replace `path`); an archive in which no link changes is not rewritten in
+    place.
+
+    Returns a tuple `(path, changed)` with the number of entries rewritten.
+    """
+    path, url_re, qmap, outfile = job
+    target = outfile or path
+    changed = 0
+    with zipfile.ZipFile(path) as zin:
+        rewritten = {}
+        for zinfo in zin.infolist():
+            if not zinfo.filename.lower().endswith(_XHTML_EXT):
+                continue
+            data = zin.read(zinfo)
+            new = utils.mk_query_urls(data, url_re, qmap)
+            if new != data:
+                rewritten[zinfo.filename] = new
+        changed = len(rewritten)
+        if not changed and outfile is None:
+            logging.debug('no links to rewrite in %s', path)
+            return path, 0
+        logging.info('retagging %s...', target)
+        fd, tmp = tempfile.mkstemp(prefix='.retag-', suffix='.epub',
+                                   dir=os.path.dirname(os.path.abspath(
+                                       target)))
+        try:
+            with os.fdopen(fd, 'wb') as foo, \
+                    zipfile.ZipFile(foo, 'w') as zout:
+                for zinfo in zin.infolist():
+                    if zinfo.filename in rewritten:
+                        zout.writestr(_rewritten_info(zinfo),
+                                      rewritten[zinfo.filename])
+                    else:
+                        copy_raw(zin.fp, zinfo, zout)
+            shutil.copymode(path, tmp)
+            os.replace(tmp, target)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    events.emit('file_written', path=target, bytes=os.path.getsize(target))
+    return path, changed
+
+
+def retag(paths, url_re, qmap, outdir=None, workers=None):
+    """
+    Rewrites the link query parameters in all EPUB archives in `paths` (see
+    `find_epubs` and `retag_epub`), in place or to directory `outdir`, using
+    `workers` processes (number of CPUs if `None`). In `outdir` the archives
+    keep their paths relative to the directory in `paths` they were found
+    in.
+
+    Returns the number of archives in which links changed. Raises
+    `ValueError` if two archives would be written to the same file in
+    `outdir`.
+    """
+    epubs = find_epubs(paths)
+    jobs = []
+    if outdir:
+        targets = {}
+        for p, rel in epubs:
+            target = os.path.normpath(os.path.join(outdir, rel))
+            if target in targets and not os.path.samefile(targets[target], p):
+                raise ValueError('{} and {} would both be written to '
+                                 '{}'.format(targets[target], p, target))
+            targets[target] = p
+        for target, p in sorted(targets.items(), key=lambda t: t[1]):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            jobs.append((p, url_re, qmap, target))
+    else:
+        jobs = [(p, url_re, qmap, None)
+                for p in sorted({os.path.realpath(p): p
+                                 for p, _ in epubs}.values())]
+    if workers == 1 or len(jobs) < 2:
+        results = list(map(retag_epub, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(retag_epub, jobs))
+    retagged = sum(1 for _, changed in results if changed)
+    logging.info('rewrote links in %d of %d archives', retagged, len(results))
+    return retagged
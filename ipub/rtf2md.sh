@@ -4,6 +4,8 @@
 #
 #   usage:  rtf2md <RTF input file> <Markdown output file>
 #
+#   Markdown output file '-' writes to stdout.
+#
 
 set -e
 
@@ -16,16 +18,22 @@ then
 	exit 1
 fi
 
+OUTFILE=$2
+if [ "$OUTFILE" = "-" ]
+then
+	OUTFILE=/dev/stdout
+fi
+
 TMPDIR=$(mktemp -d .${SCRIPTFILE%.*}.XXXXXXXX)
 
-libreoffice --convert-to html --outdir $TMPDIR $1 2> /dev/null
+libreoffice --convert-to html --outdir $TMPDIR $1 >&2 2> /dev/null
 INFILE=$(basename $1)
 
 sed -e 's:</\?span[^>]*>::g' \
     -e 's:</\?font[^>]*>::g' \
     -e 's:<p [^>]*>:<p>:g' < $TMPDIR/${INFILE%.*}.html | \
     pandoc --normalize --smart --wrap=none -f html -t markdown | \
-    sed '/^\\[ ]*$/d' > $2
+    sed '/^\\[ ]*$/d' > $OUTFILE
 
 rm $TMPDIR/${INFILE%.*}.html
 rmdir $TMPDIR
@@ -0,0 +1,386 @@
+"""
+Up-front validation and normalization of book metadata (meta YAML and
+mainmatter YAML) into typed page records, so that all problems are reported
+at once before anything is rendered.
+"""
+
+import os
+import difflib
+import logging
+import functools
+from collections.abc import Mapping, MutableMapping
+
+import yaml
+
+from . import params
+
+
+class SchemaError(Exception):
+    """
+    Raised if the metadata has errors; `problems` holds the list of
+    `(severity, location, message)` tuples found.
+    """
+
+    def __init__(self, problems):
+        self.problems = problems
+        errors = [p for p in problems if p[0] == 'error']
+        super().__init__('{} errors in book metadata:\n{}'.format(
+                len(errors), '\n'.join('{}: {}'.format(loc, msg)
+                                       for _, loc, msg in errors)))
+
+
+# page types and the keys that have a meaning for the page generators
+_PAGE_TYPES = ('chapter', 'static', 'template')
+# keys used by the shipped templates (only used to detect misspelled keys)
+_TEMPLATE_KEYS = ('hdgalign', 'subalign', 'beg_raw', 'end_raw', 'introlines',
+                  'introstyle', 'fleuronimg', 'max_depth', 'url', 'urltext',
+                  'title', 'subtitle', 'subplain', 'img', 'img_class',
+                  'beg_img', 'end_img', 'series', 'author', 'nodisclaimer',
+                  'centerheadings', 'parting', 'pars', 'links', 'sp_title',
+                  'sp_img', 'sp_review', 'sp_review_src', 'suffix')
+# top level keys of meta YAML used by genep/genlatex and the shipped templates
+_META_KEYS = ('title', 'subtitle', 'subplain', 'author', 'authorlist',
+              'authorweb', 'authoremail', 'series', 'publisher', 'pubdate',
+              'uuid', 'editor', 'coverart', 'translator', 'description',
+              'keywords', 'language', 'rights', 'isbn', 'isbn10', 'start_id',
+              'css_file', 'frontmatter', 'backmatter', 'mainmatter',
+              'toc_depth', 'ncx_map_depth', 'titlegraphic', 'copyright',
+              'targets')
+
+
+class Page(MutableMapping):
+    """
+    Page record and node of the page tree: the keys used by the page
+    generators (and by `scrivx2yaml`) are stored in slots and can be read as
+    attributes (as in templates), all other keys in `extra`. Supports the
+    dict interface, so page records can be used wherever page dicts were
+    used before.
+
+    'children' is stored as a tuple of `Page` records, each of which refers
+    back to its parent (`parent`); `depth` (1 for top level pages) is
+    computed on first access. See `from_dict`/`to_dict` and
+    `load_pages`/`dump_pages` for (de)serialization.
+    """
+
+    # keys stored in slots, in the order in which they are iterated:
+    _KEYS = ('id', 'type', 'heading', 'subheading', 'template', 'yaml',
+             'src', 'srcdir', 'children', 'no_toc', 'query_url', 'parstyle',
+             'mdfile', 'stats', 'rtf_src', 'scrivType', 'scrivTitle',
+             'scrivID', 'scrivLabel', 'scrivStatus', 'scrivKeywords')
+
+    __slots__ = tuple(k for k in _KEYS if k != 'children') + (
+            '_children', '_parent', '_depth', 'extra')
+
+    def __init__(self, data=(), **kwargs):
+        self.extra = {}
+        self._parent = None
+        if hasattr(data, 'items'):
+            data = data.items()
+        for key, value in data:
+            self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    @property
+    def children(self):
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = tuple(value)
+        for child in self._children:
+            if isinstance(child, Page):
+                child._parent = self
+                try:
+                    del child._depth
+                except AttributeError:
+                    pass
+
+    @children.deleter
+    def children(self):
+        del self._children
+
+    @property
+    def parent(self):
+        """
+        Parent page or `None` for top level pages.
+        """
+        return self._parent
+
+    @property
+    def depth(self):
+        """
+        Nesting level, starting with 1 for top level pages.
+        """
+        try:
+            return self._depth
+        except AttributeError:
+            self._depth = 1 if self._parent is None else \
+                    self._parent.depth + 1
+            return self._depth
+
+    def __getitem__(self, key):
+        if key in _PAGE_KEYS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _PAGE_KEYS:
+            setattr(self, key, value)
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _PAGE_KEYS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        else:
+            del self.extra[key]
+
+    def __contains__(self, key):
+        if key in _PAGE_KEYS:
+            return hasattr(self, key)
+        return key in self.extra
+
+    def get(self, key, default=None):
+        if key in _PAGE_KEYS:
+            return getattr(self, key, default)
+        return self.extra.get(key, default)
+
+    def __iter__(self):
+        for key in self._KEYS:
+            if hasattr(self, key):
+                yield key
+        yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'Page({!r})'.format(self.to_dict())
+
+    def copy(self):
+        """
+        Returns a copy of the page and its descendants (values other than
+        'children' are shared).
+        """
+        return Page.from_dict(self)
+
+    def walk(self):
+        """
+        Generator that yields this page and all its descendants in reading
+        order.
+        """
+        yield self
+        for child in self.get('children', ()):
+            yield from child.walk()
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Returns a `Page` tree for the (nested) page dict `data`.
+        """
+        pg = cls()
+        children = None
+        for key, value in data.items():
+            if key == 'children':
+                children = value
+            else:
+                pg[key] = value
+        if children:
+            pg.children = [cls.from_dict(c) for c in children]
+        return pg
+
+    def to_dict(self):
+        """
+        Returns the page tree as nested plain dicts and lists (e.g. for
+        serialization).
+        """
+        out = dict(self)
+        if 'children' in out:
+            out['children'] = [c.to_dict() for c in out['children']]
+        return out
+
+
+_PAGE_KEYS = frozenset(Page._KEYS)
+
+
+def load_pages(stream):
+    """
+    Reads a list of pages from YAML `stream` (as written by `scrivx2yaml`)
+    and returns it as list of `Page` trees (not validated, see `validate`).
+    """
+    return [Page.from_dict(d) for d in yaml.safe_load(stream) or []]
+
+
+def dump_pages(pages, stream=None):
+    """
+    Writes the list of `Page` trees `pages` as YAML to `stream` (returns the
+    YAML string if `stream` is `None`).
+    """
+    return yaml.dump([pg.to_dict() for pg in pages], stream=stream,
+                     default_flow_style=False)
+
+
+@functools.lru_cache()
+def compiled_schema():
+    """
+    Returns the schema in the form used by `validate` (computed once per
+    process): a dict with the sets of 'known_page_keys', 'known_meta_keys'
+    and 'templates' (names of the templates in ``params._TEMPLATE_PATH``
+    without extension).
+    """
+    templates = {os.path.splitext(f)[0]
+                 for f in os.listdir(params._TEMPLATE_PATH)
+                 if f.endswith(params._TEMPLATE_EXT)}
+    return {'known_page_keys': _PAGE_KEYS | set(_TEMPLATE_KEYS),
+            'known_meta_keys': frozenset(_META_KEYS),
+            'templates': frozenset(templates)}
+
+
+def _misspelled(key, known):
+    """
+    Returns the closest match for `key` in `known` if `key` looks like a
+    misspelling of it, otherwise `None`.
+    """
+    if key in known:
+        return None
+    match = difflib.get_close_matches(key, known, n=1, cutoff=0.8)
+    return match[0] if match else None
+
+
+def validate_pages(pages, location, ids, problems, epubdir=None,
+                   srcdir=None):
+    """
+    Validates the (nested) list of page dicts `pages` and returns it as list
+    of `Page` records with normalized values: ids and headings as strings,
+    type in lower case, empty children removed, `no_toc` as bool. Problems
+    are appended to `problems`; `ids` is the set of page ids seen so far.
+    If `epubdir` and `srcdir` are given, the existence of chapter and static
+    source files is checked as well.
+    """
+    schema = compiled_schema()
+    out = []
+    if pages is None:
+        return out
+    if not isinstance(pages, (list, tuple)):
+        problems.append(('error', location, 'must be a list of pages'))
+        return out
+
+    for i, data in enumerate(pages):
+        loc = '{}[{}]'.format(location, i)
+        if not isinstance(data, Mapping):
+            problems.append(('error', loc, 'page must be a mapping'))
+            continue
+        pg = Page((k, v) for k, v in data.items() if k != 'children')
+        if pg.get('id') in (None, ''):
+            problems.append(('error', loc, "missing 'id'"))
+        elif isinstance(pg['id'], (dict, list)):
+            problems.append(('error', loc, "'id' must be a string"))
+        else:
+            pg.id = str(pg.id)
+            loc = '{} ({})'.format(loc, pg.id)
+            if pg.id in ids:
+                problems.append(('error', loc, 'duplicate page id'))
+            ids.add(pg.id)
+        if 'type' not in pg:
+            problems.append(('error', loc, "missing 'type'"))
+        else:
+            pg.type = str(pg.type).strip().lower()
+            if pg.type not in _PAGE_TYPES:
+                problems.append(('error', loc, "unknown type {!r} (must be "
+                                 "one of {})".format(pg['type'],
+                                                     ', '.join(_PAGE_TYPES))))
+        for key in ('heading', 'subheading'):
+            if key in pg and pg[key] is not None and \
+                    not isinstance(pg[key], str):
+                if isinstance(pg[key], (dict, list)):
+                    problems.append(('error', loc,
+                                     '{!r} must be a string'.format(key)))
+                else:
+                    pg[key] = str(pg[key])
+        if 'no_toc' in pg:
+            pg.no_toc = bool(pg.no_toc)
+        if 'query_url' in pg and (not isinstance(pg.query_url, dict) or
+                                  not {'url_re', 'utm'} <= set(pg.query_url)):
+            problems.append(('error', loc, "'query_url' needs 'url_re' and "
+                             "'utm'"))
+        for key in pg.extra:
+            match = _misspelled(key, schema['known_page_keys'])
+            if match:
+                problems.append(('warning', loc, 'unknown key {!r} (did you '
+                                 'mean {!r}?)'.format(key, match)))
+
+        pg_id = str(pg.get('id'))
+        if pg.get('type') == 'template' or 'template' in pg:
+            tmpl_name = pg.get('template') or pg_id
+            if tmpl_name not in schema['templates']:
+                problems.append(('error', loc, 'template {!r} not found in '
+                                 '{}'.format(tmpl_name,
+                                             params._TEMPLATE_PATH)))
+        if epubdir is not None and srcdir is not None and 'id' in pg:
+            src = None
+            if pg.get('type') == 'chapter':
+                src = os.path.join(epubdir, pg.get('srcdir') or srcdir,
+                                   str(pg.get('src', pg_id)) + '.md')
+            elif pg.get('type') == 'static':
+                src = os.path.join(epubdir, srcdir,
+                                   str(pg.get('src', pg_id)) + '.xhtml')
+            if src and not os.path.isfile(src):
+                problems.append(('error', loc,
+                                 'source file {} not found'.format(src)))
+
+        if data.get('children'):
+            children = validate_pages(data['children'], loc + '.children',
+                                      ids, problems, epubdir, srcdir)
+            if children:
+                pg.children = children
+        out.append(pg)
+
+    return out
+
+
+def validate(meta, mainmatter=None, epubdir=None, srcdir=None):
+    """
+    Validates and normalizes the book metadata `meta` (as read from meta
+    YAML) and `mainmatter` (as read from mainmatter YAML, optional), see
+    `validate_pages`. Warnings (e.g. for misspelled keys) are logged.
+
+    Returns a tuple `(meta, mainmatter)` with front- and backmatter in
+    `meta` as well as `mainmatter` converted to lists of `Page` records.
+
+    Raises `SchemaError` listing all errors found.
+    """
+    schema = compiled_schema()
+    problems = []
+    if not isinstance(meta, dict):
+        raise SchemaError([('error', 'meta', 'must be a mapping')])
+    meta = dict(meta)
+    if not meta.get('title'):
+        problems.append(('error', 'meta', "missing 'title'"))
+    ids = set()
+    for key in ('frontmatter', 'backmatter'):
+        if key in meta:
+            meta[key] = validate_pages(meta[key], key, ids, problems,
+                                       epubdir, srcdir)
+    if mainmatter is not None:
+        mainmatter = validate_pages(mainmatter, 'mainmatter', ids, problems,
+                                    epubdir, srcdir)
+    for key in meta:
+        match = _misspelled(key, schema['known_meta_keys'])
+        if match and key not in ids:
+            problems.append(('warning', 'meta', 'unknown key {!r} (did you '
+                             'mean {!r}?)'.format(key, match)))
+
+    for severity, loc, msg in problems:
+        if severity == 'warning':
+            logging.warning('%s: %s', loc, msg)
+    if any(p[0] == 'error' for p in problems):
+        raise SchemaError(problems)
+
+    return meta, mainmatter
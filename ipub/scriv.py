@@ -2,29 +2,158 @@ import sys
 import xml.etree.ElementTree as ET
 import re
 import os.path
-from copy import deepcopy
 import logging
+import hashlib
 
 import yaml
 
 from . import params
 from . import utils
+from . import ipitfix
+from . import stats
+from . import schema
+from . import search
 
 
 class ParsingError(Exception):
     pass
 
 
-def get_top_bi(scriv_xml='project.scrivx', top_title='Manuscript'):
+# files of a binder item in the Scrivener 3 content directory
+# ('Files/Data/<UUID>/') and the item kinds they are indexed as
+_SCRIV3_FILES = {'content.rtf': 'content', 'synopsis.txt': 'synopsis',
+                 'notes.rtf': 'notes'}
+# files of a binder item in the Scrivener 2 content directory ('Files/Docs')
+_SCRIV2_FILE_RE = re.compile(r'^(\d+)(\.rtf|_synopsis\.txt|_notes\.rtf)$')
+_SCRIV2_FILES = {'.rtf': 'content', '_synopsis.txt': 'synopsis',
+                 '_notes.rtf': 'notes'}
+
+
+# RTF groups that Scrivener (or the RTF writer it uses) rewrites without the
+# text changing: document info (timestamps, revision counts) and generator
+# or revision tables
+_RTF_VOLATILE_GROUP_RE = re.compile(
+        rb'\{\\(?:\*\\)?(?:info|generator|rsidtbl|revtbl|userprops|'
+        rb'xmlnstbl|themedata|colorschememapping|datastore)(?![a-z])')
+# volatile control words: revision session ids and RTF writer versions
+_RTF_VOLATILE_WORD_RE = re.compile(
+        rb'\\(?:[a-z]*rsid[a-z]*|cocoartf|cocoasubrtf)-?\d+ ?')
+
+
+def rtf_fingerprint(data):
+    """
+    Returns a fingerprint (SHA-256 hex digest) of RTF document `data`
+    (bytes) that only changes with its content: volatile groups and control
+    words (see ``_RTF_VOLATILE_GROUP_RE`` and ``_RTF_VOLATILE_WORD_RE``) are
+    removed and line breaks (insignificant in RTF) are normalized first.
+    """
+    out = []
+    pos = 0
+    m = _RTF_VOLATILE_GROUP_RE.search(data)
+    while m:
+        out.append(data[pos:m.start()])
+        # skip to the closing brace of the group
+        depth = 0
+        i = m.start()
+        while i < len(data):
+            c = data[i]
+            if c == 0x5c:  # backslash: skip escaped character
+                i += 2
+                continue
+            if c == 0x7b:
+                depth += 1
+            elif c == 0x7d:
+                depth -= 1
+                if depth == 0:
+                    i += 1
+                    break
+            i += 1
+        pos = i
+        m = _RTF_VOLATILE_GROUP_RE.search(data, pos)
+    out.append(data[pos:])
+    data = _RTF_VOLATILE_WORD_RE.sub(b'', b''.join(out))
+    # backslash + line break is a paragraph mark, other line breaks are
+    # ignored by RTF readers
+    data = re.sub(rb'\\\r?\n', rb'\\par ', data)
+    data = data.replace(b'\r', b'').replace(b'\n', b'')
+    return hashlib.sha256(data).hexdigest()
+
+
+def project_format(projdir):
+    """
+    Returns the Scrivener version (2 or 3) of the project in `projdir`,
+    judged by its content directory (see ``params._SCRIV_RTF_DIR``).
+    """
+    if os.path.isdir(os.path.join(projdir, params._SCRIV_RTF_DIR[3])):
+        return 3
+    return 2
+
+
+def find_scrivx(projdir, scrivxml=None):
+    """
+    Returns the path of the Scrivener project file `scrivxml` (relative to
+    `projdir`). If `scrivxml` is `None` the '.scrivx' file in `projdir` is
+    used (Scrivener 3 names it after the project, Scrivener 2 projects
+    usually have 'project.scrivx').
+
+    Raises `ParsingError` if there is no single such file.
+    """
+    if scrivxml:
+        return os.path.join(projdir, scrivxml)
+    found = [f for f in os.listdir(projdir) if f.endswith('.scrivx')]
+    if len(found) != 1:
+        raise ParsingError('expected one .scrivx file in {}, found {}'.format(
+                projdir, len(found)))
+    return os.path.join(projdir, found[0])
+
+
+def index_binder(projdir, rtfdir, fmt):
+    """
+    Indexes the content directory `rtfdir` (relative to `projdir`) of a
+    Scrivener project in format `fmt` (2 or 3) in a single scan. Returns a
+    dict that maps binder item IDs ('ID' attribute in Scrivener 2, 'UUID' in
+    Scrivener 3) to dicts with the paths (relative to `projdir`) of the
+    item's 'content' RTF, 'synopsis' and 'notes' (where present).
+    """
+    index = {}
+    base = os.path.join(projdir, rtfdir)
+    try:
+        entries = list(os.scandir(base))
+    except FileNotFoundError:
+        logging.warning('Scrivener content directory %s not found', base)
+        return index
+    for e in entries:
+        if fmt == 3:
+            if not e.is_dir():
+                continue
+            files = {}
+            for f in os.scandir(e.path):
+                kind = _SCRIV3_FILES.get(f.name)
+                if kind:
+                    files[kind] = os.path.join(rtfdir, e.name, f.name)
+            if files:
+                index[e.name] = files
+        else:
+            m = _SCRIV2_FILE_RE.match(e.name)
+            if m:
+                index.setdefault(m.group(1), {})[
+                        _SCRIV2_FILES[m.group(2)]] = os.path.join(rtfdir,
+                                                                  e.name)
+    logging.info('indexed %d binder items in %s', len(index), base)
+    return index
+
+
+def get_top_bi(scriv_xml='project.scrivx', top_title='Manuscript', root=None):
     """
     Returns the first ETree 'BinderItem' element (within the first 'Binder'
     element) that includes a 'Title' tag with `top_title`. `scriv_xml` is the
-    path to the Scrivener project file.
+    path to the Scrivener project file; it is not read if its root element is
+    passed as `root`.
 
     Raises `ParsingError` if element cannot be found.
     """
-    tree = ET.parse(scriv_xml)
-    root = tree.getroot()
+    if root is None:
+        root = ET.parse(scriv_xml).getroot()
     bis = root.find('Binder').iterfind('BinderItem')
     for bi in bis:
         if bi.find('Title').text == top_title:
@@ -34,33 +163,69 @@ def get_top_bi(scriv_xml='project.scrivx', top_title='Manuscript'):
             top_title))
 
 
-def get_chapters(top, type_filter=None, in_compile_only=True):
+def project_meta(root):
     """
-    Returns a tuple `(chapters, count)`. `chapters` is a list of dicts with
-    keys 'scrivID', 'scrivTitle', 'scrivType', 'IncludeInCompile' based on the
-    'BinderItem' elements under `top`. If the respective element has children
-    these will be captured in a list, mapped against 'children'.  If
+    Returns a dict with the names of the labels, status values and keywords
+    defined in the Scrivener project with root element `root`, as dicts
+    keyed by ID under 'labels', 'status' and 'keywords'.
+    """
+    def names(path, title=None):
+        out = {}
+        for e in root.iterfind(path):
+            name = e.findtext(title) if title else e.text
+            if e.get('ID') is not None and name:
+                out[e.get('ID')] = name.strip()
+        return out
+
+    return {'labels': names('LabelSettings/Labels/Label'),
+            'status': names('StatusSettings/StatusItems/Status'),
+            'keywords': names('Keywords/Keyword', 'Title')}
+
+
+def get_chapters(top, type_filter=None, in_compile_only=True, proj_meta=None):
+    """
+    Returns a tuple `(chapters, count)`. `chapters` is a list of
+    `schema.Page` records with keys 'scrivID', 'scrivTitle', 'scrivType'
+    based on the 'BinderItem' elements under `top`. If the respective
+    element has children these will be captured under 'children'.  If
     `type_filter` is not `None` only elements with 'Type' tag text equal to
     `type_filter` will be considered (children will be considered in any case).
     Similarly, if `in_compile_only` is `True` only items for which the
     'IncludeInCompile' value is 'Yes' will be considered. `count` is the total
     number of items in `chapters` across potential nestings.
+
+    If `proj_meta` (see `project_meta`) is given, the item's label, status
+    and keywords are added by name as 'scrivLabel', 'scrivStatus' and
+    'scrivKeywords' (if set).
     """
+    def add_meta(rec, e, meta):
+        label = meta.findtext('LabelID') if meta is not None else None
+        if label not in (None, '-1'):
+            rec.scrivLabel = proj_meta['labels'].get(label, label)
+        status = meta.findtext('StatusID') if meta is not None else None
+        if status not in (None, '-1'):
+            rec.scrivStatus = proj_meta['status'].get(status, status)
+        keywords = [proj_meta['keywords'].get(k.text, k.text)
+                    for k in e.iterfind('Keywords/KeywordID') if k.text]
+        if keywords:
+            rec.scrivKeywords = keywords
+
     def get_children(top, chapters):
         count = 0
         for e in top.iterfind('BinderItem'):
-            rec = {}
-            rec['scrivID'] = e.get('ID')
-            rec['scrivType'] = e.get('Type')
-            rec['scrivTitle'] = e.findtext('Title')
-            in_compile = e.find('MetaData').findtext(
-                    'IncludeInCompile')
+            rec = schema.Page(scrivID=e.get('ID') or e.get('UUID'),
+                              scrivType=e.get('Type'),
+                              scrivTitle=e.findtext('Title'))
+            meta = e.find('MetaData')
+            in_compile = (meta.findtext('IncludeInCompile') if meta is not None
+                          else None)
             if ((type_filter is None or rec['scrivType'] == type_filter)
                     and (in_compile is None or in_compile.lower() == 'yes'
                          or not in_compile_only)):
                 incl_item = True
-                rec['children'] = []
-                ccollect = rec['children']
+                ccollect = []
+                if proj_meta is not None:
+                    add_meta(rec, e, meta)
             else:
                 # we're not interested in the current item but want to pull
                 # up its children one level
@@ -70,8 +235,8 @@ def get_chapters(top, type_filter=None, in_compile_only=True):
             if children is not None:
                     count += get_children(children, ccollect)
             if incl_item:
-                if len(rec['children']) == 0:
-                    rec.pop('children', None)
+                if ccollect:
+                    rec.children = ccollect
                 chapters.append(rec)
                 count += 1
         return count
@@ -86,8 +251,95 @@ def get_chapters(top, type_filter=None, in_compile_only=True):
     return (chapters, count)
 
 
+def synopsis_file(projdir, rtf_src):
+    """
+    Returns the path of the Scrivener synopsis file for RTF source `rtf_src`
+    (relative to `projdir`): '{rtf number}_synopsis.txt' (Scrivener 2) or
+    'synopsis.txt' next to 'content.rtf' (Scrivener 3).
+    """
+    head, tail = os.path.split(rtf_src)
+    if tail == 'content.rtf':
+        return os.path.join(projdir, head, 'synopsis.txt')
+    return os.path.join(projdir, os.path.splitext(rtf_src)[0] +
+                        '_synopsis.txt')
+
+
+def read_synopsis(path, location, problems):
+    """
+    Reads the page metadata in synopsis file `path`, which must hold a YAML
+    mapping (`key: value` pairs) whose keys do not clash with the keys set by
+    `scrivx2yaml` (``params._SYNOPSIS_RESERVED``).
+
+    Returns a tuple `(text, meta)` with the file content and the metadata
+    dict, or `None` if there is no synopsis file. Problems are appended to
+    `problems` as `(severity, location, message)` tuples (see
+    `schema.SchemaError`).
+    """
+    try:
+        with open(path, 'r') as foi:
+            text = foi.read()
+    except FileNotFoundError:
+        return None
+    loc = '{} ({})'.format(location, path)
+    try:
+        meta = yaml.safe_load(text)
+    except yaml.YAMLError as e:
+        problems.append(('error', loc, 'invalid YAML: {}'.format(
+                str(e).replace('\n', ' '))))
+        return None
+    if meta is None:
+        return None
+    if not isinstance(meta, dict):
+        problems.append(('error', loc, 'synopsis must be a mapping of '
+                         '`key: value` pairs'))
+        return None
+    reserved = sorted(set(meta) & set(params._SYNOPSIS_RESERVED))
+    if reserved:
+        problems.append(('error', loc, 'reserved key(s) {}'.format(
+                ', '.join(map(repr, reserved)))))
+        return None
+    return text, meta
+
+
+def add_synopses(chapters, projdir, index=None):
+    """
+    Merges the metadata from the synopsis files (see `read_synopsis`) into
+    the page records in `chapters` (with 'rtf_src' set, see
+    `chapters_to_dict`) in place; keys already set to a non-empty value are
+    kept. If the binder `index` (see `index_binder`) is given, only the
+    synopsis files listed there are read.
+
+    Raises `schema.SchemaError` listing all problems found.
+    """
+    problems = []
+    if index is not None:
+        index = {f['content']: os.path.join(projdir, f['synopsis'])
+                 for f in index.values() if 'content' in f and 'synopsis' in f}
+    for top in chapters:
+        for pg in top.walk():
+            if not pg.get('rtf_src'):
+                continue
+            if index is None:
+                path = synopsis_file(projdir, pg.rtf_src)
+            elif pg.rtf_src in index:
+                path = index[pg.rtf_src]
+            else:
+                continue
+            syn = read_synopsis(path, pg.get('scrivTitle', pg.get('id')),
+                                problems)
+            if syn is None:
+                continue
+            for key, value in syn[1].items():
+                if pg.get(key) in (None, ''):
+                    pg[key] = value
+    if problems:
+        raise schema.SchemaError(problems)
+    return chapters
+
+
 def chapters_to_dict(chapters, src_dir='Files/Docs', src_type='chapter',
-                     headings=None, sub_headings=None, in_place=False):
+                     headings=None, sub_headings=None, in_place=False,
+                     index=None):
     """
     Converts chapter list to dict that can be serialized as YAML for
     mainmatter.
@@ -95,8 +347,8 @@ def chapters_to_dict(chapters, src_dir='Files/Docs', src_type='chapter',
     Arguments:
     ----------
 
-    chapters: list of dicts
-        List with metadate extracted from Scrivener project file. Each dict
+    chapters: list of `schema.Page` records (or dicts)
+        List with metadate extracted from Scrivener project file. Each record
         must be keyed by 'scrivID', 'scrivType', 'scrivTitle', and potentially
         'children'
     src_dir: str
@@ -109,10 +361,14 @@ def chapters_to_dict(chapters, src_dir='Files/Docs', src_type='chapter',
     sub_headings: sequence
         List of chapter sub-headings to be used. These will be used in sequence
         across potentially nested structures in `chapters`.
+    index: dict
+        Binder index (see `index_binder`); if given, 'rtf_src' is taken from
+        it (and left out for items without content) instead of being built
+        from `src_dir`.
 
     Returns `chapters`, augmented by the keys below, but with key 'scrivID'
-    removed. If `in_place` is `False` an augmented copy of `chapters` will be
-    returned.
+    removed. If `in_place` is `False` an augmented copy of `chapters` (as
+    `schema.Page` records) will be returned.
 
         id: str
             Unique label, generated from Scrivener Title tag text
@@ -129,7 +385,8 @@ def chapters_to_dict(chapters, src_dir='Files/Docs', src_type='chapter',
         scrivTitle: str
             Title tag text in Scrivener
     """
-    if not in_place: chapters = deepcopy(chapters)
+    if not in_place:
+        chapters = [schema.Page.from_dict(ch) for ch in chapters]
     if headings: headings = headings[:]
     if sub_headings: sub_headings = sub_headings[:]
     ids = set()
@@ -148,8 +405,11 @@ def chapters_to_dict(chapters, src_dir='Files/Docs', src_type='chapter',
             ids.add(id_str)
             ch['id'] = id_str
             ch['type'] = src_type
-            ch['rtf_src'] = os.path.join(src_dir,
-                                         '{}.rtf'.format(ch['scrivID']))
+            if index is None:
+                ch['rtf_src'] = os.path.join(src_dir,
+                                             '{}.rtf'.format(ch['scrivID']))
+            elif 'content' in index.get(ch['scrivID'], ()):
+                ch['rtf_src'] = index[ch['scrivID']]['content']
             ch.pop('scrivID', None)
             ch['heading'] =  headings.pop(0) if headings else ''
             ch['subheading'] =  sub_headings.pop(0) if sub_headings else ''
@@ -161,72 +421,193 @@ def chapters_to_dict(chapters, src_dir='Files/Docs', src_type='chapter',
     return chapters
 
 
-def to_md(mmyaml, projdir, mddir, use_synopsis=False):
+def to_md(mmyaml, projdir, mddir, use_synopsis=False, fixit=False,
+          workers=None, stats_file=None, fingerprints=None, force=False,
+          report=False, search_index=None, search_book=None):
     """
     Generates markdown files from Scrivener RTF sources.
 
+    Only chapters whose content changed since the last run are converted:
+    the fingerprints of their RTF sources (see `rtf_fingerprint`, including
+    the synopsis if used) are kept as JSON in `fingerprints` (defaults to
+    ``params._SCRIV_FINGERPRINTS`` in `mddir`). If `force` is `True` all
+    chapters are converted. If `report` is `True` nothing is converted;
+    the chapters that are new, changed or removed since the last run are
+    printed instead.
+
+    If `fixit` is `True` hanging italics in the generated Markdown files will
+    be fixed (see `ipitfix.fix_files`), using `workers` processes. `fixit` is
+    part of the fingerprints, so switching it on or off converts all
+    chapters again.
+
     If `use_synopsis` is `True` the Scrivener synopsis text files for each
-    chapter must contain valid yaml `key: value` pairs. These will be prepended
-    to the chapter markdown as metadata.
+    chapter must contain valid yaml `key: value` pairs (see `read_synopsis`;
+    all synopses are validated before anything is converted). These will be
+    prepended to the chapter markdown as metadata. Only Markdown files whose
+    content changed are rewritten.
 
-    Returns number of items written.
+    If `stats_file` is given, a JSON stats index of the generated Markdown
+    files is saved there (see `stats.save_index`).
+
+    If `search_index` (an SQLite file) is given, the converted chapters are
+    updated in this full-text search index (see `search.SearchIndex`) as
+    book `search_book` (required), after hanging italics were fixed, and
+    removed chapters are dropped from it.
+
+    Returns number of items converted.
     """
+    if search_index and not search_book:
+        raise ValueError('search_index needs search_book')
     with open(mmyaml, 'r') as foi:
-        mainmatter = yaml.load(foi)
+        mainmatter = schema.load_pages(foi)
 
     src = []
     target = []
+    headings = {}
 
     # quick and dirty recursion to turn yaml into lists
     def mk_mm_list(mm):
         for m in mm:
-            if not m.get('rtf_src'): continue
-            src.append(m['rtf_src'])
-            target.append(m['id'])
+            # folders without text of their own still hold chapters
+            if m.get('rtf_src'):
+                src.append(m['rtf_src'])
+                target.append(m['id'])
+                headings[m['id']] = m.get('heading')
             if 'children' in m:
                 mk_mm_list(m['children'])
 
     mk_mm_list(mainmatter)
 
-    for i, (s, t) in enumerate(zip(src, target)):
+    synopses = {}
+    if use_synopsis:
+        problems = []
+        for s, t in zip(src, target):
+            syn = read_synopsis(synopsis_file(projdir, s), t, problems)
+            if syn is not None:
+                synopses[t] = syn[0]
+        if problems:
+            raise schema.SchemaError(problems)
+
+    fp_file = fingerprints or os.path.join(mddir, params._SCRIV_FINGERPRINTS)
+    old_fps = utils.load_json(fp_file, {})
+    new_fps = {}
+    changes = []
+    for s, t in zip(src, target):
+        infile = os.path.join(projdir, s)
+        try:
+            with open(infile, 'rb') as foi:
+                fp = rtf_fingerprint(foi.read())
+        except FileNotFoundError:
+            logging.error('RTF source %s not found', infile)
+            continue
+        if t in synopses:
+            fp = hashlib.sha256('{}\0{}'.format(
+                    fp, synopses[t]).encode('utf-8')).hexdigest()
+        if fixit:
+            fp = hashlib.sha256('{}\0fixit'.format(fp).encode(
+                    'utf-8')).hexdigest()
+        new_fps[t] = fp
+        if t not in old_fps:
+            changes.append(('new', t, s))
+        elif old_fps[t] != fp:
+            changes.append(('changed', t, s))
+        elif force or not os.path.exists(os.path.join(mddir, t + '.md')):
+            changes.append(('convert', t, s))
+    removed = sorted(set(old_fps) - set(target))
+
+    if report:
+        for status, t, s in changes:
+            if status != 'convert':
+                print('{}\t{}\t{}'.format(status, t, s))
+        for t in removed:
+            print('removed\t{}'.format(t))
+        return 0
+
+    outfiles = [os.path.join(mddir, t + '.md') for t in target]
+    converted = []
+    cmd = os.path.join(params._PATH_PREFIX, 'rtf2md.sh')
+    for _, t, s in changes:
         infile = os.path.join(projdir, s)
         outfile = os.path.join(mddir, t + '.md')
         logging.info('converting %s to %s...', infile, outfile)
-        cmd = os.path.join(params._PATH_PREFIX, 'rtf2md.sh')
-        std, err = utils.run_script(cmd, infile, outfile)
+        # Markdown goes to stdout, so that the synopsis can be prepended with
+        # a single write:
+        std, err = utils.run_script(cmd, infile, '-')
         if err: logging.error(err.decode('utf-8'))
-        if std: logging.info(std.decode('utf-8'))
-
-        if not use_synopsis:
-            continue
-
-        # synopsis file: {rtf number}_synopsis.txt
-        syn_file = os.path.join(projdir, os.path.splitext(s)[0] +
-                                '_synopsis.txt')
-        try:
-            with open(syn_file, 'r') as foi:
-                meta = foi.read()
-        except FileNotFoundError:
+        if not std:
+            # keep the existing Markdown and retry on the next run
+            logging.error('no Markdown output for %s', infile)
+            if t in old_fps:
+                new_fps[t] = old_fps[t]
+            else:
+                del new_fps[t]
             continue
-        logging.info('fetching chapter meta data from %s', syn_file)
-        with open(outfile, 'r') as foi:
-            content = foi.read()
-        with open(outfile, 'w') as foo:
-            foo.write('{}\n---\n\n{}'.format(meta, content))
-
-    return i
+        converted.append(outfile)
+        content = std.decode('utf-8')
+        if t in synopses:
+            logging.info('adding chapter meta data from %s',
+                         synopsis_file(projdir, s))
+            content = '{}\n---\n\n{}'.format(synopses[t], content)
+        utils.write_if_changed(outfile, content)
+    logging.info('converted %d of %d chapters (others unchanged)',
+                 len(converted), len(target))
+    utils.save_json(fp_file, new_fps)
+
+    if fixit and converted:
+        logging.info('fixing hanging italics in %d files...', len(converted))
+        for f in ipitfix.fix_files(converted, workers):
+            logging.info('fixed hanging italics in %s', f)
+
+    if search_index:
+        indexer = search.SearchIndex(search_index, search_book)
+        indexer.remove(removed)
+        # converted chapters plus those converted before the index existed:
+        missing = set(target) - indexer.pages()
+        for t, outfile in zip(target, outfiles):
+            if (outfile in converted or t in missing) and \
+                    os.path.exists(outfile):
+                with open(outfile, 'r') as foi:
+                    indexer.add(t, headings[t], foi.read())
+        indexer.close()
+
+    if stats_file:
+        page_stats = {}
+        for t, outfile in zip(target, outfiles):
+            try:
+                with open(outfile, 'r') as foi:
+                    page_stats[t] = stats.text_stats(foi.read())
+            except FileNotFoundError:
+                logging.warning('no Markdown file %s, left out of the stats',
+                                outfile)
+        logging.info('saving stats index %s...', stats_file)
+        stats.save_index(stats_file, page_stats)
+
+    return len(converted)
 
 
 def to_yaml(projdir, scrivxml, rtfdir, toptitle, typefilter, src_type, hoffset,
-        headings, output):
+        headings, output, synopsis=False):
     """
     Converts the 'Manuscript' section a Scrivener project XML file into a YAML
     file, augmenting with additional info such as rtf source
-    file location and unique label.
+    file location, unique label and the Scrivener label, status and
+    keywords. If `synopsis` is `True` the metadata in the items' synopsis
+    files is merged into the pages (see `add_synopses`).
+
+    Scrivener 2 and 3 projects are told apart by their layout (see
+    `project_format`); `scrivxml` (see `find_scrivx`) and `rtfdir` default
+    to the format's locations if `None`. RTF and synopsis paths are looked
+    up in an index of the content directory (see `index_binder`).
     """
-    xml_path = os.path.join(projdir, scrivxml)
-    ms_bi = get_top_bi(scriv_xml=xml_path, top_title=toptitle)
-    ch, count = get_chapters(top=ms_bi, type_filter=typefilter)
+    fmt = project_format(projdir)
+    rtfdir = rtfdir or params._SCRIV_RTF_DIR[fmt]
+    xml_path = find_scrivx(projdir, scrivxml)
+    logging.info('reading Scrivener %d project %s...', fmt, xml_path)
+    root = ET.parse(xml_path).getroot()
+    ms_bi = get_top_bi(top_title=toptitle, root=root)
+    ch, count = get_chapters(top=ms_bi, type_filter=typefilter,
+                             proj_meta=project_meta(root))
+    index = index_binder(projdir, rtfdir, fmt)
 
     if headings:
         headings = hoffset * ['']
@@ -236,10 +617,12 @@ def to_yaml(projdir, scrivxml, rtfdir, toptitle, typefilter, src_type, hoffset,
         headings = None
 
     chapters_to_dict(ch, src_dir=rtfdir, src_type=src_type,
-                     headings=headings, in_place=True)
+                     headings=headings, in_place=True, index=index)
+    if synopsis:
+        add_synopses(ch, projdir, index)
 
     foo = output if output else sys.stdout
-    yaml.dump(ch, stream=foo, default_flow_style=False)
+    schema.dump_pages(ch, stream=foo)
     if output:
         output.close()
 
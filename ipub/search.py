@@ -0,0 +1,187 @@
+"""
+Full-text search index over the chapter sources of one or more books, built
+while `genep` and `scriv2md` process the chapters anyway.
+
+The index is an SQLite database with an FTS5 table of the chapter texts
+(Markdown without metadata) plus a table with one row per chapter: book,
+page id, heading, fingerprint of the text and the number of in-page section
+breaks (see `stats.text_stats`). Chapters whose text did not change are not
+touched when the index is updated.
+"""
+
+import os
+import hashlib
+import logging
+import sqlite3
+from urllib.parse import quote
+
+from . import stats
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chapters (
+    rowid INTEGER PRIMARY KEY,
+    book TEXT NOT NULL,
+    page TEXT NOT NULL,
+    heading TEXT,
+    fingerprint TEXT NOT NULL,
+    words INTEGER,
+    breaks INTEGER,
+    UNIQUE (book, page)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chapter_text USING fts5(
+    heading, body, tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+
+class SearchError(Exception):
+    pass
+
+
+class SearchIndex:
+    """
+    Search index in SQLite database `path`, updated with the chapters of
+    book `book` (see `add`). Changes are committed by `close`.
+    """
+
+    def __init__(self, path, book):
+        self.path = path
+        self.book = book
+        self.updated = self.unchanged = 0
+        self._seen = set()
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(_SCHEMA)
+
+    def add(self, page_id, heading, md_text, counts=None):
+        """
+        Adds or updates chapter `page_id` with heading `heading` and Markdown
+        source `md_text`; `counts` are the chapter's statistics if known
+        (see `stats.text_stats`). Returns `True` if the index changed.
+        """
+        self._seen.add(page_id)
+        body = stats.strip_meta(md_text)
+        heading = heading or ''
+        fp = hashlib.sha256('{}\0{}'.format(heading, body).encode(
+                'utf-8')).hexdigest()
+        row = self.conn.execute(
+                'SELECT rowid, fingerprint FROM chapters WHERE book = ? AND '
+                'page = ?', (self.book, page_id)).fetchone()
+        if row and row[1] == fp:
+            self.unchanged += 1
+            return False
+        counts = counts or stats.text_stats(md_text)
+        if row:
+            rowid = row[0]
+            self.conn.execute(
+                    'UPDATE chapters SET heading = ?, fingerprint = ?, '
+                    'words = ?, breaks = ? WHERE rowid = ?',
+                    (heading, fp, counts['words'], counts['breaks'], rowid))
+            self.conn.execute('DELETE FROM chapter_text WHERE rowid = ?',
+                              (rowid,))
+        else:
+            rowid = self.conn.execute(
+                    'INSERT INTO chapters (book, page, heading, fingerprint, '
+                    'words, breaks) VALUES (?, ?, ?, ?, ?, ?)',
+                    (self.book, page_id, heading, fp, counts['words'],
+                     counts['breaks'])).lastrowid
+        self.conn.execute('INSERT INTO chapter_text (rowid, heading, body) '
+                          'VALUES (?, ?, ?)', (rowid, heading, body))
+        self.updated += 1
+        logging.debug('indexed %s in %s', page_id, self.path)
+        return True
+
+    def pages(self):
+        """
+        Returns the set of page ids of the book in the index.
+        """
+        return {r[0] for r in self.conn.execute(
+                'SELECT page FROM chapters WHERE book = ?', (self.book,))}
+
+    def remove(self, page_ids):
+        """
+        Removes the chapters `page_ids` of the book from the index and
+        returns their number.
+        """
+        removed = 0
+        for page_id in page_ids:
+            row = self.conn.execute(
+                    'SELECT rowid FROM chapters WHERE book = ? AND page = ?',
+                    (self.book, page_id)).fetchone()
+            if row:
+                self.conn.execute('DELETE FROM chapter_text WHERE rowid = ?',
+                                  row)
+                self.conn.execute('DELETE FROM chapters WHERE rowid = ?', row)
+                removed += 1
+        return removed
+
+    def prune(self):
+        """
+        Removes all chapters of the book that have not been added since the
+        index was opened and returns their number.
+        """
+        return self.remove(self.pages() - self._seen)
+
+    def close(self):
+        """
+        Commits the changes and closes the index.
+        """
+        logging.info('search index %s: %d chapters updated, %d unchanged',
+                     self.path, self.updated, self.unchanged)
+        self.conn.commit()
+        self.conn.close()
+
+
+def search(path, query=None, book=None, breaks=False, limit=20):
+    """
+    Searches the index in `path` for FTS5 query `query` (e.g. 'Buck',
+    '"lost mine"' or 'heading:Thornton'), optionally restricted to book
+    `book` and/or (if `breaks` is `True`) to chapters with in-page section
+    breaks. Without `query` all chapters (of `book`) are listed, in the order
+    in which they were first indexed.
+
+    Returns a list of dicts with 'book', 'page', 'heading', 'breaks' and (for
+    queries) a 'snippet' of the matching text, best matches first, at most
+    `limit` (all if `None`).
+
+    Raises `SearchError` for invalid queries or if the index does not exist.
+    """
+    try:
+        conn = sqlite3.connect('file:{}?mode=ro'.format(
+                quote(os.path.abspath(path))), uri=True)
+    except sqlite3.OperationalError as e:
+        raise SearchError('cannot open search index {}: {}'.format(path, e))
+    where = []
+    args = []
+    if query:
+        sql = ("SELECT c.book, c.page, c.heading, c.breaks, "
+               "snippet(chapter_text, 1, '[', ']', '...', 12) "
+               "FROM chapter_text JOIN chapters c "
+               "ON c.rowid = chapter_text.rowid")
+        where.append('chapter_text MATCH ?')
+        args.append(query)
+        order = 'rank'
+    else:
+        sql = ("SELECT c.book, c.page, c.heading, c.breaks, NULL "
+               "FROM chapters c")
+        order = 'c.book, c.rowid'
+    if book is not None:
+        where.append('c.book = ?')
+        args.append(book)
+    if breaks:
+        where.append('c.breaks > 0')
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY ' + order
+    if limit is not None:
+        sql += ' LIMIT ?'
+        args.append(limit)
+    try:
+        with conn:
+            rows = conn.execute(sql, args).fetchall()
+    except sqlite3.OperationalError as e:
+        raise SearchError('search failed: {}'.format(e))
+    finally:
+        conn.close()
+    keys = ('book', 'page', 'heading', 'breaks', 'snippet')
+    return [dict(zip(keys, r)) for r in rows]
@@ -0,0 +1,111 @@
+"""
+Word count, reading time and structural statistics for Markdown chapter
+sources, collected while the sources are processed anyway (`genep`,
+`mmcat`, `scriv2md`) and optionally saved as JSON stats index.
+"""
+
+import re
+import math
+
+from . import params
+from . import utils
+
+
+# in-page section breaks (same variants as in `epub.gen_chapter` and
+# `latex.fleuronize`), on a line of their own:
+_BREAK_RE = re.compile(
+        r'\s*(?:\\?[*]\s*\\?[*]\s*\\?[*]'
+        r'|\\?[#]\s*\\?[#]\s*\\?[#]'
+        r'|\\?[<]\s*\\?[<]\s*\\?[<]\s*\\?[>]\s*\\?[>]\s*\\?[>])\s*$')
+# Markdown meta data lines (as read by the 'meta' extension):
+_META_RE = re.compile(r'[ ]{0,3}[A-Za-z0-9_-]+:\s*.*$')
+# single '*' italics spans (not '**' bold, not escaped '\*'):
+_ITALICS_RE = re.compile(r'(?<![\\*])\*(?![\s*])(.+?)(?<![\\\s*])\*(?!\*)',
+                         re.S)
+_LINK_RE = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+_MARKUP_RE = re.compile(r'(?<!\\)[*_`]|^\s{0,3}(?:>\s*)+|\\(?=[\\*_`#])',
+                        re.M)
+_WORD_RE = re.compile(r"\w+(?:['’-]\w+)*")
+
+# keys of the per chapter counts returned by `text_stats`
+_COUNTS = ('words', 'chars', 'paragraphs', 'breaks', 'italics')
+
+
+def strip_meta(md_text):
+    """
+    Returns `md_text` without a leading metadata block (`key: value` lines,
+    optionally enclosed in '---' lines, up to the first blank line).
+    """
+    lines = md_text.splitlines(keepends=True)
+    i = 0
+    if lines and lines[0].strip() == '---':
+        i = 1
+    if i >= len(lines) or not _META_RE.match(lines[i]):
+        return md_text
+    while i < len(lines) and lines[i].strip():
+        if lines[i].strip() in ('---', '...') and i > 0:
+            i += 1
+            break
+        i += 1
+    return ''.join(lines[i:])
+
+
+def text_stats(md_text):
+    """
+    Returns a dict with counts for Markdown chapter source `md_text`:
+
+        words, chars: words and characters of the plain text (without markup,
+            metadata and headings)
+        paragraphs: number of paragraphs (not counting headings and section
+            breaks)
+        breaks: number of in-page section breaks
+        italics: number of italics spans
+    """
+    counts = dict.fromkeys(_COUNTS, 0)
+    for block in re.split(r'\n[ \t]*\n', strip_meta(md_text)):
+        block = block.strip()
+        if not block:
+            continue
+        if _BREAK_RE.match(block):
+            counts['breaks'] += 1
+            continue
+        if block.startswith('#'):
+            continue
+        counts['paragraphs'] += 1
+        counts['italics'] += len(_ITALICS_RE.findall(block))
+        plain = _MARKUP_RE.sub('', _LINK_RE.sub(r'\1', block))
+        plain = re.sub(r'\s+', ' ', plain)
+        counts['words'] += len(_WORD_RE.findall(plain))
+        counts['chars'] += len(plain)
+    return counts
+
+
+def totals(page_stats):
+    """
+    Returns a dict with the sums of all counts (and output 'bytes' where
+    available) over the dicts in `page_stats`, plus the number of
+    'chapters' (pages with text counts) and the estimated
+    'reading_minutes' (at ``params._READING_WPM`` words per minute).
+    """
+    out = dict.fromkeys(_COUNTS, 0)
+    out['chapters'] = 0
+    for st in page_stats:
+        if 'words' in st:
+            out['chapters'] += 1
+        for key in _COUNTS + ('bytes',):
+            if key in st:
+                out[key] = out.get(key, 0) + st[key]
+    out['reading_minutes'] = math.ceil(out['words'] / params._READING_WPM)
+    return out
+
+
+def save_index(path, pages):
+    """
+    Saves the stats index as JSON to `path`: `pages` (a dict that maps page
+    ids to their stats) plus the totals (see `totals`).
+
+    Returns the totals.
+    """
+    tot = totals(pages.values())
+    utils.save_json(path, {'pages': pages, 'totals': tot})
+    return tot
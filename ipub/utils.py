@@ -1,10 +1,19 @@
 import math
+import os
+import json
 import re
+import shutil
+import tempfile
+import time
 import subprocess
 from urllib.parse import urlsplit, urlunsplit, urlencode, parse_qsl
 import logging
+import yaml
 from cookiecutter.main import cookiecutter
 
+from . import events
+
+
 def cc_create(tmpl, extra_context=None, output_dir='.', no_input=False):
     """
     Create new book project from cookiecutter template.
@@ -31,11 +40,240 @@ def run_script(*args):
     """
     Runs external executable with list of arguments in `args`.
 
-    Returns a tuple (stdout, stderr) with script output.
+    Returns a tuple (stdout, stderr) with script output. A 'process' event
+    with the duration is emitted (see `events.emit`).
     """
     logging.debug('calling Popen with args: %s', ' '.join(args))
+    start = time.perf_counter()
     proc = subprocess.Popen(args, stdout=subprocess.PIPE)
-    return proc.communicate()
+    out = proc.communicate()
+    events.emit('process', cmd=os.path.basename(args[0]), args=args[1:],
+                returncode=proc.returncode,
+                duration=round(time.perf_counter() - start, 4))
+    return out
+
+
+# ioctl request code for FICLONE (linux/fs.h), used for reflink copies
+_FICLONE = 0x40049409
+
+
+def link_file(src, dst, mode='copy'):
+    """
+    Places a copy of file `src` at `dst`. `mode` can be 'copy' (regular copy,
+    preserving metadata), 'hard' (hardlink) or 'reflink' (copy-on-write clone,
+    sharing disk blocks on file systems that support it, e.g. btrfs or XFS).
+    If linking is not possible (cross-device, unsupported file system or
+    platform) the file will be copied instead. An existing `dst` will be
+    replaced.
+
+    Returns the mode that was actually used.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == 'hard':
+        try:
+            os.link(src, dst)
+            return 'hard'
+        except OSError as e:
+            logging.debug('cannot hardlink %s: %s', src, e)
+    elif mode == 'reflink':
+        try:
+            import fcntl
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return 'reflink'
+        except (ImportError, OSError) as e:
+            logging.debug('cannot reflink %s: %s', src, e)
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+class FileData(bytes):
+    """
+    Content of file `path`, read unchanged from disk (see `read_file`), so
+    that writers can link or copy the file instead of writing its content
+    (see `place_file`). Operations that change the content return plain
+    `bytes`.
+    """
+
+    def __new__(cls, data, path):
+        obj = super().__new__(cls, data)
+        obj.path = path
+        return obj
+
+    def __reduce__(self):
+        return FileData, (bytes(self), self.path)
+
+
+def read_file(path):
+    """
+    Reads file `path` with a single unbuffered read and returns its content
+    as `FileData`.
+    """
+    with open(path, 'rb', buffering=0) as foi:
+        return FileData(foi.readall(), path)
+
+
+def place_file(data, path, mode='copy'):
+    """
+    Places the file `data` (`FileData`) was read from at `path` unless `path`
+    already has the same content: 'copy' copies it in the kernel (see
+    `shutil.copyfile`, which uses sendfile/copy_file_range where available)
+    to a temporary file that atomically replaces `path` (as in
+    `write_if_changed`), 'hard' and 'reflink' link it (see `link_file`).
+
+    Returns `True` if the file was placed, `False` if it was unchanged.
+    Emits a 'file_written' or 'file_skipped' event (see `events.emit`).
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    if st is not None and st.st_size == len(data):
+        same = os.path.samefile(data.path, path)
+        if not same:
+            with open(path, 'rb') as foi:
+                same = foi.read() == data
+        if same:
+            events.emit('file_skipped', path=path, bytes=len(data))
+            return False
+    if mode == 'copy':
+        # the new file replaces `path` (possibly a hardlink to the source)
+        _replace_file(path, st, lambda tmp_path: shutil.copyfile(data.path,
+                                                                 tmp_path))
+    else:
+        link_file(data.path, path, mode)
+    events.emit('file_written', path=path, bytes=len(data))
+    return True
+
+
+def write_if_changed(path, data):
+    """
+    Writes `data` (bytes, or str which will be UTF-8 encoded) to `path`
+    unless the file already has exactly this content, in which case it (and
+    its mtime) is left untouched. The file is replaced atomically via a
+    temporary file in the same directory, keeping the permissions of an
+    existing file.
+
+    Returns `True` if the file was written, `False` if it was unchanged.
+    Emits a 'file_written' or 'file_skipped' event (see `events.emit`).
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    if st is not None and st.st_size == len(data):
+        with open(path, 'rb') as foi:
+            if foi.read() == data:
+                events.emit('file_skipped', path=path, bytes=len(data))
+                return False
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as foo:
+            foo.write(data)
+
+    _replace_file(path, st, write)
+    events.emit('file_written', path=path, bytes=len(data))
+    return True
+
+
+# umask of the process for the permissions of new files (see
+# `_replace_file`); read once at import, since reading it means setting it,
+# which would race with threads creating files
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _replace_file(path, st, write):
+    """
+    Replaces `path` atomically with a temporary file in the same directory,
+    filled by calling `write` with its path. The new file gets the
+    permissions of the existing file (`st` is its stat result, `None` if
+    there is none) or those of a newly created file.
+    """
+    dirname = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.',
+            suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        if st is not None:
+            os.chmod(tmp_path, st.st_mode & 0o7777)
+        else:
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_json(path, default=None):
+    """
+    Returns the data stored as JSON in `path` or `default` if `path` does not
+    exist or cannot be decoded (caches are expendable).
+    """
+    try:
+        with open(path, 'r') as foi:
+            return json.load(foi)
+    except FileNotFoundError:
+        return default
+    except ValueError as e:
+        logging.warning('ignoring corrupt cache file %s: %s', path, e)
+        return default
+
+
+def save_json(path, data):
+    """
+    Stores `data` as JSON in `path`, creating parent directories as required.
+    """
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'w') as foo:
+        json.dump(data, foo, indent=1, sort_keys=True)
+
+
+# maps (absolute path, mtime) of YAML files to their parsed content
+_YAML_CACHE = {}
+
+
+def load_yaml_cached(path):
+    """
+    Returns the parsed content of YAML file `path`, memoized as long as the
+    file is not modified. Raises `FileNotFoundError` if `path` does not
+    exist.
+    """
+    path = os.path.abspath(path)
+    key = (path, os.stat(path).st_mtime_ns)
+    if key not in _YAML_CACHE:
+        with open(path, 'r') as foi:
+            _YAML_CACHE[key] = yaml.safe_load(foi)
+    return _YAML_CACHE[key]
+
+
+def find_page_data(pg, meta, search_dirs):
+    """
+    Returns the page data for template page `pg` (passed to its template as
+    `pg_data`): the item in `meta` keyed with the page id or, if there is
+    none, the content of the supplementary YAML file `<pg['yaml']>.yaml`
+    (or `<page id>.yaml`), looked up in `search_dirs` where later
+    directories take precedence. Returns `None` if no page data is found.
+    """
+    pg_data = meta.get(pg['id'])
+    if pg_data:
+        return pg_data
+    fname = '{0}.yaml'.format(pg['yaml'] if 'yaml' in pg else pg['id'])
+    for dirname in reversed(search_dirs):
+        try:
+            return load_yaml_cached(os.path.join(dirname, fname))
+        except FileNotFoundError:
+            continue
+    logging.warning('no page data for %s: %s not found in %s', pg['id'],
+                    fname, ', '.join(search_dirs))
+    return None
 
 
 def mk_query_urls(ht_text, url_re, qmap):
@@ -43,19 +281,46 @@ def mk_query_urls(ht_text, url_re, qmap):
     Appends a URL query string contructed from `qmap` to all URLs that match
     `url_re` in `ht_text`. If the original URL already contained one of the
     query elements in `qmap` this will be overwritten with the `qmap` version.
-    Returns the text with substitutions made.
+    If `url_re` has a group, its first group is taken as the URL; only URLs
+    in double quotes (attribute values) are changed.
+
+    `ht_text` can be a string or a bytes-like object (such as a memory-mapped
+    file), which is scanned in a single pass without decoding it as a whole.
+
+    Returns the text (as string or bytes) with substitutions made.
     """
-    links = re.findall(url_re, ht_text)
-    for ll in set(links):
-        old = urlsplit(ll)
-        if old.query:
-            updated_qmap = dict(parse_qsl(old.query) + list(qmap.items()))
-        else:
-            updated_qmap = qmap
-        new = list(old[:3]) + [urlencode(updated_qmap)] + list(old[-1:])
-        ht_text = ht_text.replace('"{}"'.format(ll),
-                '"{}"'.format(urlunsplit(new).replace('&', '&amp;')))
-    return ht_text
+    binary = not isinstance(ht_text, str)
+    pattern = re.compile(url_re.encode('utf-8') if binary else url_re)
+    quote = b'"' if binary else '"'
+    group = 1 if pattern.groups else 0
+    new_urls = {}
+    out = []
+    pos = 0
+    for m in pattern.finditer(ht_text):
+        start, end = m.span(group)
+        if (start < 1 or ht_text[start - 1:start] != quote or
+                ht_text[end:end + 1] != quote):
+            continue
+        ll = m.group(group)
+        if ll not in new_urls:
+            old = urlsplit(ll.decode('utf-8') if binary else ll)
+            if old.query:
+                # attribute values escape '&' (e.g. URLs tagged before)
+                query = old.query.replace('&amp;', '&')
+                updated_qmap = dict(parse_qsl(query) + list(qmap.items()))
+            else:
+                updated_qmap = qmap
+            new = list(old[:3]) + [urlencode(updated_qmap)] + \
+                    list(old[-1:])
+            new = urlunsplit(new).replace('&', '&amp;')
+            new_urls[ll] = new.encode('utf-8') if binary else new
+        out.append(ht_text[pos:start])
+        out.append(new_urls[ll])
+        pos = end
+    if not out:
+        return bytes(ht_text) if binary else ht_text
+    out.append(ht_text[pos:])
+    return (b'' if binary else '').join(out)
 
 
 
@@ -0,0 +1,148 @@
+"""
+Output writers for generated EPUB files
+
+Each writer takes an iterable of `(path, data)` tuples (`path` relative to the
+EPUB root directory, `data` as bytes) plus the EPUB root directory and
+returns the number of files it wrote.
+"""
+
+import os
+import re
+import fnmatch
+import logging
+import time
+import zipfile
+
+from . import params
+from . import utils
+from . import events
+
+
+def write_dir(files, epubdir, link='copy', **kwargs):
+    """
+    Writes `files` below `epubdir` (see `utils.write_if_changed`). Files whose
+    content is identical to the one already on disk are not touched. Files
+    passed unchanged from disk (`utils.FileData`) are copied or linked
+    instead, according to `link` (see `utils.place_file`).
+    """
+    written = unchanged = 0
+    for path, data in files:
+        target = os.path.join(epubdir, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if isinstance(data, utils.FileData):
+            changed = utils.place_file(data, target, link)
+        else:
+            changed = utils.write_if_changed(target, data)
+        if changed:
+            logging.info('wrote %s', target)
+            written += 1
+        else:
+            logging.debug('%s unchanged', target)
+            unchanged += 1
+    logging.info('%d files written, %d unchanged', written, unchanged)
+    return written
+
+
+def read_exclude_list(epubdir, exclude_list='exclude.list'):
+    """
+    Returns the list of shell patterns in `exclude_list` (relative to
+    `epubdir`), as used with zip's -x option. Returns an empty list if the
+    file does not exist.
+    """
+    try:
+        with open(os.path.join(epubdir, exclude_list), 'r') as foi:
+            return [l.strip() for l in foi if l.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def collect_files(epubdir, files=(), skip=()):
+    """
+    Returns a dict that maps the paths (relative to `epubdir`) of all files
+    that make up the EPUB to their content: `files` (an iterable of `(path,
+    data)` tuples, e.g. freshly rendered files) plus all other files below
+    `epubdir`, except hidden files, files matching a pattern in
+    ``exclude.list`` and the files in `skip`.
+    """
+    files = dict(files)
+    skip = {os.path.abspath(os.path.join(epubdir, p)) for p in skip}
+    excl = [re.compile(fnmatch.translate(p))
+            for p in read_exclude_list(epubdir)]
+    for dirpath, dirnames, filenames in os.walk(epubdir):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for fname in filenames:
+            path = os.path.relpath(os.path.join(dirpath, fname), epubdir)
+            if (fname.startswith('.') or path in files or
+                    os.path.abspath(os.path.join(epubdir, path)) in skip or
+                    any(p.match(path) for p in excl)):
+                continue
+            with open(os.path.join(epubdir, path), 'rb') as foi:
+                files[path] = foi.read()
+    return files
+
+
+def write_zip(files, epubdir, epubfile='book.epub', skip=(), **kwargs):
+    """
+    Packages `files` together with all other files below `epubdir` (see
+    `collect_files`; files in `skip` are left out) as EPUB archive
+    `epubfile` (relative to `epubdir`).
+    Entries in `files` take precedence over files on disk. ``mimetype`` is
+    stored uncompressed as first entry. Entries are sorted and carry fixed
+    timestamps and permissions (see `zip_date_time`), so that identical
+    input yields a byte-identical archive.
+    """
+    target = os.path.join(epubdir, epubfile)
+    files = collect_files(epubdir, files, skip=[epubfile] + list(skip))
+    mimetype = files.pop('mimetype', b'application/epub+zip')
+    logging.info('packaging %s...', target)
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(_zip_info('mimetype', zipfile.ZIP_STORED), mimetype)
+        for path in sorted(files):
+            zf.writestr(_zip_info(path.replace(os.sep, '/')), files[path])
+    events.emit('file_written', path=target, bytes=os.path.getsize(target))
+    return len(files) + 1
+
+
+def zip_date_time():
+    """
+    Returns the timestamp to use for archive entries: taken from the
+    SOURCE_DATE_EPOCH environment variable if set (see
+    https://reproducible-builds.org/specs/source-date-epoch/), otherwise
+    ``params._ZIP_DATE_TIME``.
+    """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch:
+        # zip timestamps cannot predate 1980
+        stamp = time.gmtime(max(int(epoch), 315532800))
+        return stamp[:6]
+    return params._ZIP_DATE_TIME
+
+
+def _zip_info(name, compress_type=zipfile.ZIP_DEFLATED):
+    """
+    Returns a ZipInfo for `name` with fixed timestamp, permissions and
+    creator system, so that identical content yields identical archives.
+    """
+    zinfo = zipfile.ZipInfo(name, date_time=zip_date_time())
+    zinfo.compress_type = compress_type
+    zinfo.create_system = 3
+    zinfo.external_attr = 0o644 << 16
+    return zinfo
+
+
+def write_none(files, epubdir, **kwargs):
+    """
+    Dry run: only logs what would be written.
+    """
+    count = 0
+    for path, data in files:
+        logging.info('would write %s (%d bytes)', path, len(data))
+        count += 1
+    return count
+
+
+# maps writer names (as used for `genep --writer`) to writer functions
+_WRITERS = {'dir':  write_dir,
+            'zip':  write_zip,
+            'none': write_none,
+}
@@ -0,0 +1,80 @@
+import unittest
+
+from ipub import check
+
+
+_CONTAINER = b'''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>'''
+
+_OPF = b'''<?xml version="1.0"?>
+<package version="2.0" xmlns="http://www.idpf.org/2007/opf">
+  <manifest>
+    <item href="a.xhtml" id="html_a" media-type="application/xhtml+xml"/>
+    <item href="b.xhtml" id="html_b" media-type="application/xhtml+xml"/>
+  </manifest>
+  <spine><itemref idref="html_a"/><itemref idref="html_b"/></spine>
+</package>'''
+
+_XHTML = '''<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>x</title></head>
+<body>{}</body></html>'''
+
+
+class CheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.files = {
+            'mimetype': b'application/epub+zip',
+            'META-INF/container.xml': _CONTAINER,
+            'OPS/content.opf': _OPF,
+            'OPS/a.xhtml': _XHTML.format(
+                '<p id="p1">&nbsp;<a href="b.xhtml#p2">b</a></p>').encode(),
+            'OPS/b.xhtml': _XHTML.format('<p id="p2">b</p>').encode(),
+        }
+
+    def test_valid(self):
+        self.assertEqual(check.check_files(self.files, ['a', 'b'],
+                                           workers=1), [])
+
+    def test_split_parts(self):
+        self.files['OPS/content.opf'] = _OPF.replace(b'</manifest>', (
+                b'<item href="a-part2.xhtml" id="html_a-part2" '
+                b'media-type="application/xhtml+xml"/>'
+                b'<item href="b-part2.xhtml" id="html_b-part2" '
+                b'media-type="application/xhtml+xml"/></manifest>')).replace(
+                b'<itemref idref="html_b"/>',
+                b'<itemref idref="html_a-part2"/><itemref idref="html_b"/>'
+                b'<itemref idref="html_b-part2"/>')
+        for name in ('a-part2', 'b-part2'):
+            self.files['OPS/{}.xhtml'.format(name)] = _XHTML.format(
+                    '<p>x</p>').encode()
+        # a-part2 is a part of split chapter a, b-part2 a page of its own:
+        self.assertEqual(check.check_files(self.files, ['a', 'b', 'b-part2'],
+                                           workers=1), [])
+        problems = check.check_files(self.files, ['a', 'b-part2', 'b'],
+                                     workers=1)
+        self.assertEqual([m for _, _, m in problems],
+                         ['spine order does not match pages'])
+
+    def test_problems(self):
+        self.files['OPS/b.xhtml'] = _XHTML.format(
+            '<p id="p1">b</p><p id="p1"><img src="img/x.png"/></p>'
+            ).encode()
+        self.files['OPS/c.xhtml'] = b'<p>'
+        problems = check.check_files(self.files, ['a', 'c'], workers=1)
+        messages = [(s, p, m.split(' (')[0]) for s, p, m in problems]
+        self.assertIn(('error', 'OPS/a.xhtml', 'broken link b.xhtml#p2'),
+                      messages)
+        self.assertIn(('error', 'OPS/b.xhtml', "duplicate id 'p1'"),
+                      messages)
+        self.assertIn(('error', 'OPS/b.xhtml', 'broken image img/x.png'),
+                      messages)
+        self.assertIn(('warning', 'OPS/c.xhtml', 'not listed in manifest'),
+                      messages)
+        self.assertIn(('error', 'OPS/content.opf', "page 'c' not in manifest"),
+                      messages)
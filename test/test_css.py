@@ -0,0 +1,54 @@
+import unittest
+
+from ipub import css
+
+
+_CSS = """/* book stylesheet */
+@charset "utf-8";
+p.par-indent { text-indent: 2em; }
+.toc-item-1, .toc-item-2 {
+    margin: 0;
+    font-family: "Linux Libertine", serif;
+}
+div.fleuron img {width: 40%}
+h1 + p.par-indent, div.fleuron + p.par-indent { text-indent: 0 }
+a:hover, #cover { color: red }
+@media amzn-kf8 {
+    .dropcap { float: left }
+}
+@font-face { font-family: "A"; src: url(data:font/woff;base64,AA) }
+"""
+
+
+class PruneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.used = css.collect_selectors(
+                b'<html><body><h1 class="chapter-heading">A</h1>'
+                b'<p class="par-indent">x <a href="#y">y</a></p>'
+                b'<ul><li class="toc-item-1">z</li></ul></body></html>',
+                css.new_selectors())
+
+    def test_collect(self):
+        self.assertEqual(self.used['classes'],
+                         {'chapter-heading', 'par-indent', 'toc-item-1'})
+        self.assertIn('a', self.used['tags'])
+        self.assertNotIn('div', self.used['tags'])
+
+    def test_prune(self):
+        text, kept, total = css.prune(_CSS, self.used)
+        self.assertEqual((kept, total), (4, 6))
+        self.assertEqual(text,
+                '@charset "utf-8";'
+                'p.par-indent{text-indent:2em}'
+                '.toc-item-1{margin:0;font-family:"Linux Libertine",serif}'
+                'h1+p.par-indent{text-indent:0}'
+                'a:hover{color:red}'
+                '@font-face{font-family:"A";'
+                'src:url(data:font/woff;base64,AA)}')
+
+    def test_minify_only(self):
+        text, kept, total = css.prune(_CSS)
+        self.assertEqual((kept, total), (6, 6))
+        self.assertIn('@media amzn-kf8{.dropcap{float:left}}', text)
+        self.assertIn('div.fleuron img{width:40%}', text)
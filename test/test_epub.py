@@ -2,21 +2,208 @@ import unittest
 from unittest.mock import patch
 from io import StringIO
 import sys
-import logging
+import os
+import tempfile
+import shutil
+
+import jinja2 as j2
 
 from ipub import epub
 from ipub import params
 
 
-logging.basicConfig(level=logging.INFO)
+class InitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
 
+    def test_init(self):
+        target = epub.init(self.tmp.name)
+        self.assertEqual(target, os.path.join(self.tmp.name, 'epub'))
+        for rel_path in ('mimetype', 'meta.yaml', 'META-INF/container.xml',
+                         'OPS/css/stylesheet.css', 'OPS/img/cover.jpg'):
+            self.assertTrue(os.path.isfile(os.path.join(target, rel_path)))
 
-class InitTest(unittest.TestCase):
+    def test_init_hardlink(self):
+        target = epub.init(os.path.join(self.tmp.name, 'book'), link='hard')
+        self.assertEqual(target, os.path.join(self.tmp.name, 'book'))
+        src_img = os.path.join(params._EPUB_SKELETON_PATH, 'OPS/img/cover.jpg')
+        out_img = os.path.join(target, 'OPS/img/cover.jpg')
+        src_yaml = os.path.join(params._EPUB_SKELETON_PATH, 'meta.yaml')
+        out_yaml = os.path.join(target, 'meta.yaml')
+        if os.stat(src_img).st_dev == os.stat(target).st_dev:
+            self.assertTrue(os.path.samefile(src_img, out_img))
+        self.assertFalse(os.path.samefile(src_yaml, out_yaml))
+
+
+class ImgInventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        os.makedirs(os.path.join(self.tmp.name, 'images', 'maps'))
+        src_img = os.path.join(params._EPUB_SKELETON_PATH, 'OPS/img/cover.jpg')
+        with open(src_img, 'rb') as foi:
+            self.cover = foi.read()
+        for rel_path in ('cover.jpg', 'maps/cover.jpg'):
+            with open(os.path.join(self.tmp.name, 'images', rel_path),
+                      'wb') as foo:
+                foo.write(self.cover)
+
+    def test_img_srcdir(self):
+        images, files = epub.build_img_inventory(
+                self.tmp.name, 'OPS/img', 'OPS/content.opf', 'images',
+                persist=False)
+        self.assertEqual([i['href'] for i in images],
+                         ['img/cover.jpg', 'img/maps/cover.jpg'])
+        self.assertEqual(files, {'OPS/img/cover.jpg': self.cover,
+                                 'OPS/img/maps/cover.jpg': self.cover})
+        # nothing written to the book tree:
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['images'])
+
+
+class UuidTest(unittest.TestCase):
+
+    def test_book_uuid(self):
+        meta = {'title': 'Some Title', 'author': 'Some Author',
+                'description': 'will not affect uuid'}
+        uuid = epub.book_uuid(meta)
+        self.assertRegex(uuid, r'^[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}$')
+        self.assertEqual(uuid, epub.book_uuid(dict(meta, description='')))
+        self.assertNotEqual(uuid, epub.book_uuid(dict(meta, title='Other')))
+        self.assertEqual(epub.book_uuid(dict(meta, uuid='pinned')), 'pinned')
+
+
+class PageIndexTest(unittest.TestCase):
+
+    pages = [{'id': 'a'},
+             {'id': 'b', 'children': [
+                 {'id': 'b1', 'children': [{'id': 'b11'}]},
+                 {'id': 'b2', 'no_toc': True, 'children': [{'id': 'b21'}]}]},
+             {'id': 'c'}]
+
+    def test_index_pages(self):
+        index = epub.index_pages(self.pages)
+        self.assertEqual([e['id'] for e in index],
+                         ['a', 'b', 'b1', 'b11', 'b2', 'b21', 'c'])
+        self.assertEqual([e['depth'] for e in index], [1, 1, 2, 3, 2, 3, 1])
+        self.assertEqual(index[3]['parent'], 'b1')
+        self.assertEqual(index[3]['play_order'], 4)
+        self.assertEqual([e['toc'] for e in index],
+                         [True, True, True, True, False, False, True])
+
+    def test_nav_entries(self):
+        index = epub.index_pages(self.pages)
+        toc = epub.nav_entries(index, toc_only=True)
+        self.assertEqual([(e['id'], e['close']) for e in toc],
+                         [('a', 1), ('b', 0), ('b1', 0), ('b11', 3),
+                          ('c', 1)])
+        flat = epub.nav_entries(index, max_depth=1)
+        self.assertEqual([(e['id'], e['play_order'], e['close'])
+                          for e in flat], [('a', 1, 1), ('b', 2, 1),
+                                           ('c', 3, 1)])
+
+
+class SplitTest(unittest.TestCase):
+
+    ht_text = ('<p class="par-indent">one\ntwo</p>\n'
+               '<blockquote>\n<p>quoted</p>\n</blockquote>\n'
+               '<p class="center-par-tb-space">* * *</p>\n'
+               '<p class="par-indent" id="x">three</p>\n')
+
+    def test_split_html(self):
+        self.assertEqual(epub.split_html(self.ht_text), [self.ht_text])
+        self.assertEqual(len(epub.html_blocks(self.ht_text)), 4)
+        parts = epub.split_html(self.ht_text, at_breaks=True)
+        self.assertEqual(len(parts), 2)
+        self.assertTrue(parts[1].startswith('<p class="par-indent" id="x">'))
+        self.assertEqual(''.join(parts), self.ht_text)
+        parts = epub.split_html(self.ht_text, max_bytes=40)
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(''.join(parts), self.ht_text)
+
+    def test_rewrite_split_links(self):
+        files = {'OPS/a.xhtml': b'<a href="#x">x</a><a href="#y">y</a>',
+                 'OPS/a-part2.xhtml': b'<p id="x">x</p>',
+                 'OPS/b.xhtml': b'<a href="a.xhtml#x">x</a>'}
+        splits = {'a.xhtml': ['OPS/a.xhtml', 'OPS/a-part2.xhtml']}
+        self.assertEqual(epub.rewrite_split_links(files, 'OPS', splits), 2)
+        self.assertEqual(files['OPS/a.xhtml'],
+                b'<a href="a-part2.xhtml#x">x</a><a href="#y">y</a>')
+        self.assertEqual(files['OPS/b.xhtml'],
+                         b'<a href="a-part2.xhtml#x">x</a>')
+
+
+class TargetTest(unittest.TestCase):
+
+    def test_render_target(self):
+        env = j2.Environment(loader=j2.DictLoader({
+                'opf.jinja': 'opf {{ epub_version }} {{ guide_cover }}',
+                'opf3.jinja': 'opf3 {{ nav_href }}',
+                'ncx.jinja': 'ncx {{ title }}',
+                'nav_toc.jinja': '{{ doctype }}\nnav {{ pg_meta.id }}'}))
+        doctype = (b'<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
+                   b'"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">')
+        page = doctype + (b'\n<a href="http://example.com/?utm_source=web">'
+                          b'x</a>')
+        content = {'OPS/a.xhtml': page}
+        tracked = {'OPS/a.xhtml': {'url_re': r'http://example\.com[^"]*',
+                                   'utm': {'utm_source': 'web'}}}
+        targets = {'kindle': {'utm': {'utm_source': 'amazon'}}}
+
+        files = epub.render_target('epub2', content, env, 'OPS', tracked,
+                                   title='T', targets=targets)
+        self.assertEqual(list(files), ['OPS/content.opf', 'OPS/toc.ncx',
+                                       'OPS/a.xhtml'])
+        self.assertEqual(files['OPS/content.opf'], b'opf 2.0 True')
+        self.assertIs(files['OPS/a.xhtml'], page)
+
+        files = epub.render_target('kindle', content, env, 'OPS', tracked,
+                                   title='T', targets=targets)
+        self.assertEqual(files['OPS/content.opf'], b'opf 2.0 False')
+        self.assertIn(b'utm_source=amazon', files['OPS/a.xhtml'])
+
+        files = epub.render_target('epub3', content, env, 'OPS', tracked,
+                                   title='T', targets=targets,
+                                   doctype=doctype.decode('ascii'))
+        self.assertEqual(files['OPS/content.opf'], b'opf3 nav.xhtml')
+        self.assertEqual(files['OPS/nav.xhtml'], b'<!DOCTYPE html>\nnav nav')
+        self.assertTrue(files['OPS/a.xhtml'].startswith(b'<!DOCTYPE html>\n'))
+        self.assertEqual(epub.target_file('book.epub', 'epub3'),
+                         'book-epub3.epub')
+
+
+class RenderBookTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.epubdir = os.path.join(tmp.name, 'epub')
+        shutil.copytree(os.path.join(os.path.dirname(__file__), '..',
+                                     'example', 'epub'), self.epubdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.epubdir)
 
-    @patch('ipub.epub.utils.run_script', return_value=(
-            b'this should print as info', b'this should print as error'))
-    def test_init(self, run_script_mock):
-        target = 'target_dir'
-        call_args = ('cp', '-ar', params._EPUB_SKELETON_PATH, target)
-        epub.init(target)
-        self.assertEqual(run_script_mock.call_args[0], call_args)
+    def test_render_book(self):
+        before = sorted(os.listdir('.'))
+        books = epub.render_book('.', 'src', 'OPS', 'OPS/img', 'meta.yaml',
+                                 'mainmatter.yaml', '.', workers=1,
+                                 targets=['epub2', 'epub3'], persist=False)
+        self.assertEqual(sorted(books), ['epub2', 'epub3'])
+        self.assertEqual(sorted(os.listdir('.')), before)
+        files = books['epub2']
+        self.assertEqual(list(files)[:2], ['OPS/content.opf', 'OPS/toc.ncx'])
+        for i in range(1, 8):
+            page = files['OPS/cotw_{:02d}.xhtml'.format(i)]
+            self.assertIn(b'class="chapter-heading', page)
+            self.assertIn('cotw_{:02d}.xhtml'.format(i).encode('ascii'),
+                          files['OPS/content.opf'])
+        self.assertTrue(files['OPS/cotw_01.xhtml'].startswith(
+                b'<?xml version="1.0" encoding="UTF-8" ?>\n'
+                b'<!DOCTYPE html PUBLIC'))
+        nav = books['epub3']['OPS/nav.xhtml']
+        self.assertIn(b'<!DOCTYPE html>', nav)
+        self.assertIn(b'cotw_07.xhtml', nav)
+        self.assertIn(b'<!DOCTYPE html>',
+                      books['epub3']['OPS/cotw_01.xhtml'])
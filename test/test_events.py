@@ -0,0 +1,68 @@
+import unittest
+import os
+import json
+import socket
+import logging
+import tempfile
+
+from ipub import events
+from ipub import utils
+
+
+class EventsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(events.close_stream)
+
+    def read_events(self, path):
+        with open(path, 'r') as foi:
+            return [json.loads(l) for l in foi]
+
+    def test_file_stream(self):
+        path = os.path.join(self.tmp.name, 'events.jsonl')
+        target = os.path.join(self.tmp.name, 'a.txt')
+        events.emit('dropped')
+        events.open_stream(path)
+        with events.stage('write', writer='dir'):
+            utils.write_if_changed(target, 'abc')
+            utils.write_if_changed(target, 'abc')
+        with self.assertRaises(ValueError):
+            with events.stage('fail'):
+                raise ValueError()
+        events.close_stream()
+        evs = self.read_events(path)
+        self.assertEqual([e['event'] for e in evs],
+                         ['stage_start', 'file_written', 'file_skipped',
+                          'stage_end', 'stage_start', 'stage_end'])
+        self.assertEqual(evs[1]['path'], target)
+        self.assertEqual(evs[1]['bytes'], 3)
+        self.assertEqual(evs[3]['writer'], 'dir')
+        self.assertTrue(evs[3]['ok'])
+        self.assertFalse(evs[5]['ok'])
+
+    def test_socket_stream(self):
+        path = os.path.join(self.tmp.name, 'sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(server.close)
+        server.bind(path)
+        server.listen(1)
+        events.open_stream('unix:' + path)
+        conn, _ = server.accept()
+        self.addCleanup(conn.close)
+        events.emit('process', cmd='rtf2md.sh', duration=0.5)
+        events.close_stream()
+        data = b''
+        while not data.endswith(b'\n'):
+            data += conn.recv(4096)
+        rec = json.loads(data)
+        self.assertEqual(rec['event'], 'process')
+        self.assertEqual(rec['cmd'], 'rtf2md.sh')
+
+    def test_json_formatter(self):
+        record = logging.LogRecord('root', logging.WARNING, __file__, 1,
+                                   'no page data for %s', ('x',), None)
+        out = json.loads(events.JsonFormatter().format(record))
+        self.assertEqual(out['level'], 'warning')
+        self.assertEqual(out['message'], 'no page data for x')
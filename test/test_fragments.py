@@ -0,0 +1,85 @@
+import unittest
+import os
+import time
+import tempfile
+
+import jinja2 as j2
+
+from ipub import fragments, params
+
+
+class FragmentCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.templates = {
+                'base.jinja': '<p>{% block body %}{% endblock %}</p>',
+                'links.jinja': '{% extends "base.jinja" %}'
+                               '{% block body %}{{ author }}: '
+                               '{{ pg_meta.heading }}{% endblock %}',
+                'dynamic.jinja': '{% include pg_meta.tmpl %}'}
+        self.env = j2.Environment(loader=j2.DictLoader(self.templates))
+        self.cache = fragments.FragmentCache(self.tmp.name)
+
+    def test_render(self):
+        render = self.cache.render
+        self.assertEqual(render(self.env, 'links.jinja', author='A',
+                                title='T1', pg_meta={'heading': 'H'}),
+                         '<p>A: H</p>')
+        # `title` is not read by the templates:
+        self.assertEqual(render(self.env, 'links.jinja', author='A',
+                                title='T2', pg_meta={'heading': 'H'}),
+                         '<p>A: H</p>')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(render(self.env, 'links.jinja', author='B',
+                                pg_meta={'heading': 'H'}), '<p>B: H</p>')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+        # changed base template:
+        self.templates['base.jinja'] = ('<div>{% block body %}'
+                                        '{% endblock %}</div>')
+        cache = fragments.FragmentCache(self.tmp.name)
+        self.assertEqual(cache.render(self.env, 'links.jinja', author='A',
+                                      pg_meta={'heading': 'H'}),
+                         '<div>A: H</div>')
+        self.assertEqual(cache.misses, 1)
+
+    def test_default_fallback(self):
+        env = j2.Environment(loader=j2.FileSystemLoader(
+                params._TEMPLATE_PATH), trim_blocks=True, lstrip_blocks=True)
+        pg = {'id': 'bye', 'heading': 'Thank You', 'parting': '<p>Bye</p>',
+              'links': [{'text': 'More', 'url': 'https://example.com/'}]}
+        first = self.cache.render(env, 'bye_links.jinja', title='Book One',
+                                  pg_meta=pg, header_title=pg['heading'])
+        self.assertIn('<title>Thank You</title>', first)
+        # `title` is only the fallback of `header_title` in xhtml_skeleton:
+        self.assertEqual(self.cache.render(env, 'bye_links.jinja',
+                                           title='Book Two', pg_meta=pg,
+                                           header_title=pg['heading']),
+                         first)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertIn('<title>Book Two</title>', self.cache.render(
+                env, 'bye_links.jinja', title='Book Two', pg_meta=pg))
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_uncacheable(self):
+        self.assertIsNone(self.cache.template_info(self.env,
+                                                   'dynamic.jinja'))
+        self.assertEqual(self.cache.render(self.env, 'dynamic.jinja',
+                                           pg_meta={'tmpl': 'base.jinja'}),
+                         '<p></p>')
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_evict(self):
+        for i in range(4):
+            self.cache.render(self.env, 'links.jinja', author=str(i) * 100,
+                              pg_meta={})
+            # distinct mtimes for LRU order
+            time.sleep(0.01)
+        self.cache.max_bytes = 250
+        self.assertEqual(self.cache.evict(), 2)
+        self.assertEqual(self.cache.render(self.env, 'links.jinja',
+                                           author='3' * 100, pg_meta={}),
+                         '<p>{}: </p>'.format('3' * 100))
+        self.assertEqual(self.cache.hits, 1)
@@ -0,0 +1,115 @@
+import unittest
+import unittest.mock
+import os
+import io
+import struct
+import tempfile
+from hashlib import sha1
+
+from ipub import img
+from ipub import params
+
+
+class SniffTest(unittest.TestCase):
+
+    def test_formats(self):
+        png = b'\x89PNG\r\n\x1a\n' + b'\x00\x00\x00\rIHDR' + \
+                struct.pack('>II', 640, 480)
+        self.assertEqual(img.inspect(png)['format'], 'png')
+        self.assertEqual(img.dimensions(png, 'png'), (640, 480))
+        gif = b'GIF89a' + struct.pack('<HH', 32, 16)
+        self.assertEqual(img.dimensions(gif, img.sniff_format(gif)),
+                         (32, 16))
+        svg = b'<?xml version="1.0"?>\n<svg width="120px" height="60">'
+        self.assertEqual(img.sniff_format(svg), 'svg+xml')
+        self.assertEqual(img.dimensions(svg, 'svg+xml'), (120, 60))
+        self.assertIsNone(img.sniff_format(b'just some text'))
+
+    def test_jpeg(self):
+        cover = os.path.join(params._EPUB_SKELETON_PATH, 'OPS/img/cover.jpg')
+        with open(cover, 'rb') as foi:
+            rec = img.inspect(foi.read())
+        self.assertEqual(rec['format'], 'jpeg')
+        self.assertEqual((rec['width'], rec['height']), (1800, 2700))
+        self.assertTrue(img.over_budget(rec, params._IMG_BUDGETS['compact']))
+
+
+def _png(width, height):
+    from PIL import Image
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 30, 30)).save(out, 'PNG')
+    return out.getvalue()
+
+
+_GIF = b'GIF89a' + struct.pack('<HH', 32, 16) + b'\x00' * 16
+
+
+class ProcessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = os.path.join(self.tmp.name, 'src')
+        self.cache = os.path.join(self.tmp.name, 'cache')
+        os.makedirs(os.path.join(self.src, 'maps', '.hidden'))
+        self.write('b.gif', _GIF)
+        self.write(os.path.join('maps', 'a.gif'), _GIF)
+        self.write(os.path.join('maps', '.hidden', 'c.gif'), _GIF)
+        self.write('notes.txt', b'not an image')
+
+    def write(self, rel_path, data):
+        with open(os.path.join(self.src, rel_path), 'wb') as foo:
+            foo.write(data)
+
+    def test_scan(self):
+        found = img.process(self.src, self.cache)
+        self.assertEqual([p for p, _, _ in found],
+                         ['b.gif', os.path.join('maps', 'a.gif')])
+        self.assertEqual(found[0][1]['format'], 'gif')
+        self.assertEqual((found[0][1]['width'], found[0][1]['height']),
+                         (32, 16))
+        self.assertEqual(found[1][2], _GIF)
+        self.assertEqual(found[1][2].path,
+                         os.path.join(self.src, 'maps', 'a.gif'))
+
+    def test_cache(self):
+        img.process(self.src, self.cache)
+        with unittest.mock.patch('ipub.img.inspect') as inspect:
+            found = img.process(self.src, self.cache)
+        # both GIFs share one cache entry, the text file is cached as well
+        inspect.assert_not_called()
+        self.assertEqual(len(found), 2)
+        # records of images that are gone are dropped:
+        os.remove(os.path.join(self.src, 'notes.txt'))
+        img.process(self.src, self.cache)
+        self.assertEqual(list(img.utils.load_json(os.path.join(
+                self.cache, 'images.json'))), [sha1(_GIF).hexdigest()])
+
+    def test_budget(self):
+        try:
+            import PIL
+        except ImportError:
+            self.skipTest('Pillow not installed')
+        big = _png(1600, 1200)
+        self.write('big.png', big)
+        # dry run: nothing cached
+        found = {p: (rec, data) for p, rec, data in img.process(
+                self.src, self.cache, budget='compact', workers=1,
+                persist=False)}
+        self.assertFalse(os.path.exists(self.cache))
+        rec, data = found['big.png']
+        self.assertEqual(rec['width'], 1600)
+        self.assertFalse(img.over_budget(img.inspect(data),
+                                         params._IMG_BUDGETS['compact']))
+        img.process(self.src, self.cache, budget='compact', workers=1)
+        opt_dir = os.path.join(self.cache, 'img')
+        self.assertEqual(len(os.listdir(opt_dir)), 1)
+        # cached optimized image is reused:
+        with unittest.mock.patch('ipub.img.optimize') as optimize:
+            found = img.process(self.src, self.cache, budget='compact')
+        optimize.assert_not_called()
+        self.assertEqual(dict((p, d) for p, _, d in found)['big.png'], data)
+        # stale optimized images are removed:
+        os.remove(os.path.join(self.src, 'big.png'))
+        img.process(self.src, self.cache, budget='compact')
+        self.assertEqual(os.listdir(opt_dir), [])
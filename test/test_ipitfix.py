@@ -0,0 +1,32 @@
+import unittest
+import os
+import tempfile
+
+from ipub import ipitfix
+
+
+class FixItalicsTest(unittest.TestCase):
+
+    def test_fix_italics(self):
+        lines = ['This is *an open\n', 'paragraph\n', '\n',
+                 'that closes* here.\n', 'Escaped \\* is *fine*.\n']
+        self.assertEqual(list(ipitfix.fix_italics(lines)), [
+            'This is *an open*\n*paragraph*\n\n*that closes* here.\n',
+            'Escaped \\* is *fine*.\n'])
+
+    def test_open_at_eof(self):
+        self.assertEqual(list(ipitfix.fix_italics(['*open\n', 'end\n'])),
+                         ['*open*\n*end*\n'])
+
+    def test_fix_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fixed = os.path.join(tmp, 'a.md')
+            clean = os.path.join(tmp, 'b.md')
+            with open(fixed, 'w') as foo:
+                foo.write('*open\n\nclosed*\n')
+            with open(clean, 'w') as foo:
+                foo.write('*closed*\n')
+            self.assertEqual(ipitfix.fix_files([fixed, clean], workers=1),
+                             [fixed])
+            with open(fixed, 'r') as foi:
+                self.assertEqual(foi.read(), '*open*\n\n*closed*\n')
@@ -0,0 +1,55 @@
+import unittest
+import os
+import tempfile
+import unittest.mock
+
+import yaml
+
+from ipub import latex
+
+
+class ChapterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for ch_id in ('a', 'b', 'b1'):
+            with open(os.path.join(self.tmp.name, ch_id + '.md'), 'w') as foo:
+                foo.write('Text of {}.\n\n* * *\n'.format(ch_id))
+        self.mm = [{'id': 'a', 'heading': 'A', 'type': 'chapter'},
+                   {'id': 'b', 'heading': 'B', 'type': 'chapter',
+                    'children': [{'id': 'b1', 'heading': 'B1',
+                                  'type': 'chapter'}]}]
+
+    def test_mm_chapters(self):
+        chapters = list(latex.mm_chapters(self.mm, self.tmp.name, 1))
+        self.assertEqual([c for c, _ in chapters], ['a', 'b'])
+        self.assertTrue(chapters[1][1].startswith('##B\n\nText of b.'))
+        self.assertIn('###B1\n\nText of b1.', chapters[1][1])
+        self.assertEqual(''.join(t for _, t in chapters),
+                         ''.join('{}\n\n'.format(s) for s in
+                                 latex.mm_gen(self.mm, self.tmp.name, 1)))
+        chapters = dict(latex.mm_chapters(self.mm, self.tmp.name, 0, True))
+        self.assertIn(r'\fancybreak', chapters['a'])
+
+    def test_mkbook_chapters(self):
+        tmpl_dir = os.path.join(self.tmp.name, 'tmpl')
+        os.makedirs(tmpl_dir)
+        with open(os.path.join(tmpl_dir, 'main.jinja'), 'w') as foo:
+            foo.write('<& title &>\n<% for ch in chapters %>'
+                      '\\include{<& ch &>}\n<% endfor %>')
+        with open(os.path.join(self.tmp.name, 'meta.yaml'), 'w') as foo:
+            yaml.safe_dump({'title': 'T'}, foo)
+        with open(os.path.join(self.tmp.name, 'mm.yaml'), 'w') as foo:
+            yaml.safe_dump(self.mm, foo)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmp.name)
+        latex.mmcat('mm.yaml', None, '.', chapterdir='chapters')
+        self.assertEqual(sorted(os.listdir('chapters')), ['a.md', 'b.md'])
+        with unittest.mock.patch('ipub.params._TEMPLATE_PATH', tmpl_dir), \
+                unittest.mock.patch('ipub.latex._TEX_ENV', None):
+            latex.mkbook('meta.yaml', 'book', 'main', '.', workers=1,
+                         mmyaml='mm.yaml', chapterdir='chapters')
+        with open('book.tex') as foi:
+            self.assertEqual(foi.read(), 'T\n\\include{chapters/a}\n'
+                                         '\\include{chapters/b}\n')
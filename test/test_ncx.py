@@ -0,0 +1,52 @@
+import unittest
+from io import BytesIO
+import xml.etree.ElementTree as ET
+
+from ipub import ncx
+from ipub import epub
+
+
+NCX = b"""<?xml version="1.0" encoding="utf-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <docTitle><text>Book</text></docTitle>
+  <navMap>
+    <navPoint id="one" playOrder="1">
+      <navLabel><text>One</text></navLabel>
+      <content src="one.xhtml"/>
+      <navPoint id="one_a" playOrder="2">
+        <navLabel><text>One A</text></navLabel>
+        <content src="one.xhtml#a"/>
+      </navPoint>
+    </navPoint>
+    <navPoint id="two" playOrder="3">
+      <navLabel><text>Two</text></navLabel>
+      <content src="two.xhtml"/>
+    </navPoint>
+  </navMap>
+</ncx>
+"""
+
+
+class NcxTest(unittest.TestCase):
+
+    def test_iter_navpoints(self):
+        self.assertEqual(list(ncx.iter_navpoints(BytesIO(NCX))), [
+            (1, 'one', 'One', 'one.xhtml'),
+            (2, 'one_a', 'One A', 'one.xhtml#a'),
+            (1, 'two', 'Two', 'two.xhtml')])
+
+    def test_navMap2dict(self):
+        nav_map = ET.fromstring(NCX).find(
+                '{http://www.daisy.org/z3986/2005/ncx/}navMap')
+        mm = epub.navMap2dict(nav_map, headings=True, hoffset=-1)
+        self.assertEqual([m['heading'] for m in mm], ['One', 'Chapter Two'])
+        self.assertEqual(mm[0]['children'][0]['heading'], 'Chapter One')
+        self.assertNotIn('children', mm[1])
+
+    def test_html2md(self):
+        html = ('<html><head><title>x</title></head><body><h2>One</h2>'
+                '<p>Some <em>italic</em> text_</p><hr/>'
+                '<h3 id="a">Part A</h3><p>More<br/>text</p></body></html>')
+        self.assertEqual(ncx.html2md(html, ['one'], ['a']), {
+            None: 'Some *italic* text\\_\n\n* * *\n',
+            'a': '### Part A\n\nMore  \ntext\n'})
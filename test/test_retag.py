@@ -0,0 +1,81 @@
+import unittest
+import os
+import tempfile
+import zipfile
+
+from ipub import retag, writers
+
+
+_PAGE = (b'<html><body><a href="https://shop.example.com/b?utm_source=x">'
+         b'b</a> <a href="https://other.example.com/">o</a></body></html>')
+
+
+class RetagTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cat = os.path.join(self.tmp.name, 'cat')
+        os.makedirs(os.path.join(self.cat, 'sub'))
+        files = {'OPS/links.xhtml': _PAGE,
+                 'OPS/ch1.xhtml': b'<html><body>text</body></html>' * 50,
+                 'OPS/img/a.jpg': b'\xff\xd8' + bytes(range(256))}
+        for name in ('a', os.path.join('sub', 'b')):
+            writers.write_zip(files.items(), self.cat, name + '.epub')
+        self.url_re = r'https://shop\.example\.com/[^"]*'
+
+    def test_retag(self):
+        before = os.path.join(self.cat, 'a.epub')
+        with zipfile.ZipFile(before) as zf:
+            raw_before = {i.filename: (i.CRC, i.compress_size)
+                          for i in zf.infolist()}
+        self.assertEqual(retag.retag([self.cat], self.url_re,
+                                     {'utm_source': 'y', 'utm_campaign': 'c'},
+                                     workers=1), 2)
+        with zipfile.ZipFile(before) as zf:
+            self.assertIsNone(zf.testzip())
+            infos = zf.infolist()
+            self.assertEqual(infos[0].filename, 'mimetype')
+            self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual([i.filename for i in infos], list(raw_before))
+            for i in infos:
+                if i.filename != 'OPS/links.xhtml':
+                    self.assertEqual((i.CRC, i.compress_size),
+                                     raw_before[i.filename])
+            self.assertIn(b'href="https://shop.example.com/b?utm_source=y'
+                          b'&amp;utm_campaign=c"', zf.read('OPS/links.xhtml'))
+            self.assertIn(b'href="https://other.example.com/"',
+                          zf.read('OPS/links.xhtml'))
+        # nothing left to change:
+        mtime = os.path.getmtime(before)
+        self.assertEqual(retag.retag([before], self.url_re,
+                                     {'utm_source': 'y', 'utm_campaign': 'c'}),
+                         0)
+        self.assertEqual(os.path.getmtime(before), mtime)
+
+    def test_outdir(self):
+        out = os.path.join(self.tmp.name, 'out')
+        src = os.path.join(self.cat, 'sub', 'b.epub')
+        with open(src, 'rb') as foi:
+            orig = foi.read()
+        retag.retag([src], self.url_re, {'utm_source': 'z'}, outdir=out)
+        with open(src, 'rb') as foi:
+            self.assertEqual(foi.read(), orig)
+        with zipfile.ZipFile(os.path.join(out, 'b.epub')) as zf:
+            self.assertIn(b'?utm_source=z"', zf.read('OPS/links.xhtml'))
+
+    def test_outdir_tree(self):
+        out = os.path.join(self.tmp.name, 'out')
+        writers.write_zip({'OPS/links.xhtml': _PAGE}.items(), self.cat,
+                          os.path.join('sub', 'a.epub'))
+        self.assertEqual(retag.retag([self.cat], self.url_re,
+                                     {'utm_source': 'z'}, outdir=out,
+                                     workers=2), 3)
+        found = sorted(os.path.relpath(os.path.join(d, f), out)
+                       for d, _, files in os.walk(out) for f in files)
+        self.assertEqual(found, ['a.epub', os.path.join('sub', 'a.epub'),
+                                 os.path.join('sub', 'b.epub')])
+        with self.assertRaises(ValueError):
+            retag.retag([os.path.join(self.cat, 'a.epub'),
+                         os.path.join(self.cat, 'sub', 'a.epub')],
+                        self.url_re, {'utm_source': 'z'}, outdir=out)
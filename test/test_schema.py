@@ -0,0 +1,88 @@
+import unittest
+import os
+import tempfile
+import pickle
+
+import jinja2 as j2
+
+from ipub import schema
+
+
+class PageTest(unittest.TestCase):
+
+    def test_page(self):
+        pg = schema.Page({'id': 'a', 'type': 'chapter', 'beg_raw': 'x'})
+        self.assertEqual(pg.id, 'a')
+        self.assertEqual(pg['beg_raw'], 'x')
+        self.assertEqual(pg.extra, {'beg_raw': 'x'})
+        self.assertNotIn('heading', pg)
+        self.assertIsNone(pg.get('heading'))
+        self.assertEqual(dict(pg), {'id': 'a', 'type': 'chapter',
+                                    'beg_raw': 'x'})
+        copy = pg.copy()
+        copy['heading'] = 'A'
+        self.assertNotIn('heading', pg)
+        self.assertEqual(pickle.loads(pickle.dumps(copy)), copy)
+        tmpl = j2.Template('{{ pg.id }}|{{ pg.beg_raw }}|'
+                           '{{ pg.heading is defined }}')
+        self.assertEqual(tmpl.render(pg=pg), 'a|x|False')
+
+    def test_tree(self):
+        data = [{'id': 'a', 'type': 'chapter',
+                 'children': [{'id': 'b', 'type': 'chapter', 'x': 1,
+                               'children': [{'id': 'c',
+                                             'type': 'chapter'}]}]}]
+        pages = schema.load_pages(schema.dump_pages(
+                [schema.Page.from_dict(d) for d in data]))
+        self.assertEqual([pg.to_dict() for pg in pages], data)
+        a = pages[0]
+        b, = a.children
+        c, = b.children
+        self.assertIsInstance(a.children, tuple)
+        self.assertEqual([pg.id for pg in a.walk()], ['a', 'b', 'c'])
+        self.assertEqual([a.depth, b.depth, c.depth], [1, 2, 3])
+        self.assertIs(c.parent, b)
+        self.assertIsNone(a.parent)
+        # re-parenting resets the depth:
+        a.children = [c]
+        self.assertIs(c.parent, a)
+        self.assertEqual(c.depth, 2)
+
+
+class ValidateTest(unittest.TestCase):
+
+    def test_valid(self):
+        meta = {'title': 'T', 'frontmatter': [
+            {'id': 'toc', 'type': 'Template', 'heading': 1, 'no_toc': 1}]}
+        meta, mm = schema.validate(meta, [{'id': 2, 'type': 'chapter',
+                                           'children': []}])
+        toc = meta['frontmatter'][0]
+        self.assertIsInstance(toc, schema.Page)
+        self.assertEqual((toc.type, toc.heading, toc.no_toc),
+                         ('template', '1', True))
+        self.assertEqual(mm[0].id, '2')
+        self.assertNotIn('children', mm[0])
+
+    def test_errors(self):
+        meta = {'frontmatter': [{'id': 'a', 'type': 'template',
+                                 'template': 'no_such_template'}],
+                'backmatter': [{'type': 'static'}, 'not a page']}
+        mm = [{'id': 'a', 'type': 'chaptr', 'hedaing': 'x'},
+              {'id': 'b', 'type': 'chapter',
+               'children': [{'id': 'c', 'type': 'chapter'}]}]
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'b.md'), 'w') as foo:
+                foo.write('text')
+            with self.assertRaises(schema.SchemaError) as cm:
+                schema.validate(meta, mm, tmp, '.')
+        problems = [(s, m) for s, _, m in cm.exception.problems]
+        self.assertIn(('error', "missing 'title'"), problems)
+        self.assertIn(('error', "missing 'id'"), problems)
+        self.assertIn(('error', 'page must be a mapping'), problems)
+        self.assertIn(('error', 'duplicate page id'), problems)
+        self.assertIn(('warning', "unknown key 'hedaing' (did you mean "
+                       "'heading'?)"), problems)
+        self.assertEqual(len([m for _, m in problems
+                              if m.startswith('source file')]), 1)
+        self.assertEqual(len([m for _, m in problems
+                              if m.startswith('template')]), 1)
@@ -0,0 +1,311 @@
+import unittest
+import os
+import io
+import tempfile
+import unittest.mock
+
+import yaml
+
+from ipub import scriv, schema, search
+
+
+_SCRIVX = """<?xml version="1.0" encoding="UTF-8"?>
+<ScrivenerProject>
+  <Binder>
+    <BinderItem ID="0" Type="DraftFolder">
+      <Title>Manuscript</Title>
+      <MetaData><IncludeInCompile>Yes</IncludeInCompile></MetaData>
+      <Children>
+        <BinderItem ID="5" Type="Text">
+          <Title>Into the Primitive</Title>
+          <MetaData>
+            <LabelID>1</LabelID><StatusID>2</StatusID>
+            <IncludeInCompile>Yes</IncludeInCompile>
+          </MetaData>
+          <Keywords><KeywordID>0</KeywordID><KeywordID>7</KeywordID></Keywords>
+        </BinderItem>
+        <BinderItem ID="6" Type="Text">
+          <Title>The Law of Club and Fang</Title>
+          <MetaData>
+            <LabelID>-1</LabelID><IncludeInCompile>Yes</IncludeInCompile>
+          </MetaData>
+        </BinderItem>
+        <BinderItem ID="7" Type="Text">
+          <Title>Notes</Title>
+          <MetaData><IncludeInCompile>No</IncludeInCompile></MetaData>
+        </BinderItem>
+      </Children>
+    </BinderItem>
+  </Binder>
+  <LabelSettings>
+    <Labels>
+      <Label ID="-1">No Label</Label><Label ID="1">Chapter</Label>
+    </Labels>
+  </LabelSettings>
+  <StatusSettings>
+    <StatusItems>
+      <Status ID="-1">No Status</Status><Status ID="2">First Draft</Status>
+    </StatusItems>
+  </StatusSettings>
+  <Keywords>
+    <Keyword ID="0"><Title>Buck</Title></Keyword>
+  </Keywords>
+</ScrivenerProject>
+"""
+
+
+class ScrivxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.proj = self.tmp.name
+        with open(os.path.join(self.proj, 'project.scrivx'), 'w') as foo:
+            foo.write(_SCRIVX)
+        self.docs = os.path.join(self.proj, 'Files', 'Docs')
+        os.makedirs(self.docs)
+        for name in ('5.rtf', '6.rtf', '7.rtf', '7_notes.rtf'):
+            open(os.path.join(self.docs, name), 'w').close()
+
+    def to_yaml(self, synopsis=False, scrivxml='project.scrivx',
+                rtfdir='Files/Docs'):
+        out = io.StringIO()
+        out.close = lambda: None
+        scriv.to_yaml(self.proj, scrivxml, rtfdir, 'Manuscript', None,
+                      'chapter', 0, False, out, synopsis)
+        return yaml.safe_load(out.getvalue())
+
+    def test_project_meta(self):
+        pages = self.to_yaml()
+        self.assertEqual([pg['id'] for pg in pages],
+                         ['into_the_primitive', 'the_law_of_club_and_fang'])
+        self.assertEqual(pages[0]['scrivLabel'], 'Chapter')
+        self.assertEqual(pages[0]['scrivStatus'], 'First Draft')
+        self.assertEqual(pages[0]['scrivKeywords'], ['Buck', '7'])
+        self.assertNotIn('scrivLabel', pages[1])
+        self.assertNotIn('scrivKeywords', pages[1])
+        self.assertEqual(pages[1]['rtf_src'], os.path.join('Files', 'Docs',
+                                                           '6.rtf'))
+
+    def test_chapters_in_place(self):
+        chapters = [{'scrivID': '5', 'scrivType': 'Text',
+                     'scrivTitle': 'Into the Primitive',
+                     'children': [{'scrivID': '6', 'scrivType': 'Text',
+                                   'scrivTitle': 'Club & Fang'}]}]
+        self.assertIs(scriv.chapters_to_dict(chapters, in_place=True),
+                      chapters)
+        self.assertEqual(chapters[0]['id'], 'into_the_primitive')
+        self.assertEqual(chapters[0]['children'][0]['rtf_src'],
+                         os.path.join('Files/Docs', '6.rtf'))
+        self.assertNotIn('scrivID', chapters[0])
+        pages = scriv.chapters_to_dict([{'scrivID': '7', 'scrivType': 'Text',
+                                         'scrivTitle': 'Notes'}])
+        self.assertIsInstance(pages[0], schema.Page)
+
+    def test_index(self):
+        self.assertEqual(scriv.project_format(self.proj), 2)
+        index = scriv.index_binder(self.proj, 'Files/Docs', 2)
+        self.assertEqual(index['7'], {
+                'content': os.path.join('Files/Docs', '7.rtf'),
+                'notes': os.path.join('Files/Docs', '7_notes.rtf')})
+
+    def test_scrivener3(self):
+        uuids = ('A1B2-5', 'A1B2-6')
+        with open(os.path.join(self.proj, 'project.scrivx')) as foi:
+            scrivx = foi.read()
+        scrivx = scrivx.replace('ID="5"', 'UUID="{}"'.format(uuids[0]))
+        scrivx = scrivx.replace('ID="6"', 'UUID="{}"'.format(uuids[1]))
+        os.remove(os.path.join(self.proj, 'project.scrivx'))
+        with open(os.path.join(self.proj, 'Novel.scrivx'), 'w') as foo:
+            foo.write(scrivx)
+        data = os.path.join(self.proj, 'Files', 'Data')
+        for uuid in uuids:
+            os.makedirs(os.path.join(data, uuid))
+            open(os.path.join(data, uuid, 'content.rtf'), 'w').close()
+        with open(os.path.join(data, uuids[1], 'synopsis.txt'), 'w') as foo:
+            foo.write('subheading: Club and Fang\n')
+        self.assertEqual(scriv.project_format(self.proj), 3)
+        pages = self.to_yaml(synopsis=True, scrivxml=None, rtfdir=None)
+        self.assertEqual([pg['rtf_src'] for pg in pages],
+                         [os.path.join('Files/Data', u, 'content.rtf')
+                          for u in uuids])
+        self.assertEqual(pages[1]['subheading'], 'Club and Fang')
+        self.assertEqual(scriv.synopsis_file('p', pages[1]['rtf_src']),
+                         os.path.join('p', 'Files/Data', uuids[1],
+                                      'synopsis.txt'))
+
+    def test_nested_folders(self):
+        scrivx = _SCRIVX.replace(
+                '<BinderItem ID="5" Type="Text">',
+                '<BinderItem ID="3" Type="Folder"><Title>Part One</Title>'
+                '<MetaData><IncludeInCompile>Yes</IncludeInCompile>'
+                '</MetaData><Children>'
+                '<BinderItem ID="4" Type="Folder"><Title>Book One</Title>'
+                '<MetaData><IncludeInCompile>Yes</IncludeInCompile>'
+                '</MetaData><Children>'
+                '<BinderItem ID="5" Type="Text">', 1).replace(
+                '</BinderItem>\n        <BinderItem ID="6"',
+                '</BinderItem></Children></BinderItem></Children>'
+                '</BinderItem>\n        <BinderItem ID="6"', 1)
+        with open(os.path.join(self.proj, 'project.scrivx'), 'w') as foo:
+            foo.write(scrivx)
+        pages = self.to_yaml()
+        self.assertEqual([pg['id'] for pg in pages],
+                         ['part_one', 'the_law_of_club_and_fang'])
+        self.assertNotIn('rtf_src', pages[0])
+        self.assertNotIn('rtf_src', pages[0]['children'][0])
+        mmyaml = os.path.join(self.proj, 'mm.yaml')
+        with open(mmyaml, 'w') as foo:
+            yaml.safe_dump(pages, foo)
+        mddir = os.path.join(self.proj, 'md')
+        os.makedirs(mddir)
+        with unittest.mock.patch('sys.stdout', new=io.StringIO()) as out:
+            scriv.to_md(mmyaml, self.proj, mddir, report=True)
+        self.assertEqual(out.getvalue().splitlines(), [
+                'new\tinto_the_primitive\t' + os.path.join(
+                        'Files', 'Docs', '5.rtf'),
+                'new\tthe_law_of_club_and_fang\t' + os.path.join(
+                        'Files', 'Docs', '6.rtf')])
+
+    def test_synopsis(self):
+        with open(os.path.join(self.docs, '5_synopsis.txt'), 'w') as foo:
+            foo.write('heading: Chapter I\nintrolines: 2\n')
+        pages = self.to_yaml(synopsis=True)
+        self.assertEqual(pages[0]['heading'], 'Chapter I')
+        self.assertEqual(pages[0]['introlines'], 2)
+        self.assertEqual(pages[1]['heading'], '')
+
+    def test_synopsis_errors(self):
+        with open(os.path.join(self.docs, '5_synopsis.txt'), 'w') as foo:
+            foo.write('heading: [Chapter I\n')
+        with open(os.path.join(self.docs, '6_synopsis.txt'), 'w') as foo:
+            foo.write('id: law\n')
+        with self.assertRaises(schema.SchemaError) as cm:
+            self.to_yaml(synopsis=True)
+        problems = cm.exception.problems
+        self.assertEqual(len(problems), 2)
+        self.assertIn('invalid YAML', problems[0][2])
+        self.assertIn("reserved key(s) 'id'", problems[1][2])
+
+
+_RTF = (rb'{\rtf1\ansi\ansicpg1252\cocoartf1038\cocoasubrtf360'
+        b'\n'
+        rb'{\fonttbl\f0\fnil\fcharset0 Palatino-Roman;}'
+        rb'{\info{\author A}{\revtim\yr2016\mo3\dy1}}'
+        rb'{\*\rsidtbl \rsid123\rsid456}'
+        b'\n'
+        rb'\f0\fs26 \insrsid123 Buck did not read the \i newspapers\i0 .\
+'
+        rb'Next paragraph \{braces\}.}')
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def test_fingerprint(self):
+        fp = scriv.rtf_fingerprint(_RTF)
+        volatile = (_RTF.replace(b'cocoartf1038', b'cocoartf1504')
+                    .replace(b'yr2016', b'yr2017')
+                    .replace(b'rsid123', b'rsid789')
+                    .replace(b'\n', b'\r\n'))
+        self.assertEqual(scriv.rtf_fingerprint(volatile), fp)
+        self.assertNotEqual(scriv.rtf_fingerprint(
+                _RTF.replace(b'\\i newspapers\\i0', b'newspapers')), fp)
+        self.assertNotEqual(scriv.rtf_fingerprint(
+                _RTF.replace(b'.\\\n', b'.\n')), fp)
+
+    def test_to_md(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            docs = os.path.join(tmp, 'Files', 'Docs')
+            mddir = os.path.join(tmp, 'src')
+            os.makedirs(docs)
+            os.makedirs(mddir)
+            pages = [{'id': 'ch1', 'type': 'chapter',
+                      'rtf_src': 'Files/Docs/5.rtf'},
+                     {'id': 'ch2', 'type': 'chapter',
+                      'rtf_src': 'Files/Docs/6.rtf'}]
+            mmyaml = os.path.join(tmp, 'mm.yaml')
+            with open(mmyaml, 'w') as foo:
+                yaml.safe_dump(pages, foo)
+            for name in ('5.rtf', '6.rtf'):
+                with open(os.path.join(docs, name), 'wb') as foo:
+                    foo.write(_RTF.replace(b'Buck', name.encode('ascii')))
+            for pg in pages:
+                open(os.path.join(mddir, pg['id'] + '.md'), 'w').close()
+            fps = {pg['id']: scriv.rtf_fingerprint(
+                           open(os.path.join(tmp, pg['rtf_src']), 'rb').read())
+                   for pg in pages}
+            fps['ch0'] = 'x'
+            scriv.utils.save_json(os.path.join(mddir, '.scriv2md.json'), fps)
+            index = os.path.join(tmp, 'index.db')
+            # Scrivener autosave: same text, new revision info
+            with open(os.path.join(docs, '5.rtf'), 'wb') as foo:
+                foo.write(_RTF.replace(b'Buck', b'5.rtf')
+                          .replace(b'yr2016', b'yr2020'))
+            with open(os.path.join(docs, '6.rtf'), 'wb') as foo:
+                foo.write(_RTF.replace(b'Buck', b'Spitz'))
+            with unittest.mock.patch('sys.stdout', new=io.StringIO()) as out:
+                self.assertEqual(scriv.to_md(mmyaml, tmp, mddir,
+                                             report=True), 0)
+            self.assertEqual(out.getvalue(),
+                             'changed\tch2\tFiles/Docs/6.rtf\nremoved\tch0\n')
+            with self.assertRaises(ValueError):
+                scriv.to_md(mmyaml, tmp, mddir, search_index=index)
+            def rtf2md(cmd, infile, out):
+                if infile.endswith('6.rtf'):
+                    return b'*Spitz\n\nfought*\n', None
+                return b'Buck\n', None
+
+            # switching on fixit converts all chapters again:
+            with unittest.mock.patch('ipub.utils.run_script',
+                                     side_effect=rtf2md) as run:
+                self.assertEqual(scriv.to_md(mmyaml, tmp, mddir, fixit=True,
+                                             search_index=index,
+                                             search_book='Wild'), 2)
+            self.assertEqual(run.call_count, 2)
+            self.assertEqual([(r['book'], r['page'])
+                              for r in search.search(index, 'Spitz')],
+                             [('Wild', 'ch2')])
+            self.assertEqual(len(search.search(index)), 2)
+            with open(os.path.join(mddir, 'ch2.md')) as foi:
+                fixed = foi.read()
+            self.assertEqual(fixed, '*Spitz*\n\n*fought*\n')
+            # the index holds the fixed text:
+            indexer = search.SearchIndex(index, 'Wild')
+            self.assertFalse(indexer.add('ch2', None, fixed))
+            indexer.close()
+            with unittest.mock.patch('ipub.utils.run_script') as run:
+                self.assertEqual(scriv.to_md(mmyaml, tmp, mddir,
+                                             fixit=True), 0)
+            run.assert_not_called()
+
+    def test_to_md_failure(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'src'))
+            mmyaml = os.path.join(tmp, 'mm.yaml')
+            with open(mmyaml, 'w') as foo:
+                yaml.safe_dump([{'id': 'ch1', 'type': 'chapter',
+                                 'rtf_src': '5.rtf'},
+                                {'id': 'ch2', 'type': 'chapter',
+                                 'rtf_src': '6.rtf'}], foo)
+            with open(os.path.join(tmp, '5.rtf'), 'wb') as foo:
+                foo.write(_RTF)
+            mdfile = os.path.join(tmp, 'src', 'ch1.md')
+            with open(mdfile, 'w') as foo:
+                foo.write('Buck\n')
+            fps = os.path.join(tmp, 'fps.json')
+            index = os.path.join(tmp, 'index.db')
+            stats_file = os.path.join(tmp, 'stats.json')
+            with unittest.mock.patch('ipub.utils.run_script',
+                                     return_value=(b'', b'failed')), \
+                    unittest.mock.patch('ipub.ipitfix.fix_files') as fix:
+                self.assertEqual(scriv.to_md(
+                        mmyaml, tmp, os.path.dirname(mdfile), fixit=True,
+                        fingerprints=fps, search_index=index,
+                        search_book='Wild', stats_file=stats_file), 0)
+            fix.assert_not_called()
+            with open(mdfile) as foi:
+                self.assertEqual(foi.read(), 'Buck\n')
+            self.assertEqual(scriv.utils.load_json(fps, None), {})
+            # 6.rtf missing: no Markdown, no stats
+            self.assertEqual(list(scriv.utils.load_json(stats_file, None)[
+                    'pages']), ['ch1'])
@@ -0,0 +1,66 @@
+import unittest
+import os
+import tempfile
+
+from ipub import search
+
+
+_CH1 = """heading: Into the Primitive
+
+Buck did not read the newspapers.
+
+* * *
+
+He lived at a big house in the sun-kissed Santa Clara Valley.
+"""
+_CH2 = """Spitz was a practised fighter. Buck had never fought Spitz before.
+"""
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'index.db')
+        index = search.SearchIndex(self.path, 'Wild')
+        index.add('ch1', 'Into the Primitive', _CH1)
+        index.add('ch2', None, _CH2)
+        index.close()
+        index = search.SearchIndex(self.path, 'Fang')
+        index.add('ch1', None, 'White Fang met Buck once.')
+        index.close()
+
+    def pages(self, *args, **kwargs):
+        return [(r['book'], r['page'])
+                for r in search.search(self.path, *args, **kwargs)]
+
+    def test_search(self):
+        self.assertEqual(sorted(self.pages('Buck')),
+                         [('Fang', 'ch1'), ('Wild', 'ch1'), ('Wild', 'ch2')])
+        self.assertEqual(self.pages('Buck', book='Wild', breaks=True),
+                         [('Wild', 'ch1')])
+        self.assertEqual(self.pages('"santa clara"'), [('Wild', 'ch1')])
+        # metadata is not indexed as text, headings are:
+        self.assertEqual(self.pages('heading'), [])
+        self.assertEqual(self.pages('primitive'), [('Wild', 'ch1')])
+        result = search.search(self.path, 'newspapers')[0]
+        self.assertEqual(result['breaks'], 1)
+        self.assertIn('[newspapers]', result['snippet'])
+        self.assertEqual(self.pages(book='Wild'),
+                         [('Wild', 'ch1'), ('Wild', 'ch2')])
+        with self.assertRaises(search.SearchError):
+            search.search(self.path, 'AND AND')
+        with self.assertRaises(search.SearchError):
+            search.search(os.path.join(self.tmp.name, 'none.db'), 'Buck')
+
+    def test_update(self):
+        index = search.SearchIndex(self.path, 'Wild')
+        self.assertFalse(index.add('ch1', 'Into the Primitive', _CH1))
+        self.assertTrue(index.add('ch3', None, 'Buck and John Thornton.'))
+        self.assertEqual(index.prune(), 1)
+        index.close()
+        self.assertEqual(sorted(self.pages('Buck', book='Wild')),
+                         [('Wild', 'ch1'), ('Wild', 'ch3')])
+        self.assertEqual(self.pages('Spitz'), [])
+        self.assertEqual(self.pages('Fang'), [('Fang', 'ch1')])
@@ -0,0 +1,33 @@
+import unittest
+
+from ipub import stats
+
+
+class StatsTest(unittest.TestCase):
+
+    md_text = ('title: Some title\n'
+               'heading: Chapter One\n'
+               '\n'
+               '# Heading\n'
+               '\n'
+               'Some *italics* and **bold**, \\*not\\* [a link](http://x).\n'
+               '\n'
+               '* * *\n'
+               '\n'
+               '> quoted *across\n'
+               'lines* here\n')
+
+    def test_text_stats(self):
+        self.assertEqual(stats.text_stats(self.md_text),
+                         {'words': 11, 'chars': 60, 'paragraphs': 2,
+                          'breaks': 1, 'italics': 2})
+        self.assertEqual(stats.strip_meta('no: meta\n'), '')
+        self.assertEqual(stats.strip_meta('Plain text.\n'), 'Plain text.\n')
+
+    def test_totals(self):
+        tot = stats.totals([{'words': 600, 'bytes': 10},
+                            {'words': 100, 'bytes': 5}, {'bytes': 1}])
+        self.assertEqual(tot['words'], 700)
+        self.assertEqual(tot['bytes'], 16)
+        self.assertEqual(tot['chapters'], 2)
+        self.assertEqual(tot['reading_minutes'], 3)
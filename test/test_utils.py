@@ -1,5 +1,9 @@
 import unittest
+import unittest.mock
 import re
+import os
+import tempfile
+import pickle
 from urllib.parse import urlparse, parse_qsl, unquote_plus
 
 from ipub import utils
@@ -71,6 +75,89 @@ class UrlQueryTest(unittest.TestCase):
             self.assertEqual(Url(actual), Url(expected))
 
 
+class WriteIfChangedTest(unittest.TestCase):
+
+    def test_write_if_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'out.xhtml')
+            self.assertTrue(utils.write_if_changed(path, 'some text'))
+            os.utime(path, (0, 0))
+            self.assertFalse(utils.write_if_changed(path, b'some text'))
+            self.assertEqual(os.stat(path).st_mtime, 0)
+            self.assertTrue(utils.write_if_changed(path, 'other text'))
+            with open(path, 'r') as foi:
+                self.assertEqual(foi.read(), 'other text')
+            self.assertEqual(os.listdir(tmp), ['out.xhtml'])
+            # new files get the default permissions:
+            plain = os.path.join(tmp, 'plain.xhtml')
+            open(plain, 'w').close()
+            new = os.path.join(tmp, 'new.xhtml')
+            with unittest.mock.patch('os.umask') as umask:
+                utils.write_if_changed(new, 'text')
+            umask.assert_not_called()
+            self.assertEqual(os.stat(new).st_mode, os.stat(plain).st_mode)
+
+
+class PlaceFileTest(unittest.TestCase):
+
+    def test_place_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp, 'src.xhtml')
+            with open(src, 'w') as foo:
+                foo.write('<a href="http://example.com/x">x</a>')
+            data = utils.read_file(src)
+            self.assertEqual(pickle.loads(pickle.dumps(data)).path, src)
+            self.assertIs(type(data.replace(b'x', b'y')), bytes)
+            dst = os.path.join(tmp, 'dst.xhtml')
+            self.assertTrue(utils.place_file(data, dst, 'hard'))
+            self.assertTrue(os.path.samefile(src, dst))
+            self.assertFalse(utils.place_file(data, dst))
+            # copying over a hardlink leaves the source alone:
+            os.chmod(dst, 0o640)
+            data = utils.FileData(b'<p>new</p>', src)
+            with unittest.mock.patch('shutil.copyfile',
+                                     side_effect=OSError('disk full')):
+                with self.assertRaises(OSError):
+                    utils.place_file(data, dst)
+            self.assertTrue(os.path.samefile(src, dst))
+            other = os.path.join(tmp, 'other.xhtml')
+            with open(other, 'w') as foo:
+                foo.write('<p>other</p>')
+            self.assertTrue(utils.place_file(utils.read_file(other), dst))
+            self.assertFalse(os.path.samefile(src, dst))
+            with open(dst) as foi:
+                self.assertEqual(foi.read(), '<p>other</p>')
+            self.assertEqual(os.stat(dst).st_mode & 0o777, 0o640)
+            with open(src) as foi:
+                self.assertIn('example.com', foi.read())
+            self.assertEqual(sorted(os.listdir(tmp)),
+                             ['dst.xhtml', 'other.xhtml', 'src.xhtml'])
+            data = utils.read_file(src)
+            self.assertEqual(
+                    utils.mk_query_urls(data, r'http://example\.com[^"]*',
+                                        {'utm_source': 'a'}),
+                    b'<a href="http://example.com/x?utm_source=a">x</a>')
+
+
+class PageDataTest(unittest.TestCase):
+
+    def test_find_page_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            incl = os.path.join(tmp, 'incl')
+            os.mkdir(incl)
+            for dirname, value in ((tmp, 'top'), (incl, 'incl')):
+                with open(os.path.join(dirname, 'blurb.yaml'), 'w') as foo:
+                    foo.write('value: {}\n'.format(value))
+            pg = {'id': 'books', 'yaml': 'blurb'}
+            self.assertEqual(utils.find_page_data(pg, {}, [tmp, incl]),
+                             {'value': 'incl'})
+            self.assertEqual(utils.find_page_data(pg, {}, [tmp]),
+                             {'value': 'top'})
+            self.assertEqual(utils.find_page_data(pg, {'books': [1]}, [tmp]),
+                             [1])
+            self.assertIsNone(utils.find_page_data({'id': 'x'}, {}, [tmp]))
+
+
 class RunScriptTest(unittest.TestCase):
 
     def test_run_script_std(self):
@@ -0,0 +1,37 @@
+import unittest
+import os
+import tempfile
+import zipfile
+
+from ipub import writers
+
+
+class WriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.files = {'mimetype': b'application/epub+zip',
+                      'OPS/a.xhtml': b'<html/>'}
+        os.makedirs(os.path.join(self.tmp.name, 'OPS'))
+
+    def test_write_dir(self):
+        self.assertEqual(writers.write_dir(self.files.items(), self.tmp.name),
+                         2)
+        self.assertEqual(writers.write_dir(self.files.items(), self.tmp.name),
+                         0)
+        with open(os.path.join(self.tmp.name, 'OPS/a.xhtml'), 'rb') as foi:
+            self.assertEqual(foi.read(), b'<html/>')
+
+    def test_write_zip(self):
+        with open(os.path.join(self.tmp.name, 'exclude.list'), 'w') as foo:
+            foo.write('exclude.list\n')
+        with open(os.path.join(self.tmp.name, 'OPS/b.css'), 'w') as foo:
+            foo.write('p {}')
+        writers.write_zip(self.files.items(), self.tmp.name, 'x.epub')
+        with zipfile.ZipFile(os.path.join(self.tmp.name, 'x.epub')) as zf:
+            infos = zf.infolist()
+            self.assertEqual(infos[0].filename, 'mimetype')
+            self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(sorted(zf.namelist()),
+                             ['OPS/a.xhtml', 'OPS/b.css', 'mimetype'])